@@ -0,0 +1,3 @@
+"""
+Benchmark suite for the conversion pipeline (see run module).
+"""
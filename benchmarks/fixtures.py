@@ -0,0 +1,135 @@
+"""
+Synthetic media fixtures for the benchmarks, generated locally with ffmpeg's
+lavfi sources (no sample files to download or ship).
+"""
+import os
+
+from ffconv.utils import execute_cmd
+
+
+# Subtitle cues, with tags (removed on clean up) and non-ASCII text (so the
+# encoding matters)
+CUES = [
+    ('<i>¿Qué pasó aquí?</i>', '{\\an8}Nada, señor.'),
+    ('<font color="red">¡Atención!</font>', 'Ça va très bien, merci.'),
+    ('Übermäßig große Äpfel.', '<b>Fin.</b>'),
+]
+
+# Fixtures: video size and reference frames, audio channels and codec,
+# subtitles as (format, encoding), and duration in seconds
+FIXTURES = {
+    'sd-compliant': {
+        'size': '640x360', 'refs': 4, 'channels': 2, 'audio_codec': 'aac',
+        'subtitles': [('srt', 'utf-8')], 'duration': 10,
+    },
+    'hd-refs': {
+        'size': '1280x720', 'refs': 12, 'channels': 6, 'audio_codec': 'ac3',
+        'subtitles': [('srt', 'iso-8859-1'), ('ass', 'utf-8')], 'duration': 10,
+    },
+    'fhd-refs': {
+        'size': '1920x1080', 'refs': 8, 'channels': 6, 'audio_codec': 'ac3',
+        'subtitles': [('ass', 'iso-8859-1'), ('srt', 'windows-1252')], 'duration': 10,
+    },
+}
+
+
+def _srt_timestamp(seconds):
+    """
+    Format seconds as an SRT timestamp (eg, 00:01:02,000).
+    """
+    return '{:02d}:{:02d}:{:02d},000'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def _ass_timestamp(seconds):
+    """
+    Format seconds as an ASS timestamp (eg, 0:01:02.00).
+    """
+    return '{:d}:{:02d}:{:02d}.00'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def write_srt(path, encoding, duration):
+    """
+    Write an SRT file with a cue every 2 seconds in the given encoding.
+    """
+    lines = []
+    for number, start in enumerate(range(0, duration, 2)):
+        lines.extend([str(number + 1), '{} --> {}'.format(_srt_timestamp(start), _srt_timestamp(start + 1))])
+        lines.extend(CUES[number % len(CUES)])
+        lines.append('')
+    with open(path, 'w', encoding=encoding, newline='\r\n') as srt:
+        srt.write('\n'.join(lines))
+
+
+def write_ass(path, encoding, duration):
+    """
+    Write an ASS file with a cue every 2 seconds in the given encoding.
+    """
+    lines = ['[Script Info]', 'ScriptType: v4.00+', '',
+             '[V4+ Styles]',
+             'Format: Name, Fontname, Fontsize, PrimaryColour, Bold, Italic, Alignment',
+             'Style: Default,Arial,20,&H00FFFFFF,0,0,2', '',
+             '[Events]',
+             'Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text']
+    for number, start in enumerate(range(0, duration, 2)):
+        text = '\\N'.join(CUES[number % len(CUES)])
+        lines.append('Dialogue: 0,{},{},Default,,0,0,0,,{}'.format(
+            _ass_timestamp(start), _ass_timestamp(start + 1), text))
+    with open(path, 'w', encoding=encoding) as ass:
+        ass.write('\n'.join(lines) + '\n')
+
+
+def build_command(spec, subtitle_files, output):
+    """
+    Build the command to generate a fixture: test pattern video encoded with
+    the given reference frames, sine audio with the given channels and the
+    subtitle files copied as they are (so they keep their encoding).
+    """
+    duration = str(spec['duration'])
+    cmd = ['ffmpeg', '-y',
+           '-f', 'lavfi', '-i', 'testsrc2=size={}:rate=24:duration={}'.format(spec['size'], duration),
+           '-f', 'lavfi', '-i', 'sine=frequency=440:duration={}'.format(duration)]
+    for path in subtitle_files:
+        cmd.extend(['-i', path])
+
+    cmd.extend(['-map', '0:v', '-map', '1:a'])
+    for index in range(len(subtitle_files)):
+        cmd.extend(['-map', '{}:s'.format(index + 2)])
+
+    cmd.extend(['-c:v', 'libx264', '-preset', 'ultrafast', '-refs', str(spec['refs']),
+                '-x264-params', 'ref={}'.format(spec['refs']),
+                '-c:a', spec['audio_codec'], '-ac', str(spec['channels']),
+                '-c:s', 'copy', output])
+    return cmd
+
+
+def generate(directory, names=None):
+    """
+    Generate the fixtures (all, or those with the given names) in the given
+    directory, skipping those already there.
+
+    :param directory: directory for the fixtures
+    :param names: fixture names (all by default)
+    :return: dict of fixture names and file names
+    """
+    os.makedirs(directory, exist_ok=True)
+    files = {}
+    for name in names or sorted(FIXTURES):
+        spec = FIXTURES[name]
+        output = os.path.join(directory, '{}.mkv'.format(name))
+        files[name] = output
+        if os.path.exists(output):
+            continue
+
+        # Write subtitles, then mux them with generated video and audio
+        subtitle_files = []
+        for index, (fmt, encoding) in enumerate(spec['subtitles']):
+            path = os.path.join(directory, '{}-{}.{}'.format(name, index, fmt))
+            writer = write_srt if fmt == 'srt' else write_ass
+            writer(path, encoding, spec['duration'])
+            subtitle_files.append(path)
+
+        execute_cmd(build_command(spec, subtitle_files, output))
+        for path in subtitle_files:
+            os.remove(path)
+
+    return files
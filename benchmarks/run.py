@@ -0,0 +1,234 @@
+"""
+Benchmarks for the conversion pipeline, run on synthetic fixtures (see
+fixtures module) with the real ffmpeg.
+
+Each case runs in a fresh process, so resource usage (CPU time, peak RSS and
+block I/O, from getrusage of the process and its ffmpeg children) is only
+that of the case. Only the measured step is counted, not its set up (eg,
+converting streams before merging them).
+
+Usage:
+
+    python -m benchmarks.run [--repeat 3] [--baseline baseline.json]
+                             [--save-baseline baseline.json]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from ffconv.file_processor import FileProcessor
+
+from .fixtures import FIXTURES, generate
+
+
+# Profile used in all cases
+PROFILE = 'roku'
+
+# Size of blocks reported by getrusage (ru_inblock and ru_oublock)
+BLOCK_SIZE = 512
+
+# Metrics compared with the baseline, and default tolerance for them
+COMPARED = ('wall', 'cpu')
+TOLERANCE = 0.1
+
+
+def _usage():
+    """
+    Get resource usage of this process and its (finished) children.
+    """
+    return (resource.getrusage(resource.RUSAGE_SELF),
+            resource.getrusage(resource.RUSAGE_CHILDREN))
+
+
+def measure(func, *args):
+    """
+    Run a function measuring wall time, CPU time (user and system), peak RSS
+    and bytes read and written (block I/O, so reads from the page cache are
+    not counted), including ffmpeg commands run by it.
+
+    Note: peak RSS is the maximum of the process and any of its children
+    since the process started, that's why cases run in fresh processes.
+
+    :param func: function to run
+    :return: dict of metrics
+    """
+    before = _usage()
+    start = time.perf_counter()
+    func(*args)
+    wall = time.perf_counter() - start
+    after = _usage()
+
+    cpu = sum(a.ru_utime + a.ru_stime - b.ru_utime - b.ru_stime
+              for a, b in zip(after, before))
+    read = sum(a.ru_inblock - b.ru_inblock for a, b in zip(after, before))
+    written = sum(a.ru_oublock - b.ru_oublock for a, b in zip(after, before))
+    return {'wall': wall, 'cpu': cpu,
+            'rss': max(u.ru_maxrss for u in after) * 1024,
+            'read': read * BLOCK_SIZE, 'written': written * BLOCK_SIZE}
+
+
+def list_cases(fixture_file):
+    """
+    List the cases for a fixture: probe, convert of each stream that must be
+    converted, merge, and full process (multi-pass and single-pass).
+
+    :param fixture_file: fixture file name
+    :return: list of case names
+    """
+    processor = FileProcessor(fixture_file, None, PROFILE)
+    cases = ['probe']
+    for stream_processor in processor.get_processors(processor.probe()):
+        if stream_processor.must_convert:
+            cases.append('convert-{}-{}'.format(stream_processor.media_type, stream_processor.index))
+    return cases + ['merge', 'process', 'process-single-pass']
+
+
+def run_case(case, fixture_file, scratch_root):
+    """
+    Set up and measure a single case. This runs in a fresh process.
+
+    :param case: case name
+    :param fixture_file: fixture file name
+    :param scratch_root: directory for outputs and intermediate files
+    :return: dict of metrics
+    """
+    output = os.path.join(scratch_root, 'output.mkv')
+    if case.startswith('process'):
+        processor = FileProcessor(fixture_file, output, PROFILE, scratch_root=scratch_root,
+                                  single_pass=case == 'process-single-pass')
+        return measure(processor.process)
+
+    processor = FileProcessor(fixture_file, output, PROFILE, scratch_root=scratch_root)
+    if case == 'probe':
+        return measure(processor.probe)
+
+    processor.create_work_dir()
+    try:
+        streams = processor.probe()
+        if case == 'merge':
+            processed_streams = processor.process_streams(streams)
+            return measure(processor.merge, processed_streams)
+
+        # Convert a single stream (by index)
+        index = int(case.rsplit('-', 1)[1])
+        stream_processor = [p for p in processor.get_processors(streams) if p.index == index][0]
+        return measure(stream_processor.convert)
+
+    finally:
+        processor.remove_work_dir()
+
+
+def run(fixture_files, repeat=3):
+    """
+    Run all cases for the given fixtures, each one repeated in fresh
+    processes, keeping the median of each metric.
+
+    :param fixture_files: dict of fixture names and file names
+    :param repeat: number of runs of each case
+    :return: dict of results by "fixture/case"
+    """
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    for name, fixture_file in sorted(fixture_files.items()):
+        for case in list_cases(fixture_file):
+            runs = []
+            for _ in range(repeat):
+                scratch_root = tempfile.mkdtemp(prefix='ffconv-bench-')
+                try:
+                    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                        runs.append(executor.submit(run_case, case, fixture_file, scratch_root).result())
+                finally:
+                    shutil.rmtree(scratch_root, ignore_errors=True)
+
+            results['{}/{}'.format(name, case)] = {
+                metric: statistics.median(r[metric] for r in runs) for metric in runs[0]}
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """
+    Compare results with a baseline, finding regressions: compared metrics
+    that grew more than the tolerance (a fraction of the baseline).
+
+    :param results: dict of results by "fixture/case"
+    :param baseline: dict of baseline results, same format
+    :param tolerance: allowed growth (eg, 0.1 for 10%)
+    :return: list of (key, metric, baseline value, value)
+    """
+    regressions = []
+    for key, metrics in sorted(results.items()):
+        for metric in COMPARED:
+            base = baseline.get(key, {}).get(metric)
+            if base and metrics[metric] > base * (1 + tolerance):
+                regressions.append((key, metric, base, metrics[metric]))
+    return regressions
+
+
+def format_results(results, baseline=None):
+    """
+    Format results as a table, with the change in wall time from the
+    baseline (if given).
+
+    :return: table text
+    """
+    lines = ['{:40} {:>9} {:>9} {:>9} {:>11} {:>11} {:>8}'.format(
+        'case', 'wall (s)', 'cpu (s)', 'rss (MB)', 'read (MB)', 'write (MB)', 'change')]
+    for key, metrics in sorted(results.items()):
+        change = ''
+        base = (baseline or {}).get(key, {}).get('wall')
+        if base:
+            change = '{:+.0%}'.format(metrics['wall'] / base - 1)
+        lines.append('{:40} {:9.2f} {:9.2f} {:9.1f} {:11.1f} {:11.1f} {:>8}'.format(
+            key, metrics['wall'], metrics['cpu'], metrics['rss'] / 2 ** 20,
+            metrics['read'] / 2 ** 20, metrics['written'] / 2 ** 20, change))
+    return '\n'.join(lines)
+
+
+# Init parser and add params
+parser = argparse.ArgumentParser(prog='python -m benchmarks.run',
+                                 description='Benchmark the conversion pipeline on synthetic media')
+parser.add_argument('--fixtures', '-f', type=str, nargs='*', choices=sorted(FIXTURES),
+                    help='Fixtures to run (all by default)')
+parser.add_argument('--fixtures-dir', type=str, default=os.path.join(tempfile.gettempdir(), 'ffconv-fixtures'),
+                    help='Directory where fixtures are generated (and kept for next runs)')
+parser.add_argument('--repeat', '-r', type=int, default=3,
+                    help='Number of runs of each case (the median is reported)')
+parser.add_argument('--baseline', '-b', type=str,
+                    help='Baseline results to compare with (exit with 1 on regressions)')
+parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                    help='Allowed growth of wall and CPU time over the baseline (eg, 0.1 for 10%%)')
+parser.add_argument('--save-baseline', type=str,
+                    help='File where results are saved, to use as baseline later')
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    results = run(generate(args.fixtures_dir, args.fixtures), args.repeat)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    print(format_results(results, baseline))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        for key, metric, base, value in regressions:
+            print('REGRESSION {} {}: {:.2f} -> {:.2f}'.format(key, metric, base, value))
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
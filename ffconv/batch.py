@@ -0,0 +1,344 @@
+"""
+This module contains the batch processor, which runs file processors for
+many files on bounded pools of worker processes.
+"""
+import asyncio
+import glob
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from . import profiles
+from .file_processor import FileProcessor
+from .utils import cpu_budget
+
+
+# Extensions of the files we consider media when walking directories
+MEDIA_EXTENSIONS = ('.avi', '.m4v', '.mkv', '.mov', '.mp4', '.mpg', '.mpeg',
+                    '.ts', '.webm', '.wmv')
+
+
+def walk_paths(paths, extensions=MEDIA_EXTENSIONS):
+    """
+    Expand the given paths into a sorted list of media files, with their
+    names relative to the directory they were found in (base names for files
+    given explicitly). Each path can be a file, a directory (walked
+    recursively) or a glob pattern.
+
+    :param paths: list of paths
+    :param extensions: extensions of files to collect from directories
+    :return: list of tuples with file name and relative name, without
+             duplicates
+    """
+    files = []
+    for path in paths:
+        # Expand glob patterns (unless it's an actual path, names such as
+        # "Film [1080p].mkv" are quite common)
+        matches = [path] if os.path.exists(path) else sorted(glob.glob(path))
+        if not matches:
+            raise ValueError('File {} could not be found'.format(path))
+
+        for match in matches:
+            if os.path.isdir(match):
+                # Walk directory, keeping only media files
+                for root, dirs, names in os.walk(match):
+                    dirs.sort()
+                    files.extend((os.path.join(root, name), os.path.relpath(os.path.join(root, name), match))
+                                 for name in sorted(names)
+                                 if os.path.splitext(name)[1].lower() in extensions)
+
+            else:
+                # Explicit files are always included
+                files.append((match, os.path.basename(match)))
+
+    # Remove duplicates keeping order
+    seen = set()
+    return [(f, n) for f, n in files if not (f in seen or seen.add(f))]
+
+
+def collect_files(paths, extensions=MEDIA_EXTENSIONS):
+    """
+    Expand the given paths into a sorted list of media files (see
+    walk_paths).
+
+    :param paths: list of paths
+    :param extensions: extensions of files to collect from directories
+    :return: list of file names, without duplicates
+    """
+    return [f for f, _ in walk_paths(paths, extensions)]
+
+
+def output_files(files, output_dir, names=None):
+    """
+    Get the output file names for files converted into a directory, keeping
+    their names relative to the directories they were found in (so files
+    with the same name in different directories do not collide).
+
+    :param files: input file names
+    :param output_dir: directory for the outputs (None to replace inputs)
+    :param names: dict of input file names and relative names (see
+                  walk_paths), base names are used for the rest
+    :return: dict of input and output file names (None if replacing them)
+    """
+    outputs = {}
+    for in_file in files:
+        output = None
+        if output_dir:
+            name = (names or {}).get(in_file) or os.path.basename(in_file)
+            output = os.path.join(output_dir, name)
+        outputs[in_file] = output
+
+    # Check collisions before starting, or jobs would overwrite each other
+    seen = {}
+    for in_file, output in outputs.items():
+        if output is not None and output in seen:
+            raise ValueError('Files {} and {} would have the same output {}'.format(
+                seen[output], in_file, output))
+        seen[output] = in_file
+    return outputs
+
+
+def read_list(list_file):
+    """
+    Read paths from a list file, one per line (blank lines and comments are
+    ignored).
+
+    :param list_file: file object
+    :return: list of paths
+    """
+    lines = (line.strip() for line in list_file)
+    return [line for line in lines if line and not line.startswith('#')]
+
+
+def process_file(in_file, output, profile, original_streams=None, **kwargs):
+    """
+    Process a single file, catching any errors. This is what batch workers
+    run, so it must always return and its result must be picklable.
+
+    :param in_file: input file name
+    :param output: output file name (None to replace the input)
+    :param profile: profile name
+    :param original_streams: streams data, if the file was already probed
+    :return: result data, with input, time and error (if any)
+    """
+    start = time.monotonic()
+    try:
+        processor = FileProcessor(in_file, output, profile, **kwargs)
+        res = processor.process(original_streams)
+
+    except Exception as e:
+        # Failed, just return error message
+        res = {'error': str(e) or e.__class__.__name__}
+
+    res.update(input=in_file, time=time.monotonic() - start)
+    return res
+
+
+class BatchProcessor(object):
+    """
+    Processor for many files, which probes each of them and dispatches the
+    actual processing to one of two pools of worker processes: one for the
+    CPU-heavy jobs (video transcodes) and one for cheap jobs (remux, audio
+    and subtitles).
+    """
+    executor_cls = ProcessPoolExecutor
+
+    def __init__(self, files, profile, output_dir=None, jobs=None,
+                 video_jobs=1, names=None, **kwargs):
+        """
+        Set files, profile (resolved once for all files), output directory
+        (with names of the outputs relative to it, see output_files),
+        concurrency limits and options for the file processors.
+        """
+        self.files = files
+        self.profile = profiles.get_profile(profile)
+        self.output_dir = output_dir
+        self.outputs = output_files(files, output_dir, names)
+        self.jobs = jobs or os.cpu_count() or 1
+        self.video_jobs = video_jobs
+        self.options = kwargs
+
+        # Auto threads (given, or from the profile): divide CPUs between the
+        # video jobs running at once
+        rules = profiles.compile_profile(self.profile)
+        threads = kwargs.get('threads') or (rules.video.threads if rules.video else None)
+        if threads == 'auto':
+            kwargs['threads'] = cpu_budget(video_jobs, kwargs.get('affinity'))
+        self.results = []
+        self.logger = logging.getLogger()
+
+    def __str__(self):
+        return 'Batch <{} files>'.format(len(self.files))
+
+    def get_output(self, in_file):
+        """
+        Get the output file name for an input (None if replacing inputs).
+        """
+        return self.outputs.get(in_file)
+
+    def classify(self, in_file):
+        """
+        Probe the input file and decide whether it's a heavy job, ie, if some
+        video stream must be converted.
+
+        :param in_file: input file name
+        :return: tuple with streams data and heavy flag
+        """
+        processor = FileProcessor(in_file, None, self.profile, **self.options)
+        streams = processor.probe()
+        return streams, self.is_heavy(processor, streams)
+
+    @staticmethod
+    def is_heavy(processor, streams):
+        """
+        Check whether processing the streams is a heavy job, ie, if some video
+        stream must be converted.
+
+        :param processor: file processor
+        :param streams: streams data as probed
+        :return: heavy flag
+        """
+        return any(p.media_type == 'video' and p.must_convert
+                   for p in processor.get_processors(streams))
+
+    def process(self):
+        """
+        Process all files, returning when all of them are done.
+
+        :return: list of results, in the same order as files
+        """
+        self.collect_garbage()
+        futures = {}
+        with self.executor_cls(max_workers=self.video_jobs) as heavy_pool, \
+                self.executor_cls(max_workers=self.jobs) as light_pool:
+            for in_file in self.files:
+                # Check verdict, so we skip files already done
+                start = time.monotonic()
+                output = self.get_output(in_file)
+                processor = FileProcessor(in_file, output, self.profile, **self.options)
+                verdict = processor.get_verdict()
+                if verdict:
+                    self.logger.debug('{}: skipping {}, already {}'.format(self, in_file, verdict['verdict']))
+                    futures[in_file] = {'input': in_file, 'output': verdict['output'],
+                                        'verdict': verdict['verdict'],
+                                        'time': time.monotonic() - start}
+                    continue
+
+                # Probe in this process, so we know which pool to use
+                try:
+                    streams, heavy = self.classify(in_file)
+
+                except Exception as e:
+                    # Could not even probe, no need to submit
+                    self.logger.debug('{}: {}: {}'.format(self, in_file, e))
+                    futures[in_file] = {'input': in_file, 'error': str(e),
+                                        'time': time.monotonic() - start}
+                    continue
+
+                pool = heavy_pool if heavy else light_pool
+                self.logger.debug('{}: submitting {} ({})'.format(self, in_file, 'heavy' if heavy else 'light'))
+                futures[in_file] = pool.submit(process_file, in_file, output,
+                                               self.profile, streams,
+                                               **self.options)
+
+        # Pools are shut down, so all futures are done
+        self.results = [f if isinstance(f, dict) else f.result()
+                        for f in futures.values()]
+        return self.results
+
+    async def process_async(self, timeout=None):
+        """
+        Asyncio version of process, which processes all files from a single
+        event loop with asyncio subprocesses instead of worker processes.
+        The concurrency limits are enforced with semaphores (probes have their
+        own one, as big as the cheap jobs limit).
+
+        :param timeout: maximum time in seconds for each file (None to wait
+                        forever), after which its commands are killed
+        :return: list of results, in the same order as files
+        """
+        await asyncio.to_thread(self.collect_garbage)
+        limits = {'probe': asyncio.Semaphore(self.jobs),
+                  'light': asyncio.Semaphore(self.jobs),
+                  'heavy': asyncio.Semaphore(self.video_jobs)}
+        self.results = await asyncio.gather(*(self._process_file_async(f, limits, timeout)
+                                              for f in self.files))
+        return self.results
+
+    async def _process_file_async(self, in_file, limits, timeout):
+        """
+        Process a single file within the concurrency limits, catching any
+        errors (and timeouts).
+
+        :return: result data, with input, time and error (if any)
+        """
+        start = time.monotonic()
+        processor = FileProcessor(in_file, self.get_output(in_file),
+                                  self.profile, **self.options)
+        try:
+            # Check verdict, so we skip files already done
+            verdict = await asyncio.to_thread(processor.get_verdict)
+            if verdict:
+                self.logger.debug('{}: skipping {}, already {}'.format(self, in_file, verdict['verdict']))
+                res = {'output': verdict['output'], 'verdict': verdict['verdict']}
+
+            else:
+                # Probe, so we know which limit to use
+                async with limits['probe']:
+                    streams = await processor.probe_async()
+
+                heavy = self.is_heavy(processor, streams)
+                self.logger.debug('{}: starting {} ({})'.format(self, in_file, 'heavy' if heavy else 'light'))
+                async with limits['heavy' if heavy else 'light']:
+                    res = await asyncio.wait_for(processor.process_async(streams), timeout)
+
+        except asyncio.TimeoutError:
+            res = {'error': 'Timed out after {}s'.format(timeout)}
+
+        except Exception as e:
+            res = {'error': str(e) or e.__class__.__name__}
+
+        res.update(input=in_file, time=time.monotonic() - start)
+        return res
+
+    def collect_garbage(self):
+        """
+        Remove orphan jobs left by interrupted runs that cannot be resumed
+        (resumable ones are resumed as their files are processed).
+        """
+        journal = self.options.get('journal')
+        if journal is not None:
+            removed = journal.collect_garbage()
+            if removed:
+                self.logger.debug('{}: removed {} orphan jobs'.format(self, removed))
+
+    @property
+    def failures(self):
+        """
+        Results of the files that could not be processed.
+        """
+        return [r for r in self.results if r.get('error')]
+
+    def summary(self):
+        """
+        Build a human-readable summary of the results, with per-file timings.
+
+        :return: summary text
+        """
+        lines = []
+        for res in self.results:
+            if res.get('error'):
+                status = 'FAILED: {}'.format(res['error'])
+            elif res.get('verdict'):
+                status = 'SKIPPED: already {}'.format(res['verdict'])
+            else:
+                status = 'OK'
+            lines.append('{:8.1f}s  {}  {}'.format(res['time'], res['input'], status))
+
+        total = sum(r['time'] for r in self.results)
+        skipped = len([r for r in self.results if r.get('verdict')])
+        lines.append('{} files, {} succeeded, {} skipped, {} failed ({:.1f}s of processing)'.format(
+            len(self.results), len(self.results) - len(self.failures) - skipped,
+            skipped, len(self.failures), total))
+        return '\n'.join(lines)
@@ -0,0 +1,694 @@
+"""
+This module contains the persistent caches, used to avoid repeating work
+already done in previous runs.
+"""
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+
+from .utils import fingerprint, link_or_copy, remove_files
+
+
+# Default size limit of the stream cache, in bytes (see StreamCache)
+STREAM_CACHE_SIZE = 50 * 2 ** 30
+
+
+def default_cache_dir():
+    """
+    Get the default cache directory (following XDG, ~/.cache/ffconv).
+    """
+    root = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(root, 'ffconv')
+
+
+def profile_hash(profile):
+    """
+    Get a hash of the profile contents, which changes whenever any of its
+    target values is modified.
+
+    :param profile: profile data
+    :return: hex digest
+    """
+    data = json.dumps(profile, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+class SQLiteStore(object):
+    """
+    Base class for stores in a SQLite database file under the cache
+    directory, with a single table.
+
+    Note: a connection is opened for every operation, so stores can be shared
+    by many processes (and pickled to send them to those processes).
+    """
+    file_name = None
+    table = None
+    schema = ()
+
+    def __init__(self, cache_dir=None):
+        """
+        Set cache directory and database file name.
+        """
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.db_file = os.path.join(self.cache_dir, self.file_name)
+
+    def __str__(self):
+        return '{} <{}>'.format(self.__class__.__name__, self.db_file)
+
+    def __len__(self):
+        conn = self._connect()
+        try:
+            return conn.execute('SELECT COUNT(*) FROM {}'.format(self.table)).fetchone()[0]
+        finally:
+            conn.close()
+
+    def _connect(self):
+        """
+        Open a connection to the database, creating it if required.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        conn = sqlite3.connect(self.db_file, timeout=30)
+        for statement in self.schema:
+            conn.execute(statement)
+        return conn
+
+    def invalidate(self, paths=None):
+        """
+        Remove entries for the given files, or all of them.
+
+        :param paths: file names (None to clear everything)
+        :return: number of removed entries
+        """
+        conn = self._connect()
+        try:
+            with conn:
+                if paths is None:
+                    return conn.execute('DELETE FROM {}'.format(self.table)).rowcount
+
+                keys = [(os.path.realpath(path),) for path in paths]
+                return conn.executemany('DELETE FROM {} WHERE path = ?'.format(self.table),
+                                        keys).rowcount
+        finally:
+            conn.close()
+
+
+class ProbeCache(SQLiteStore):
+    """
+    Cache of probe results, keyed by file identity (path, size and
+    modification time, optionally inode), so files are only probed again
+    when they change.
+
+    Least recently used entries are evicted when there are more than
+    max_entries.
+    """
+    file_name = 'probe.sqlite'
+    table = 'probes'
+    schema = ('CREATE TABLE IF NOT EXISTS probes ('
+              'path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, '
+              'inode INTEGER, streams TEXT, accessed REAL)',
+              'CREATE INDEX IF NOT EXISTS probes_accessed ON probes (accessed)')
+
+    def __init__(self, cache_dir=None, max_entries=100000, inode=False):
+        """
+        Set database file name, size limit and identity mode.
+        """
+        super(ProbeCache, self).__init__(cache_dir)
+        self.max_entries = max_entries
+        self.inode = inode
+
+    def get(self, path):
+        """
+        Get cached streams data for the file, if it did not change since it
+        was probed.
+
+        :param path: file name
+        :return: list of streams data (None if not cached)
+        """
+        key = fingerprint(path, self.inode)
+        conn = self._connect()
+        try:
+            with conn:
+                row = conn.execute('SELECT size, mtime, inode, streams FROM probes '
+                                   'WHERE path = ?', key[:1]).fetchone()
+                if row is None:
+                    return None
+
+                if tuple(row[:3]) != key[1:]:
+                    # File changed, entry is no good anymore
+                    conn.execute('DELETE FROM probes WHERE path = ?', key[:1])
+                    return None
+
+                # Hit, update access time for LRU
+                conn.execute('UPDATE probes SET accessed = ? WHERE path = ?',
+                             (time.time(), key[0]))
+                return json.loads(row[3])
+        finally:
+            conn.close()
+
+    def set(self, path, streams):
+        """
+        Store streams data for the file, evicting least recently used
+        entries if over the limit.
+
+        :param path: file name
+        :param streams: list of streams data
+        """
+        key = fingerprint(path, self.inode)
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?, ?)',
+                             key + (json.dumps(streams), time.time()))
+                conn.execute('DELETE FROM probes WHERE path IN ('
+                             'SELECT path FROM probes ORDER BY accessed DESC '
+                             'LIMIT -1 OFFSET ?)', (self.max_entries,))
+        finally:
+            conn.close()
+
+
+class VerdictIndex(SQLiteStore):
+    """
+    Index of verdicts for processed files: whether they were compliant with
+    a profile or converted (and where to), keyed by file identity and profile
+    (name and hash), so re-runs can skip them without probing.
+    """
+    file_name = 'verdicts.sqlite'
+    table = 'verdicts'
+    schema = ('CREATE TABLE IF NOT EXISTS verdicts ('
+              'path TEXT, profile TEXT, profile_hash TEXT, size INTEGER, '
+              'mtime INTEGER, inode INTEGER, verdict TEXT, output TEXT, '
+              'updated REAL, PRIMARY KEY (path, profile))',)
+
+    # Possible verdicts
+    COMPLIANT = 'compliant'
+    CONVERTED = 'converted'
+
+    def get(self, path, profile, output=None):
+        """
+        Get the verdict for the file with the profile, if neither of them
+        changed since it was recorded (and the output is the same one, and
+        still exists).
+
+        :param path: file name
+        :param profile: profile data
+        :param output: output file name (None if replacing the input)
+        :return: dict with verdict and output (None if not found)
+        """
+        try:
+            key = fingerprint(path)
+        except OSError:
+            # Not there, we cannot know
+            return None
+
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT profile_hash, size, mtime, verdict, output '
+                               'FROM verdicts WHERE path = ? AND profile = ?',
+                               (key[0], profile['name'])).fetchone()
+        finally:
+            conn.close()
+
+        if row is None or tuple(row[:3]) != (profile_hash(profile),) + key[1:3]:
+            # Unknown or changed
+            return None
+
+        verdict, recorded_output = row[3:]
+        if output != recorded_output:
+            # Written to (or linked as) another output, or in place, this one
+            # is still to be done
+            return None
+
+        if recorded_output and not os.path.exists(recorded_output):
+            # Output removed since
+            return None
+
+        return {'verdict': verdict, 'output': recorded_output}
+
+    def set(self, path, profile, verdict, output=None):
+        """
+        Record the verdict for the file (as it is now) with the profile.
+
+        :param path: file name
+        :param profile: profile data
+        :param verdict: COMPLIANT or CONVERTED
+        :param output: output file name (None if input was replaced)
+        """
+        key = fingerprint(path)
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO verdicts VALUES '
+                             '(?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             (key[0], profile['name'], profile_hash(profile),
+                              key[1], key[2], key[3], verdict, output,
+                              time.time()))
+        finally:
+            conn.close()
+
+
+class JobJournal(SQLiteStore):
+    """
+    Write-ahead journal of file jobs, keyed by file and profile name, which
+    records the state of each job as it advances (with its work directory,
+    temporary output and the streams already converted), so a job
+    interrupted by a crash or reboot is resumed where it stopped by the next
+    run, reusing what was done. Entries are removed when jobs are done.
+
+    Jobs whose process is gone are orphans: they're resumed if possible,
+    otherwise their files are removed (see collect_garbage).
+    """
+    file_name = 'journal.sqlite'
+    table = 'jobs'
+    schema = ('CREATE TABLE IF NOT EXISTS jobs ('
+              'path TEXT, profile TEXT, profile_hash TEXT, size INTEGER, '
+              'mtime INTEGER, output TEXT, work_dir TEXT, tmp_file TEXT, '
+              'state TEXT, streams TEXT, host TEXT, pid INTEGER, '
+              'process TEXT, updated REAL, PRIMARY KEY (path, profile))',)
+    columns = ('path', 'profile', 'profile_hash', 'size', 'mtime', 'output',
+               'work_dir', 'tmp_file', 'state', 'streams', 'host', 'pid',
+               'process', 'updated')
+
+    # Job states, in order
+    STARTED = 'started'
+    PROBED = 'probed'
+    CONVERTED = 'converted'
+    MERGED = 'merged'
+
+    @staticmethod
+    def process_id(pid):
+        """
+        Get the identity of a process, which tells it apart from later ones
+        with the same pid (eg, after a reboot): boot id and start time, from
+        /proc (Linux only).
+
+        :param pid: process id
+        :return: identity (None if not available)
+        """
+        try:
+            with open('/proc/sys/kernel/random/boot_id') as f:
+                boot_id = f.read().strip()
+            with open('/proc/{}/stat'.format(pid)) as f:
+                # Start time is the 22nd field, the 2nd one (command) may
+                # have spaces but it's the only one in parentheses
+                start_time = f.read().rpartition(')')[2].split()[19]
+        except (OSError, IndexError):
+            return None
+        return '{}:{}'.format(boot_id, start_time)
+
+    @classmethod
+    def _owner(cls):
+        """
+        Get the owner of jobs run by this process: host, pid and process
+        identity.
+        """
+        return os.uname().nodename, os.getpid(), cls.process_id(os.getpid())
+
+    @classmethod
+    def is_running(cls, job):
+        """
+        Check whether the process that owns a job is still running (always
+        assumed for other hosts, we cannot know). A process with the same pid
+        but another identity (eg, after a reboot) is not the owner.
+
+        :param job: job data
+        :return: running flag
+        """
+        if job['host'] != os.uname().nodename:
+            return True
+        try:
+            os.kill(job['pid'], 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return job['process'] is None or job['process'] == cls.process_id(job['pid'])
+
+    def is_resumable(self, job):
+        """
+        Check whether a job can be resumed: it was merged and its temporary
+        output is still there, or its file did not change and its work
+        directory (with the streams converted) is still there.
+
+        :param job: job data
+        :return: resumable flag
+        """
+        if job['state'] == self.MERGED:
+            return os.path.exists(job['tmp_file'])
+
+        try:
+            same = fingerprint(job['path'])[1:3] == (job['size'], job['mtime'])
+        except OSError:
+            same = False
+        return same and os.path.isdir(job['work_dir'])
+
+    def _query(self, where='', params=()):
+        """
+        Get the jobs that match the given condition, as dicts.
+        """
+        conn = self._connect()
+        try:
+            rows = conn.execute('SELECT * FROM jobs {}'.format(where), params).fetchall()
+        finally:
+            conn.close()
+
+        jobs = [dict(zip(self.columns, row)) for row in rows]
+        for job in jobs:
+            job['streams'] = json.loads(job['streams'])
+        return jobs
+
+    def _remove(self, job):
+        """
+        Remove a job: its files (temporary output and work directory) and its
+        entry.
+        """
+        if job['tmp_file'] and os.path.exists(job['tmp_file']):
+            os.remove(job['tmp_file'])
+        if job['work_dir']:
+            shutil.rmtree(job['work_dir'], ignore_errors=True)
+        self.finish(job['path'], {'name': job['profile']})
+
+    def get(self, path, profile):
+        """
+        Get the job for the file and profile, if any.
+
+        :param path: file name
+        :param profile: profile data
+        :return: job data (None if not found)
+        """
+        jobs = self._query('WHERE path = ? AND profile = ?',
+                           (os.path.realpath(path), profile['name']))
+        return jobs[0] if jobs else None
+
+    def resume(self, path, profile, output=None):
+        """
+        Take over the job for the file and profile left by a run that did
+        not finish, if it can be resumed with the same profile and output.
+        Otherwise its files are removed.
+
+        :param path: file name
+        :param profile: profile data
+        :param output: output file name (None if replacing the input)
+        :return: job data (None if there's nothing to resume)
+        """
+        job = self.get(path, profile)
+        if job is None or self.is_running(job):
+            return None
+
+        if job['profile_hash'] != profile_hash(profile) or job['output'] != output \
+                or not self.is_resumable(job):
+            self._remove(job)
+            return None
+
+        self.update(path, profile, job['state'])
+        return job
+
+    def start(self, path, profile, output, work_dir, tmp_file):
+        """
+        Record a new job for the file (as it is now) and profile.
+
+        :param path: file name
+        :param profile: profile data
+        :param output: output file name (None if replacing the input)
+        :param work_dir: work directory of the job
+        :param tmp_file: temporary output of the job
+        """
+        key = fingerprint(path)
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO jobs VALUES '
+                             '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             (key[0], profile['name'], profile_hash(profile),
+                              key[1], key[2], output, work_dir, tmp_file,
+                              self.STARTED, '{}') + self._owner() + (time.time(),))
+        finally:
+            conn.close()
+
+    def update(self, path, profile, state):
+        """
+        Update the state of the job (and its owner, this process).
+
+        :param path: file name
+        :param profile: profile data
+        :param state: new state
+        """
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('UPDATE jobs SET state = ?, host = ?, pid = ?, process = ?, updated = ? '
+                             'WHERE path = ? AND profile = ?',
+                             (state,) + self._owner() + (time.time(), os.path.realpath(path),
+                                                         profile['name']))
+        finally:
+            conn.close()
+
+    def add_stream(self, path, profile, stream_key, stream):
+        """
+        Record a converted stream of the job.
+
+        :param path: file name
+        :param profile: profile data
+        :param stream_key: key of the stream (its index in the file, see
+            StreamProcessor.key)
+        :param stream: processed stream data
+        """
+        key = (os.path.realpath(path), profile['name'])
+        conn = self._connect()
+        conn.isolation_level = None
+        try:
+            # Read and write in the same transaction, streams of a file might
+            # be converted concurrently
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT streams FROM jobs WHERE path = ? AND profile = ?',
+                               key).fetchone()
+            if row:
+                streams = json.loads(row[0])
+                streams[str(stream_key)] = stream
+                conn.execute('UPDATE jobs SET streams = ?, updated = ? '
+                             'WHERE path = ? AND profile = ?',
+                             (json.dumps(streams), time.time()) + key)
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def finish(self, path, profile):
+        """
+        Remove the entry for the job of the file and profile, once done.
+
+        :param path: file name
+        :param profile: profile data
+        """
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('DELETE FROM jobs WHERE path = ? AND profile = ?',
+                             (os.path.realpath(path), profile['name']))
+        finally:
+            conn.close()
+
+    def orphans(self):
+        """
+        Get the jobs whose process is gone.
+
+        :return: list of job data
+        """
+        return [job for job in self._query() if not self.is_running(job)]
+
+    def collect_garbage(self, everything=False):
+        """
+        Remove orphan jobs that cannot be resumed (eg, their file changed or
+        their work directory is gone), with their files, or all of them.
+
+        :param everything: remove resumable orphans too
+        :return: number of removed jobs
+        """
+        removed = 0
+        for job in self.orphans():
+            if everything or not self.is_resumable(job):
+                self._remove(job)
+                removed += 1
+        return removed
+
+    def invalidate(self, paths=None):
+        """
+        Remove entries (and files) of jobs for the given files, or all of
+        them, except for jobs still running.
+
+        :param paths: file names (None to clear everything)
+        :return: number of removed entries
+        """
+        jobs = self.orphans()
+        if paths is not None:
+            keys = [os.path.realpath(path) for path in paths]
+            jobs = [job for job in jobs if job['path'] in keys]
+
+        for job in jobs:
+            self._remove(job)
+        return len(jobs)
+
+
+class StreamCache(SQLiteStore):
+    """
+    Content-addressed cache of converted streams, keyed by the identity of
+    their source file, the stream (see StreamProcessor.key) and the
+    parameters of the conversion (see StreamProcessor.params), so a stream is
+    never converted twice with the same parameters (eg, the video when only
+    the subtitle rules of the profile changed, or when a merge failed).
+
+    Stream files are stored next to the database, so the whole cache can be
+    put on its own disk, and least recently used ones are evicted when they
+    take more than max_size bytes.
+    """
+    file_name = 'streams.sqlite'
+    table = 'streams'
+    schema = ('CREATE TABLE IF NOT EXISTS streams ('
+              'key TEXT PRIMARY KEY, path TEXT, file TEXT, size INTEGER, '
+              'stream TEXT, accessed REAL)',
+              'CREATE INDEX IF NOT EXISTS streams_accessed ON streams (accessed)',
+              'CREATE INDEX IF NOT EXISTS streams_path ON streams (path)')
+
+    def __init__(self, cache_dir=None, max_size=STREAM_CACHE_SIZE):
+        """
+        Set database file name, directory for stream files and size limit.
+        """
+        super(StreamCache, self).__init__(cache_dir)
+        self.files_dir = os.path.join(self.cache_dir, 'streams')
+        self.max_size = max_size
+
+    def __contains__(self, key):
+        conn = self._connect()
+        try:
+            return conn.execute('SELECT 1 FROM streams WHERE key = ?', (key,)).fetchone() is not None
+        finally:
+            conn.close()
+
+    @staticmethod
+    def key(path, stream_key, params):
+        """
+        Build the key of a converted stream.
+
+        :param path: source file name
+        :param stream_key: key of the stream in the file
+        :param params: parameters of the conversion (JSON serializable)
+        :return: hex digest
+        """
+        data = json.dumps([fingerprint(path)[:3], stream_key, params], sort_keys=True, default=str)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def get(self, key, work_dir):
+        """
+        Get a converted stream, linking (or copying) its file into the work
+        directory.
+
+        :param key: key of the stream (see key)
+        :param work_dir: directory for the stream file
+        :return: processed stream data (None if not cached)
+        """
+        conn = self._connect()
+        try:
+            with conn:
+                row = conn.execute('SELECT file, stream FROM streams WHERE key = ?', (key,)).fetchone()
+                if row is None:
+                    return None
+
+                # Hit, update access time for LRU
+                conn.execute('UPDATE streams SET accessed = ? WHERE key = ?', (time.time(), key))
+        finally:
+            conn.close()
+
+        stream = json.loads(row[1])
+        stream['input'] = os.path.join(work_dir, stream['input'])
+        try:
+            link_or_copy(os.path.join(self.files_dir, row[0]), stream['input'])
+        except OSError:
+            # File evicted (or removed) meanwhile, entry is no good anymore
+            self._delete([key])
+            return None
+        return stream
+
+    def set(self, key, path, stream):
+        """
+        Store a converted stream, evicting least recently used ones if over
+        the size limit.
+
+        :param key: key of the stream (see key)
+        :param path: source file name
+        :param stream: processed stream data (its input is the stream file)
+        """
+        name = os.path.join(key[:2], key + os.path.splitext(stream['input'])[1])
+        stored = os.path.join(self.files_dir, name)
+        os.makedirs(os.path.dirname(stored), exist_ok=True)
+
+        # Link (or copy) it atomically, it might be read concurrently
+        tmp = '{}.{}.tmp'.format(stored, os.getpid())
+        link_or_copy(stream['input'], tmp)
+        os.replace(tmp, stored)
+
+        record = dict(stream, input=os.path.basename(stream['input']))
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO streams VALUES (?, ?, ?, ?, ?, ?)',
+                             (key, os.path.realpath(path), name, os.path.getsize(stored),
+                              json.dumps(record), time.time()))
+
+                # Evict least recently used ones over the limit
+                total = 0
+                evicted = []
+                for row in conn.execute('SELECT key, file, size FROM streams ORDER BY accessed DESC').fetchall():
+                    total += row[2]
+                    if total > self.max_size:
+                        evicted.append(row[:2])
+                conn.executemany('DELETE FROM streams WHERE key = ?', [row[:1] for row in evicted])
+        finally:
+            conn.close()
+        remove_files(os.path.join(self.files_dir, row[1]) for row in evicted)
+
+    def _delete(self, keys):
+        """
+        Remove entries by key (but not their files).
+        """
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany('DELETE FROM streams WHERE key = ?', [(key,) for key in keys])
+        finally:
+            conn.close()
+
+    def size(self):
+        """
+        Get the total size of the stream files, in bytes.
+        """
+        conn = self._connect()
+        try:
+            return conn.execute('SELECT COALESCE(SUM(size), 0) FROM streams').fetchone()[0]
+        finally:
+            conn.close()
+
+    def invalidate(self, paths=None):
+        """
+        Remove entries (and files) for streams of the given files, or all of
+        them.
+
+        :param paths: file names (None to clear everything)
+        :return: number of removed entries
+        """
+        conn = self._connect()
+        try:
+            with conn:
+                if paths is None:
+                    rows = conn.execute('SELECT key, file FROM streams').fetchall()
+                else:
+                    rows = []
+                    for path in paths:
+                        rows.extend(conn.execute('SELECT key, file FROM streams WHERE path = ?',
+                                                 (os.path.realpath(path),)).fetchall())
+                conn.executemany('DELETE FROM streams WHERE key = ?', [row[:1] for row in rows])
+        finally:
+            conn.close()
+
+        remove_files(os.path.join(self.files_dir, row[1]) for row in rows)
+        return len(rows)
@@ -2,12 +2,39 @@
 This module contains the actual file processor, which is the main object
 that carries out the conversion.
 """
+import asyncio
+import copy
 import json
 import logging
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
 
 from . import profiles
-from .utils import execute_cmd
-from .stream_processors import StreamProcessor
+from .cache import JobJournal
+from .progress import track
+from .utils import execute_cmd, execute_cmd_async, file_duration, cpu_budget, cpu_limiter, \
+    link_or_copy, remove_files, ChildEvent
+from .stream_processors import StreamProcessor, AudioBatch, SEGMENT_LENGTH
+
+
+# Limits of fast probes (see FileProcessor.probe): bytes read and seconds of
+# media analyzed to find the streams and their parameters
+FAST_PROBE_SIZE = 1024 * 1024
+FAST_ANALYZE_DURATION = 1.0
+
+# Stream fields shown by fast probes, only those used by stream processors
+# (and the planner), and the ones they require
+PROBE_ENTRIES = ('index', 'codec_type', 'codec_name', 'refs', 'width', 'height',
+                 'channels', 'duration', 'bit_rate')
+REQUIRED_ENTRIES = {'video': ('codec_name', 'refs', 'height'),
+                    'audio': ('codec_name', 'channels'),
+                    'subtitle': ('codec_name',)}
+
+# ffmpeg log messages of subtitles that could not be decoded with the given
+# character encoding (see FileProcessor.transcode)
+CHARSET_ERRORS = (b'sub_charenc', b'recode subtitle', b'iconv', b'Invalid UTF-8')
 
 
 class FileProcessor(object):
@@ -15,7 +42,6 @@ class FileProcessor(object):
     Process for multimedia file, which delegates processing of streams to
     StreamProcessor subclasses.
     """
-    tmp_file = 'tmp.mkv'
 
     @staticmethod
     def _build_merge_params(streams, inputs, maps, meta):
@@ -37,13 +63,14 @@ class FileProcessor(object):
                              'language={}'.format(stream['language'])])
 
     @staticmethod
-    def _build_merge_command(inputs, maps, meta, output):
+    def _build_merge_command(inputs, maps, meta, output, force=False):
         """
-        Build merge command (if we need to make a conversion) as a list of
-        strings.
+        Build merge command (if we need to make a conversion, or to drop
+        streams) as a list of strings. A single input is only remuxed if
+        forced (it was converted, or some of its streams are dropped).
         """
         cmd = []
-        if len(inputs) > 1:
+        if len(inputs) > 1 or force:
             # Build merge command and execute it
             cmd.append('ffmpeg')
 
@@ -65,49 +92,474 @@ class FileProcessor(object):
         # Return command as list
         return cmd
 
+    @staticmethod
+    def _build_output_args(processors, output):
+        """
+        Build the options of a single-pass output: maps, codec options and
+        language of each stream, and the output file.
+        """
+        args = []
+
+        # Map each stream in the same order they are processed
+        for processor in processors:
+            args.extend(['-map', '0:{}'.format(processor.index)])
+
+        # Add codec options and language for each of the output streams
+        for out_index, processor in enumerate(processors):
+            args.extend(processor.output_args(out_index))
+            if processor.language:
+                args.extend(['-metadata:s:{}'.format(out_index),
+                             'language={}'.format(processor.language)])
+
+        args.append(output)
+        return args
+
+    @classmethod
+    def _build_transcode_command(cls, in_file, processors, output, encoding=None):
+        """
+        Build single-pass command, which reads the input once and writes every
+        stream to the output file with its processor's options, as a list of
+        strings.
+        """
+        return cls._build_fan_out_command(in_file, [(processors, output)], encoding)
+
+    @classmethod
+    def _build_fan_out_command(cls, in_file, outputs, encoding=None):
+        """
+        Build fan-out command, which reads the input once and writes several
+        outputs (each with its own streams and options), as a list of strings.
+        ffmpeg decodes each input stream once for all the encoders it feeds,
+        and copied streams are not decoded at all.
+        """
+        cmd = ['ffmpeg']
+
+        # Set subtitles encoding (input option) if required
+        if encoding:
+            cmd.extend(['-sub_charenc', encoding])
+        cmd.extend(['-i', in_file])
+
+        # Add each of the outputs
+        for processors, output in outputs:
+            cmd.extend(cls._build_output_args(processors, output))
+        return cmd
+
     @staticmethod
     def clean_up(files):
         """
         Remove the given files.
         """
-        cmd = ['rm']
-        cmd.extend(files)
-        execute_cmd(cmd)
+        remove_files(files)
 
-    def __init__(self, in_file, output, profile):
+    def __init__(self, in_file, output, profile, single_pass=False,
+                 scratch_root=None, probe_cache=None, verdict_index=None,
+                 on_progress=None, stream_jobs=1, threads=None, nice=None,
+                 affinity=None, journal=None, stop=None, segment_jobs=1,
+                 segment_length=SEGMENT_LENGTH, variants=None, stream_cache=None,
+                 fast_probe=False, probe_size=FAST_PROBE_SIZE,
+                 analyze_duration=FAST_ANALYZE_DURATION):
         """
-        Set input, output, profile and error placeholder.
+        Set input, output, profile, engine mode, scratch root, caches,
+        progress callback, stream and segment concurrency, CPU limits, job
+        journal, stop event, variants, probe mode and error placeholder.
         """
-        # Set files and error placeholder
+        # Set files, mode, number of streams converted at once (multi-pass)
+        # and error placeholder
         self.input = in_file
         self.output = output
+        self.single_pass = single_pass
+        self.stream_jobs = stream_jobs
         self.error = None
+
+        # Set number of video segments encoded at once (multi-pass) and their
+        # minimum length (see VideoProcessor.convert_segments)
+        self.segment_jobs = segment_jobs
+        self.segment_length = segment_length
+
+        # Set stop event (optional, threading.Event), which kills running
+        # commands when set (eg, by a worker that lost its lease)
+        self.stop = stop
+
+        # Set root for scratch directory (system temp dir by default), the
+        # work directory itself is created when processing
+        self.scratch_root = scratch_root
+        self.work_dir = ''
+
+        # Set probe cache and verdict index (optional, cache instances)
+        self.probe_cache = probe_cache
+        self.verdict_index = verdict_index
+        self.converted = False
+
+        # Set probe mode (fast probes read less, see probe) and its limits,
+        # and counters of probes run, fast probes that were not enough and
+        # bytes they read
+        self.fast_probe = fast_probe
+        self.probe_size = probe_size
+        self.analyze_duration = analyze_duration
+        self.probe_stats = {'probes': 0, 'fallbacks': 0, 'bytes_read': 0}
+
+        # Set stream cache (optional, cache instance), where converted streams
+        # are kept to reuse them in later runs (multi-pass only)
+        self.stream_cache = stream_cache
+
+        # Set job journal (optional, cache instance) and placeholder for the
+        # job resumed from it
+        self.journal = journal
+        self.job = None
+
+        # Set progress callback, which receives progress snapshots of all
+        # ffmpeg commands (see ProgressTracker), and duration placeholder
+        self.on_progress = on_progress
+        self.duration = None
         self.logger = logging.getLogger()
 
-        # Set profile if found (or raise an error)
-        try:
-            self.profile = getattr(profiles, profile.upper())
-        except AttributeError:
-            raise ValueError('Profile {} could not be found'.format(profile))
+        # Set profile if found (or raise an error), and compile it once for
+        # all the stream processors
+        self.profile = profiles.get_profile(profile)
+        self.rules = profiles.compile_profile(self.profile)
+
+        # Set variants (optional, list of output and profile), extra outputs
+        # written from the same decode (see process_fan_out). They require an
+        # output, since their verdicts are recorded for the original input
+        self.variants = []
+        if variants and not output:
+            raise ValueError('Variants require an output, the original cannot be replaced')
+        for variant_output, variant_profile in variants or []:
+            if not variant_output:
+                raise ValueError('Variant with profile {} requires an output'.format(variant_profile))
+            self.variants.append((variant_output, profiles.get_profile(variant_profile)))
+
+        # Set video encoding threads (given, from profile or ffmpeg's default,
+        # "auto" is all CPUs available), and niceness and CPU affinity for
+        # conversion commands
+        threads = threads or (self.rules.video.threads if self.rules.video else None)
+        if threads == 'auto':
+            threads = cpu_budget(1, affinity)
+        self.threads = int(threads) if threads else None
+        self.affinity = affinity
+        self.cpu_limits = cpu_limiter(nice, affinity)
 
     def __str__(self):
         return 'File <{}>'.format(self.input)
 
-    def process(self):
+    @property
+    def destination(self):
+        """
+        Final file: the output, or the input if replacing the original.
+        """
+        return self.output or self.input
+
+    @property
+    def tmp_file(self):
+        """
+        Temporary merge (or transcode) output, which is created next to the
+        destination (hidden, and unique for the job) so it's on the same
+        filesystem and can be moved there atomically (see publish).
+        """
+        directory, name = os.path.split(self.destination)
+        ext = os.path.splitext(self.output)[1] if self.output else '.mkv'
+        return os.path.join(directory, '.{}.{}{}'.format(
+            name, os.path.basename(self.work_dir) or 'ffconv-tmp', ext))
+
+    def create_work_dir(self):
+        """
+        Create a unique scratch directory for this job, where intermediate
+        stream files and the temporary merge output are written, so
+        concurrent jobs never collide.
+        """
+        if self.scratch_root:
+            os.makedirs(self.scratch_root, exist_ok=True)
+        self.work_dir = tempfile.mkdtemp(prefix='ffconv-', dir=self.scratch_root)
+        self.logger.debug('{}: working in {}'.format(self, self.work_dir))
+
+    def create_output_dirs(self):
+        """
+        Create the directories of the outputs (eg, mirroring the inputs' ones
+        in batches), where their temporary outputs are written.
+        """
+        for output in [self.output] + [output for output, _ in self.variants]:
+            if output and os.path.dirname(output):
+                os.makedirs(os.path.dirname(output), exist_ok=True)
+
+    def start_job(self):
+        """
+        Start the job for this file: resume the one left by an interrupted
+        run if possible (reusing its work directory), or create a new work
+        directory and record the job in the journal (if any).
+        """
+        if self.journal is not None:
+            self.job = self.journal.resume(self.input, self.profile, self.output)
+
+        if self.job:
+            self.logger.debug('{}: resuming job ({})'.format(self, self.job['state']))
+            self.work_dir = self.job['work_dir']
+
+        else:
+            self.create_work_dir()
+            self.create_output_dirs()
+            if self.journal is not None:
+                self.journal.start(self.input, self.profile, self.output,
+                                   self.work_dir, self.tmp_file)
+
+    def update_job(self, state):
+        """
+        Record the new state of the job in the journal (if any).
+        """
+        if self.journal is not None:
+            self.journal.update(self.input, self.profile, state)
+
+    def finish_job(self):
+        """
+        Remove the job from the journal (if any), once done or failed.
+        """
+        if self.journal is not None:
+            self.journal.finish(self.input, self.profile)
+
+    def remove_work_dir(self):
+        """
+        Remove the scratch directory and anything left in it.
+        """
+        if self.logger.isEnabledFor(logging.DEBUG):
+            # Debug mode, keep it
+            self.logger.debug('{}: keeping {} (DEBUG)'.format(self, self.work_dir))
+        else:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+        self.work_dir = ''
+
+    def remove_tmp_files(self):
+        """
+        Remove the temporary outputs (this one and the variants'), which are
+        not in the scratch directory, when the job failed or was cancelled
+        and is not kept to be resumed.
+        """
+        if self.logger.isEnabledFor(logging.DEBUG):
+            # Debug mode, keep them
+            self.logger.debug('{}: keeping {} (DEBUG)'.format(self, self.tmp_file))
+        else:
+            self.clean_up([self.tmp_file] + [variant.tmp_file for variant in self.get_variants()])
+
+    def process(self, original_streams=None):
         """
         Main process method, which probes the input file to get the input
         streams information, then delegates the stream processing to stream
         processor objects and then merges all resulting stream files into
         a single output file.
+
+        In single-pass mode the conversion and merge are done by a single
+        command instead (see process_single_pass), and so are they with
+        variants (see process_fan_out).
+
+        All intermediate files are created in a scratch directory for this
+        job, which is removed at the end, except for the temporary output
+        which is created next to its destination (see tmp_file), and removed
+        too if the job fails.
+
+        If the verdict index says the file is already compliant or converted
+        nothing is done at all, otherwise the verdict is recorded once the
+        output is published (see _finish).
+
+        :param original_streams: streams data, if the file was already probed
+        :return: result data
+        """
+        verdict = self.get_verdict()
+        if verdict:
+            return self._skip(verdict)
+
+        self.start_job()
+        interrupted = False
+        try:
+            if self.job and self.job['state'] == JobJournal.MERGED:
+                res = self._resume_merged()
+            else:
+                res = self._process(original_streams)
+
+        except (KeyboardInterrupt, SystemExit):
+            # Interrupted, keep the work directory (and temporary output) so
+            # the job is resumed, if we have a journal
+            interrupted = self.journal is not None
+            if not interrupted:
+                self.remove_tmp_files()
+            raise
+
+        except BaseException:
+            # Failed (or cancelled): nothing to resume
+            self.finish_job()
+            self.remove_tmp_files()
+            raise
+
+        finally:
+            if not interrupted:
+                self.remove_work_dir()
+
+        self.finish_job()
+        return res
+
+    async def process_async(self, original_streams=None):
+        """
+        Asyncio version of process, which runs all commands as asyncio
+        subprocesses, and file, journal and index operations in threads (they
+        may be slow, eg on network filesystems), so a single event loop can
+        supervise many files at once.
+
+        If cancelled (eg, on a timeout) the running command is killed and the
+        work directory and the temporary output are removed.
+
+        :param original_streams: streams data, if the file was already probed
+        :return: result data
+        """
+        verdict = await asyncio.to_thread(self.get_verdict)
+        if verdict:
+            return self._skip(verdict)
+
+        await asyncio.to_thread(self.start_job)
+        interrupted = False
+        try:
+            if self.job and self.job['state'] == JobJournal.MERGED:
+                res = await asyncio.to_thread(self._resume_merged)
+            else:
+                res = await self._process_async(original_streams)
+
+        except (KeyboardInterrupt, SystemExit):
+            # Interrupted, keep the work directory (and temporary output) so
+            # the job is resumed, if we have a journal
+            interrupted = self.journal is not None
+            if not interrupted:
+                await asyncio.to_thread(self.remove_tmp_files)
+            raise
+
+        except BaseException:
+            # Failed (or cancelled): nothing to resume
+            await asyncio.to_thread(self.finish_job)
+            await asyncio.to_thread(self.remove_tmp_files)
+            raise
+
+        finally:
+            if not interrupted:
+                await asyncio.to_thread(self.remove_work_dir)
+
+        await asyncio.to_thread(self.finish_job)
+        return res
+
+    def _skip(self, verdict):
+        """
+        Skip processing because of a recorded verdict.
+
+        :param verdict: dict with verdict and output
+        :return: result data
+        """
+        self.logger.debug('{}: skipping, already {}'.format(self, verdict['verdict']))
+        return {'streams': 0, 'output': verdict['output'],
+                'verdict': verdict['verdict']}
+
+    def get_verdict(self):
+        """
+        Get the recorded verdict for this file and profile, if any.
+
+        :return: dict with verdict and output (None if not found, or not
+            found for any of the variants)
+        """
+        if self.verdict_index is not None and all(v.get_verdict() for v in self.get_variants()):
+            return self.verdict_index.get(self.input, self.profile, self.output)
+
+    def set_verdict(self, converted):
+        """
+        Record the verdict for this file and profile, after publishing its
+        output.
+
+        :param converted: whether any stream was converted (or dropped)
+        """
+        if self.verdict_index is None:
+            return
+
+        if self.logger.isEnabledFor(logging.DEBUG):
+            # Debug mode, original might not have been replaced
+            self.logger.debug('{}: skipping verdict (DEBUG)'.format(self))
+
+        else:
+            verdict = self.verdict_index.CONVERTED if converted \
+                else self.verdict_index.COMPLIANT
+            output = self.output if self.output != self.input else None
+            self.verdict_index.set(self.input, self.profile, verdict, output)
+
+    def _resume_merged(self):
+        """
+        Resume a job interrupted after merging, which only needs its
+        temporary output published.
+        """
+        self.logger.debug('{}: publishing {}'.format(self, self.tmp_file))
+        self.converted = True
+        self._finish([], True)
+        return {'streams': len(self.job['streams']), 'output': self.output}
+
+    def _process(self, original_streams):
+        """
+        Actual process, run once the work directory is created.
         """
-        # First step, probe for file streams
-        self.logger.debug('{}: probing'.format(self))
-        original_streams = self.probe()
+        # First step, probe for file streams (unless we already did)
+        if original_streams is None:
+            self.logger.debug('{}: probing'.format(self))
+            original_streams = self.probe()
+
+        self.duration = file_duration(original_streams)
+        self.update_job(JobJournal.PROBED)
+
+        # Delegate to fan-out engine if there are variants, or single-pass
+        # engine if requested
+        if self.variants:
+            return self.process_fan_out(original_streams)
+        if self.single_pass:
+            return self.process_single_pass(original_streams)
 
         # Process streams
         self.logger.debug('{}: processing {} streams'.format(self, len(original_streams)))
         processed_streams = self.process_streams(original_streams)
 
+        # Converted if any stream is not the original one (or some are dropped)
+        dropping = bool(self.dropped_streams(original_streams))
+        converted = dropping or self._converted(processed_streams)
+        self._check_streams(processed_streams, dropping)
+
+        # By now we could have an error
+        if self.error:
+            # Update inputs in case we want to clean up
+            inputs = {s['input'] for s in processed_streams}\
+                .difference([self.input])
+        else:
+            # No errors, merge the files
+            self.update_job(JobJournal.CONVERTED)
+            self.logger.debug('{}: merging streams'.format(self))
+            inputs = self.merge(processed_streams, dropping)
+
+        self._finish(inputs, converted)
+        return {'streams': len(processed_streams), 'output': self.output}
+
+    async def _process_async(self, original_streams):
+        """
+        Asyncio version of _process.
+        """
+        # First step, probe for file streams (unless we already did)
+        if original_streams is None:
+            self.logger.debug('{}: probing'.format(self))
+            original_streams = await self.probe_async()
+
+        self.duration = file_duration(original_streams)
+        await asyncio.to_thread(self.update_job, JobJournal.PROBED)
+
+        # Delegate to fan-out engine if there are variants, or single-pass
+        # engine if requested
+        if self.variants:
+            return await self.process_fan_out_async(original_streams)
+        if self.single_pass:
+            return await self.process_single_pass_async(original_streams)
+
+        # Process streams
+        self.logger.debug('{}: processing {} streams'.format(self, len(original_streams)))
+        processed_streams = await self.process_streams_async(original_streams)
+
+        # Converted if any stream is not the original one (or some are dropped)
+        dropping = bool(self.dropped_streams(original_streams))
+        converted = dropping or self._converted(processed_streams)
+        self._check_streams(processed_streams, dropping)
+
         # By now we could have an error
         if self.error:
             # Update inputs in case we want to clean up
@@ -115,62 +567,539 @@ class FileProcessor(object):
                 .difference([self.input])
         else:
             # No errors, merge the files
+            await asyncio.to_thread(self.update_job, JobJournal.CONVERTED)
             self.logger.debug('{}: merging streams'.format(self))
-            inputs = self.merge(processed_streams)
+            inputs = await self.merge_async(processed_streams, dropping)
+
+        await asyncio.to_thread(self._finish, inputs, converted)
+        return {'streams': len(processed_streams), 'output': self.output}
+
+    def _finish(self, inputs, converted):
+        """
+        Publish the output (or link it, if nothing was converted) and record
+        its verdict, and clean up the merged inputs, then raise the error if
+        we had one.
+
+        :param inputs: files used in merge (or transcode)
+        :param converted: whether any stream was converted (or dropped), so
+            there is a temporary output to publish
+        """
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        if self.error:
+            # Failed, nothing to publish
+            pass
+
+        elif not converted:
+            # Nothing converted, the output is the input as it is
+            self.link_output()
+            self.set_verdict(False)
+
+        elif self.output or not debug:
+            # Converted, move temporary output to destination
+            self.update_job(JobJournal.MERGED)
+            self.publish()
+            self.set_verdict(True)
+
+        else:
+            # Debug mode, keep the original
+            self.logger.debug('{}: keeping {} (DEBUG)'.format(self, self.tmp_file))
 
         # Clean up if we have inputs
-        # Note: input can be empty if no streams were converted, in which
-        # case the original file is our output, so we do nothing
+        # Note: input can be empty if no streams were converted
         if inputs:
-            if self.logger.isEnabledFor(logging.DEBUG):
+            if debug:
                 # Debug mode, skip cleanup
                 self.logger.debug('{}: skipping clean up (DEBUG)'.format(self))
 
             else:
                 # Clean up and remove temps
                 self.logger.debug('{}: cleaning up'.format(self))
-                if not (self.output or self.error):
-                    self.replace_original()
                 self.clean_up(inputs)
 
         # If we had an error, raise it
         if isinstance(self.error, Exception):
             raise self.error
 
-        # No errors, return result
-        return {'streams': len(processed_streams), 'output': self.output}
-
     def probe(self):
         """
-        Probe the input file to get the streams data.
+        Probe the input file to get the streams data, unless we have it in
+        the probe cache.
+
+        Fast probes read only the headers (up to probe_size bytes and
+        analyze_duration seconds of media) and show only the fields used by
+        the processors. If any of the required ones is missing (eg, refs of
+        a video stream), the file is probed again fully.
 
         :return: list of streams data (dicts)
         """
-        cmd = ['ffprobe', '-v', 'quiet', '-show_streams',
-               '-of', 'json', self.input]
-        output = execute_cmd(cmd)
-        return json.loads(output)['streams']
+        streams = self._get_cached_probe()
+        if streams is None:
+            streams = self._parse_probe(self._execute_probe(self.fast_probe))
+            if self.fast_probe and not self._probe_complete(streams):
+                self.probe_stats['fallbacks'] += 1
+                streams = self._parse_probe(self._execute_probe(False))
+            self._cache_probe(streams)
+        return streams
+
+    async def probe_async(self):
+        """
+        Asyncio version of probe. The probe cache is used in a thread, since
+        it stats the file (slow on network filesystems).
+        """
+        streams = await asyncio.to_thread(self._get_cached_probe)
+        if streams is None:
+            streams = self._parse_probe(await self._execute_probe_async(self.fast_probe))
+            if self.fast_probe and not self._probe_complete(streams):
+                self.probe_stats['fallbacks'] += 1
+                streams = self._parse_probe(await self._execute_probe_async(False))
+            await asyncio.to_thread(self._cache_probe, streams)
+        return streams
+
+    def _execute_probe(self, fast):
+        """
+        Run a probe (fast or full), counting it and the bytes it read.
+        """
+        io_stats = {}
+        output = execute_cmd(self._build_probe_command(fast), io_stats=io_stats)
+        self._count_probe(fast, io_stats)
+        return output
+
+    async def _execute_probe_async(self, fast):
+        """
+        Asyncio version of _execute_probe.
+        """
+        io_stats = {}
+        output = await execute_cmd_async(self._build_probe_command(fast), io_stats=io_stats)
+        self._count_probe(fast, io_stats)
+        return output
+
+    def _count_probe(self, fast, io_stats):
+        """
+        Update the probe counters with a probe and its I/O counters (if
+        available, see utils.process_io).
+        """
+        self.probe_stats['probes'] += 1
+        self.probe_stats['bytes_read'] += io_stats.get('rchar', 0)
+        self.logger.debug('{}: {} probe read {} bytes'.format(
+            self, 'fast' if fast else 'full', io_stats.get('rchar', '?')))
+
+    def _get_cached_probe(self):
+        """
+        Get the streams data from the probe cache, if we have it.
+        """
+        if self.probe_cache is not None:
+            streams = self.probe_cache.get(self.input)
+            if streams is not None:
+                self.logger.debug('{}: probe found in cache'.format(self))
+                return streams
+
+    def _cache_probe(self, streams):
+        """
+        Store the streams data in the probe cache, if we have it.
+        """
+        if self.probe_cache is not None:
+            self.probe_cache.set(self.input, streams)
+
+    def _build_probe_command(self, fast=False):
+        """
+        Build the probe command (full, or fast) as a list of strings.
+        """
+        if not fast:
+            return ['ffprobe', '-v', 'quiet', '-show_streams',
+                    '-of', 'json', self.input]
+
+        return ['ffprobe', '-v', 'quiet',
+                '-probesize', str(int(self.probe_size)),
+                '-analyzeduration', str(int(self.analyze_duration * 1000000)),
+                '-show_entries', 'stream={}:stream_tags'.format(','.join(PROBE_ENTRIES)),
+                '-of', 'json', self.input]
+
+    @staticmethod
+    def _probe_complete(streams):
+        """
+        Check whether a (fast) probe found everything the processors require
+        for each of the streams.
+        """
+        for stream in streams:
+            required = REQUIRED_ENTRIES.get(stream.get('codec_type'), ())
+            if not all(stream.get(entry) for entry in required):
+                return False
+        return True
+
+    def _parse_probe(self, output):
+        """
+        Parse the probe output into streams data.
+
+        :param output: probe output (json)
+        :return: list of streams data (dicts)
+        """
+        streams = json.loads(output)['streams']
+
+        # Tag names depend on the container (eg, LANGUAGE), normalize them
+        for stream in streams:
+            if 'tags' in stream:
+                stream['tags'] = {k.lower(): v for k, v in stream['tags'].items()}
+        return streams
+
+    def execute(self, cmd):
+        """
+        Execute a command for this file, tracking its progress if we have
+        a callback.
+
+        :param cmd: command as list of strings
+        :return: output of command
+        """
+        cmd, kwargs = track(cmd, str(self), self.duration, self.on_progress)
+        cmd = self.cpu_limits + cmd
+        if self.stop is not None:
+            kwargs['stop'] = self.stop
+        return execute_cmd(cmd, **kwargs)
+
+    async def execute_async(self, cmd):
+        """
+        Asyncio version of execute.
+        """
+        cmd, kwargs = track(cmd, str(self), self.duration, self.on_progress)
+        cmd = self.cpu_limits + cmd
+        return await execute_cmd_async(cmd, **kwargs)
+
+    def process_single_pass(self, original_streams):
+        """
+        Single-pass process, which builds processors for all the streams and
+        converts them in a single command that reads the input once and writes
+        the output directly, without intermediate stream files.
+
+        :param original_streams: list of streams data as probed
+        :return: result data
+        """
+        # Build processors for all streams (this is where decisions are made)
+        processors = self.get_processors(original_streams)
+
+        # Transcode only if at least one stream must be converted (or dropped)
+        converted = self._must_transcode(processors, original_streams)
+        self._check_streams(processors, converted)
+        if converted and not self.error:
+            self.logger.debug('{}: transcoding {} streams in a single pass'.format(self, len(processors)))
+            self.transcode(processors)
+
+        # Publish or remove partial output, then raise error if we had one
+        self._finish([self.tmp_file] if self.error else [], converted)
+
+        # No errors, return result
+        return {'streams': len(processors), 'output': self.output}
+
+    async def process_single_pass_async(self, original_streams):
+        """
+        Asyncio version of process_single_pass.
+        """
+        # Build processors for all streams (this is where decisions are made)
+        processors = self.get_processors(original_streams)
+
+        # Transcode only if at least one stream must be converted (or dropped)
+        converted = self._must_transcode(processors, original_streams)
+        self._check_streams(processors, converted)
+        if converted and not self.error:
+            self.logger.debug('{}: transcoding {} streams in a single pass'.format(self, len(processors)))
+            await self.transcode_async(processors)
+
+        # Publish or remove partial output, then raise error if we had one
+        await asyncio.to_thread(self._finish, [self.tmp_file] if self.error else [], converted)
+
+        # No errors, return result
+        return {'streams': len(processors), 'output': self.output}
+
+    def process_fan_out(self, original_streams):
+        """
+        Fan-out process, which builds processors for all the streams for this
+        profile and each of the variants, and converts them in a single
+        command that reads (and decodes) the input once and writes all the
+        outputs, copying the streams that are already fine. Outputs that
+        need no conversion at all are linked to the input instead.
+
+        Variants are published before this output, so if the job is
+        interrupted once merged (see _resume_merged), only this one is left.
+
+        :param original_streams: list of streams data as probed
+        :return: result data
+        """
+        # Build processors for all streams, for each of the outputs
+        targets = self._prepare_fan_out(original_streams)
+
+        # Transcode those with at least one stream to convert (or drop)
+        converting = self._converting_targets(targets, original_streams)
+        if converting and not self.error:
+            self.logger.debug('{}: transcoding {} outputs in a single pass'.format(self, len(converting)))
+            self.fan_out(converting)
+
+        # Publish or remove partial outputs, then raise error if we had one
+        return self._finish_fan_out(targets, converting)
+
+    async def process_fan_out_async(self, original_streams):
+        """
+        Asyncio version of process_fan_out.
+        """
+        # Build processors for all streams, for each of the outputs
+        targets = self._prepare_fan_out(original_streams)
+
+        # Transcode those with at least one stream to convert (or drop)
+        converting = self._converting_targets(targets, original_streams)
+        if converting and not self.error:
+            self.logger.debug('{}: transcoding {} outputs in a single pass'.format(self, len(converting)))
+            await self.fan_out_async(converting)
+
+        # Publish or remove partial outputs, then raise error if we had one
+        return await asyncio.to_thread(self._finish_fan_out, targets, converting)
+
+    def get_variants(self):
+        """
+        Build file processors for the variants, which share the input,
+        options and work directory of this one, but not its job (the journal
+        only records this one, see process_fan_out).
+
+        :return: list of FileProcessor instances
+        """
+        variants = []
+        for output, profile in self.variants:
+            variant = copy.copy(self)
+            variant.output = output
+            variant.profile = profile
+            variant.rules = profiles.compile_profile(profile)
+            variant.variants = []
+            variant.journal = None
+            variant.converted = False
+            variant.error = None
+            variants.append(variant)
+        return variants
+
+    def _prepare_fan_out(self, original_streams):
+        """
+        Build the processors of each of the outputs (this one first, then the
+        variants), setting the error if any of them cannot be built.
+
+        :param original_streams: list of streams data as probed
+        :return: list of tuples with file processor and stream processors
+        """
+        targets = [(self, self.get_processors(original_streams))]
+        for variant in self.get_variants():
+            targets.append((variant, variant.get_processors(original_streams)))
+            self.error = self.error or variant.error
+        return targets
+
+    def _converting_targets(self, targets, original_streams):
+        """
+        Get the targets with at least one stream to convert (or drop), setting
+        the error if any of them has no streams to write.
+
+        :param targets: list of tuples with file processor and stream processors
+        :param original_streams: list of streams data as probed
+        :return: list of tuples with file processor and stream processors
+        """
+        converting = []
+        for target, processors in targets:
+            if target._must_transcode(processors, original_streams):
+                target._check_streams(processors, True)
+                self.error = self.error or target.error
+                converting.append((target, processors))
+        return converting
+
+    def _finish_fan_out(self, targets, converting):
+        """
+        Publish the outputs (or link them, if nothing was converted) and
+        record their verdicts, or remove the partial outputs and raise the
+        error if we had one.
+
+        :param targets: list of tuples with file processor and stream processors
+        :param converting: the targets with streams to convert (or drop)
+        :return: result data
+        """
+        if self.error:
+            # Failed, remove all partial outputs (raises the error)
+            self._finish([target.tmp_file for target, _ in targets], False)
+
+        converted = [target for target, _ in converting]
+        for variant, _ in targets[1:]:
+            variant._finish([], variant in converted)
+        self._finish([], self in converted)
+
+        return {'streams': len(targets[0][1]), 'output': self.output,
+                'variants': [variant.output for variant, _ in targets[1:]]}
+
+    def fan_out(self, targets):
+        """
+        Convert the streams of several outputs with a single command (see
+        _build_fan_out_command), which writes each of them to its temporary
+        output. Just like transcode, subtitle encodings are tried in order
+        until one works (or the failure is not a charset error).
+
+        :param targets: list of tuples with file processor and stream processors
+        """
+        outputs = [(processors, target.tmp_file) for target, processors in targets]
+        encodings = self._transcode_encodings(sum((p for p, _ in outputs), []))
+        for encoding in encodings:
+            try:
+                # Try to transcode with current encoding
+                cmd = self._build_fan_out_command(self.input, outputs, encoding)
+                self.execute(cmd)
+
+            except Exception as e:
+                # Failed: erase output files, and try next encoding if
+                # it was the one to blame
+                self.logger.debug('{}: {}'.format(self, e))
+                self.error = e
+                self.clean_up([output for _, output in outputs])
+                if not self._charset_failed(e, encoding):
+                    return
+
+            else:
+                # Worked
+                self.error = None
+                for target, _ in targets:
+                    target.converted = True
+                return
+
+    async def fan_out_async(self, targets):
+        """
+        Asyncio version of fan_out.
+        """
+        outputs = [(processors, target.tmp_file) for target, processors in targets]
+        encodings = self._transcode_encodings(sum((p for p, _ in outputs), []))
+        for encoding in encodings:
+            try:
+                # Try to transcode with current encoding
+                cmd = self._build_fan_out_command(self.input, outputs, encoding)
+                await self.execute_async(cmd)
+
+            except Exception as e:
+                # Failed: erase output files, and try next encoding if
+                # it was the one to blame
+                self.logger.debug('{}: {}'.format(self, e))
+                self.error = e
+                await asyncio.to_thread(self.clean_up, [output for _, output in outputs])
+                if not self._charset_failed(e, encoding):
+                    return
+
+            else:
+                # Worked
+                self.error = None
+                for target, _ in targets:
+                    target.converted = True
+                return
+
+    def _must_transcode(self, processors, original_streams):
+        """
+        Check whether a single-pass output must be written: if any stream
+        must be converted, or dropped (see dropped_streams).
+        """
+        return any(processor.must_convert for processor in processors) or \
+            bool(self.dropped_streams(original_streams))
+
+    def _check_streams(self, streams, converted):
+        """
+        Set the error if the output must be written but has no streams (eg,
+        an audio-only profile for a file without audio): without maps, ffmpeg
+        would pick the streams by itself.
+
+        :param streams: stream processors (or processed streams data)
+        :param converted: whether the output must be written
+        """
+        if converted and not streams and not self.error:
+            self.error = ValueError('{}: no streams to write to {}'.format(self, self.destination))
+
+    def dropped_streams(self, original_streams):
+        """
+        Get the streams dropped because the profile has no rules for their
+        media type (eg, video for an audio-only profile).
+
+        :param original_streams: list of streams data as probed
+        :return: list of streams data
+        """
+        dropped = []
+        for stream in original_streams:
+            processor_cls = StreamProcessor.for_stream(stream)
+            if processor_cls and self.rules.rules(processor_cls.media_type) is None:
+                dropped.append(stream)
+        return dropped
+
+    def get_processors(self, original_streams):
+        """
+        Build stream processors for the given streams, skipping those with
+        unknown media types.
+
+        If a processor cannot be built the error is set and no processors are
+        returned.
+
+        :param original_streams: list of streams data as probed
+        :return: list of StreamProcessor instances
+        """
+        try:
+            processors = self._get_processors(original_streams)
+
+        except Exception as e:
+            # Some stream is not valid, we cannot process this file
+            self.logger.debug('{}: {}'.format(self, e))
+            self.error = e
+            processors = []
+
+        return processors
+
+    def _get_processors(self, original_streams):
+        """
+        Build stream processors for the given streams (see _get_processor),
+        each followed by its companions (eg, downmixed audio tracks).
+        """
+        processors = []
+        for processor in map(self._get_processor, original_streams):
+            if processor:
+                processors.append(processor)
+                processors.extend(processor.companions())
+        return processors
+
+    def _get_processor(self, stream):
+        """
+        Build the processor for the given stream.
+
+        :param stream: stream data as probed
+        :return: StreamProcessor instance (None if media type is not known, or
+            dropped by the profile)
+        """
+        # Find the processor registered for the media type (unless the profile
+        # drops its streams)
+        processor_cls = StreamProcessor.for_stream(stream)
+        if processor_cls and self.rules.rules(processor_cls.media_type) is not None:
+            processor = processor_cls(self.input, stream, self.rules,
+                                      work_dir=self.work_dir,
+                                      on_progress=self.on_progress)
+
+            # Apply CPU limits (threads only for video, the others are cheap)
+            processor.cpu_limits = self.cpu_limits
+            processor.stop = self.stop
+            if processor.media_type == 'video':
+                processor.threads = self.threads
+                processor.segment_jobs = self.segment_jobs
+                processor.segment_length = self.segment_length
+            return processor
 
     def process_streams(self, original_streams):
         """
         Process each of the streams in the input file.
         The processing is delegated to StreamProcessor subclasses.
 
+        If stream_jobs is more than 1, conversions run concurrently (see
+        _process_streams_parallel).
+
         :param original_streams: list of streams data as probed
         :return: list of processed streams data
         """
         processed_streams = []
         try:
-            for stream in original_streams:
-                # Find all processors that match media type
-                proc_types = [pt for pt in StreamProcessor.__subclasses__()
-                              if pt.media_type == stream['codec_type']]
-
-                if proc_types:
-                    # For now just select the first one that matched media type
-                    processor_cls = proc_types[0]
-                    processor = processor_cls(self.input, stream, self.profile)
-                    result = processor.process()
+            processors = self._get_processors(original_streams)
+            self._batch_audio(processors)
+            if self.stream_jobs > 1:
+                self._process_streams_parallel(processors, processed_streams)
+
+            else:
+                for processor in processors:
+                    result = self._process_stream(processor)
                     processed_streams.append(result)
 
         except Exception as e:
@@ -180,32 +1109,245 @@ class FileProcessor(object):
 
         return processed_streams
 
-    def merge(self, streams):
+    async def process_streams_async(self, original_streams):
         """
-        Merge all processed streams into output file.
+        Asyncio version of process_streams.
+        """
+        processed_streams = []
+        try:
+            processors = self._get_processors(original_streams)
+            await asyncio.to_thread(self._batch_audio, processors)
+            if self.stream_jobs > 1:
+                await self._process_streams_parallel_async(processors, processed_streams)
 
-        :param streams: processed streams data
-        :return: list of input files
+            else:
+                for processor in processors:
+                    result = await self._process_stream_async(processor)
+                    processed_streams.append(result)
+
+        except Exception as e:
+            # This means some stream could not be processed, clean up and stop
+            self.logger.debug('{}: {}'.format(self, e))
+            self.error = e
+
+        return processed_streams
+
+    def _batch_audio(self, processors):
+        """
+        Join the audio tracks to convert (unless converted already or cached,
+        see _process_stream) in a batch, so they're converted by a single
+        command that reads the input once (see AudioBatch).
+
+        :param processors: stream processors
+        """
+        audio = [p for p in processors if p.media_type == 'audio' and p.must_convert
+                 and self._reused_stream(p) is None and not self._is_cached(p)]
+        if len(audio) > 1:
+            self.logger.debug('{}: converting {} audio streams at once'.format(self, len(audio)))
+            AudioBatch(audio)
+
+    def _is_cached(self, processor):
+        """
+        Check whether a stream is in the stream cache (if any).
+        """
+        cache_key = self._stream_cache_key(processor)
+        return cache_key is not None and cache_key in self.stream_cache
+
+    def _reused_stream(self, processor):
+        """
+        Get the processed stream data for a stream converted by an
+        interrupted run of the job (see start_job), if its output is there.
+        """
+        done = self.job['streams'].get(processor.key) if self.job else None
+        if done and os.path.exists(done['input']):
+            self.logger.debug('{}: reusing {}'.format(processor, done['input']))
+            return done
+
+    def _stream_cache_key(self, processor):
+        """
+        Get the key of a stream to convert in the stream cache (None if
+        there's no cache, or nothing to convert). It must be built before
+        converting, which changes the processor's input.
+        """
+        if self.stream_cache is not None and processor.must_convert:
+            return self.stream_cache.key(self.input, processor.key, processor.params())
+
+    def _cached_stream(self, cache_key):
+        """
+        Get the processed stream data for a stream converted by a previous
+        run with the same parameters, from the stream cache, linking its file
+        into the work directory.
+        """
+        if cache_key is not None:
+            result = self.stream_cache.get(cache_key, self.work_dir)
+            if result is not None:
+                self.logger.debug('{}: reusing cached {}'.format(self, result['input']))
+            return result
+
+    def _cache_stream(self, cache_key, result):
+        """
+        Store a converted stream in the stream cache (if any). Errors are
+        only logged, the cache is not required for the conversion.
+        """
+        if cache_key is not None:
+            try:
+                self.stream_cache.set(cache_key, self.input, result)
+            except OSError as e:
+                self.logger.debug('{}: could not cache {}: {}'.format(self, result['input'], e))
+
+    def _record_stream(self, processor, result):
+        """
+        Record a converted stream (by its key, see StreamProcessor.key) in the
+        journal (if any).
+        """
+        if self.journal is not None and processor.must_convert:
+            self.journal.add_stream(self.input, self.profile, processor.key, result)
+
+    def _process_stream(self, processor):
+        """
+        Process a single stream, unless it was converted already (see
+        _reused_stream) or before (see _cached_stream), recording it in the
+        journal and the stream cache.
+
+        :param processor: stream processor
+        :return: processed stream data
+        """
+        result = self._reused_stream(processor)
+        if result is None:
+            cache_key = self._stream_cache_key(processor)
+            result = self._cached_stream(cache_key)
+            if result is None:
+                result = processor.process()
+                self._cache_stream(cache_key, result)
+            self._record_stream(processor, result)
+        return result
+
+    async def _process_stream_async(self, processor):
+        """
+        Asyncio version of _process_stream. The journal and stream cache are
+        used in threads, since they stat files (and the cache copies them when
+        it's on another filesystem).
+        """
+        result = await asyncio.to_thread(self._reused_stream, processor) if self.job else None
+        if result is None:
+            cache_key = await asyncio.to_thread(self._stream_cache_key, processor)
+            result = await asyncio.to_thread(self._cached_stream, cache_key)
+            if result is None:
+                result = await processor.process_async()
+                await asyncio.to_thread(self._cache_stream, cache_key, result)
+            if self.journal is not None:
+                await asyncio.to_thread(self._record_stream, processor, result)
+        return result
+
+    def _set_threads(self, processors):
+        """
+        Split the CPUs (all available, or the threads set for the file)
+        between the conversions that run concurrently: cheap ones (audio,
+        subtitles) get a thread each and the video encode gets the rest.
+
+        :param processors: stream processors
+        """
+        converting = [p for p in processors if p.must_convert]
+        cheap = [p for p in converting if p.media_type != 'video']
+        for processor in cheap:
+            processor.threads = 1
+
+        budget = self.threads or cpu_budget(1, self.affinity)
+        overlapping = min(len(cheap), self.stream_jobs - 1)
+        for processor in converting:
+            if processor.media_type == 'video':
+                processor.threads = max(1, budget - overlapping)
+
+    def _process_streams_parallel(self, processors, processed_streams):
+        """
+        Process streams concurrently in threads (conversions are done by
+        ffmpeg, so threads only wait), at most stream_jobs at once.
+
+        If any of them fails, the ones not started are cancelled and the ones
+        running are killed, then the first error is raised. Results of those
+        that finished are added anyway (in order), so they're cleaned up.
+        Stopping the file (see stop) stops them too, but their own stop event
+        is a child of it, so failures do not stop anything else.
+
+        :param processors: stream processors
+        :param processed_streams: list for processed streams data
+        """
+        self._set_threads(processors)
+        stop = ChildEvent(self.stop)
+        for processor in processors:
+            processor.stop = stop
+
+        with ThreadPoolExecutor(max_workers=self.stream_jobs) as executor:
+            futures = [executor.submit(self._process_stream, p) for p in processors]
+            done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+
+            # Find first error, stop everything else
+            errors = [f.exception() for f in futures if f in done and f.exception()]
+            if errors:
+                stop.set()
+                for future in futures:
+                    future.cancel()
+
+        processed_streams.extend(f.result() for f in futures
+                                 if not f.cancelled() and not f.exception())
+        if errors:
+            raise errors[0]
+
+    async def _process_streams_parallel_async(self, processors, processed_streams):
+        """
+        Asyncio version of _process_streams_parallel, where stopping means
+        cancelling the tasks (which kills their commands).
+        """
+        self._set_threads(processors)
+        semaphore = asyncio.Semaphore(self.stream_jobs)
+
+        async def process(processor):
+            async with semaphore:
+                return await self._process_stream_async(processor)
+
+        tasks = [asyncio.ensure_future(process(p)) for p in processors]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            # Errors or cancelled, stop everything else
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        processed_streams.extend(t.result() for t in tasks
+                                 if not t.cancelled() and not t.exception())
+        errors = [t.exception() for t in tasks if t in done and t.exception()]
+        if errors:
+            raise errors[0]
+
+    def _prepare_merge(self, streams, dropping=False):
+        """
+        Build the list of inputs and the merge command (empty if there's
+        nothing to merge) for the processed streams.
         """
         inputs = []
         maps = []
         meta = []
 
         # Construct lists with parameters and build command
+        # Note: a single input must be remuxed if it's not the original one
+        # (eg, the only stream was converted)
         self._build_merge_params(streams, inputs, maps, meta)
-        cmd = self._build_merge_command(inputs, maps, meta,
-                                        self.output or self.tmp_file)
-        if cmd:
-            # We have a command -> we have something to merge
-            try:
-                execute_cmd(cmd)
+        force = dropping or self._converted(streams)
+        cmd = self._build_merge_command(inputs, maps, meta, self.tmp_file, force)
+        return inputs, cmd
 
-            except Exception as e:
-                # Oops, merge failed, log an set error
-                self.logger.debug('{}: {}'.format(self, e))
-                self.error = e
-                inputs.append(cmd[-1])
+    def _converted(self, streams):
+        """
+        Check whether any of the processed streams was converted (its input
+        is not the original file).
+        """
+        return any(stream['input'] != self.input for stream in streams)
 
+    def _merged_inputs(self, inputs):
+        """
+        Get the inputs to clean up after merge.
+        """
         # Remove main input from list of inputs, because we either keep it
         # or we replace it, in which case we'll "mv <tmp> <input>" anyway
         # Note: if we transcode it might not be in inputs list
@@ -216,12 +1358,154 @@ class FileProcessor(object):
         # (empty if there was no merge)
         return inputs
 
-    def replace_original(self):
+    def merge(self, streams, dropping=False):
+        """
+        Merge all processed streams into output file.
+
+        :param streams: processed streams data
+        :param dropping: whether the profile drops some streams, in which
+            case the output is written even if nothing was converted
+        :return: list of input files
+        """
+        inputs, cmd = self._prepare_merge(streams, dropping)
+        if cmd:
+            # We have a command -> we have something to merge
+            try:
+                self.execute(cmd)
+                self.converted = True
+
+            except Exception as e:
+                # Oops, merge failed, log an set error
+                self.logger.debug('{}: {}'.format(self, e))
+                self.error = e
+                inputs.append(cmd[-1])
+
+        return self._merged_inputs(inputs)
+
+    async def merge_async(self, streams, dropping=False):
+        """
+        Asyncio version of merge.
+        """
+        inputs, cmd = self._prepare_merge(streams, dropping)
+        if cmd:
+            # We have a command -> we have something to merge
+            try:
+                await self.execute_async(cmd)
+                self.converted = True
+
+            except Exception as e:
+                # Oops, merge failed, log an set error
+                self.logger.debug('{}: {}'.format(self, e))
+                self.error = e
+                inputs.append(cmd[-1])
+
+        return self._merged_inputs(inputs)
+
+    def _transcode_encodings(self, processors):
+        """
+        Get the encodings to try when transcoding.
+        """
+        # Only need to set encoding if we're converting subtitles (with
+        # variants, the encodings of all their profiles, in order)
+        encodings = []
+        for processor in processors:
+            if processor.media_type == 'subtitle' and processor.must_convert:
+                encodings.extend(e for e in processor.rules.encodings if e not in encodings)
+        return encodings or [None]
+
+    @staticmethod
+    def _charset_failed(error, encoding):
+        """
+        Check whether a transcode failed because of the subtitles encoding,
+        so the next one might work: only if it was set, and the log tail of
+        the command (either a CalledProcessError or, usually, a LogError for
+        the decoding error that follows) says so. Anything else (eg, an
+        encoder error, or a full disk) would just fail again after encoding
+        the whole file.
+        """
+        stderr = getattr(error, 'stderr', None) or b''
+        return encoding is not None and any(message in stderr for message in CHARSET_ERRORS)
+
+    def transcode(self, processors):
         """
-        Replace the original input with the temporary file.
+        Convert and merge all streams with a single command, writing directly
+        to the output file (or the temporary file if replacing the original).
+
+        Note: the subtitles encoding applies to the whole input, so just like
+        SubtitleProcessor.convert we try with each of the profile's encodings
+        until one works (as long as the failures are charset errors, see
+        _charset_failed). Subtitles are not cleaned up in this mode.
+
+        :param processors: stream processors, in output order
+        """
+        output = self.tmp_file
+        for encoding in self._transcode_encodings(processors):
+            try:
+                # Try to transcode with current encoding
+                cmd = self._build_transcode_command(self.input, processors,
+                                                    output, encoding)
+                self.execute(cmd)
+
+            except Exception as e:
+                # Failed: erase output file, and try next encoding if
+                # it was the one to blame
+                self.logger.debug('{}: {}'.format(self, e))
+                self.error = e
+                self.clean_up([output])
+                if not self._charset_failed(e, encoding):
+                    return
 
-        :return:
+            else:
+                # Worked
+                self.error = None
+                self.converted = True
+                return
+
+    async def transcode_async(self, processors):
+        """
+        Asyncio version of transcode.
         """
-        cmd = ['mv', self.tmp_file, self.input]
-        execute_cmd(cmd)
-        self.output = self.input
+        output = self.tmp_file
+        for encoding in self._transcode_encodings(processors):
+            try:
+                # Try to transcode with current encoding
+                cmd = self._build_transcode_command(self.input, processors,
+                                                    output, encoding)
+                await self.execute_async(cmd)
+
+            except Exception as e:
+                # Failed: erase output file, and try next encoding if
+                # it was the one to blame
+                self.logger.debug('{}: {}'.format(self, e))
+                self.error = e
+                await asyncio.to_thread(self.clean_up, [output])
+                if not self._charset_failed(e, encoding):
+                    return
+
+            else:
+                # Worked
+                self.error = None
+                self.converted = True
+                return
+
+    def publish(self):
+        """
+        Move the temporary output to its destination (the output file, or the
+        original one), atomically because they're on the same filesystem.
+        """
+        os.replace(self.tmp_file, self.destination)
+        self.output = self.destination
+
+    def link_output(self):
+        """
+        Make the output file (if any) the same as the input, when nothing was
+        converted: hard link it, or copy it if that's not possible (eg, on
+        another filesystem).
+        """
+        if not self.output:
+            # Replacing the original, which is already fine
+            return
+
+        if not (os.path.exists(self.output) and os.path.samefile(self.input, self.output)):
+            self.logger.debug('{}: linking to {}'.format(self, self.output))
+            link_or_copy(self.input, self.output)
@@ -2,38 +2,278 @@
 __author__ = 'kako'
 
 import argparse
+import asyncio
 import logging
+import os
+import sys
 
-from .file_processor import FileProcessor
+from .batch import BatchProcessor, collect_files, read_list, walk_paths
+from .cache import JobJournal, ProbeCache, StreamCache, VerdictIndex
+from .file_processor import FileProcessor, FAST_PROBE_SIZE, FAST_ANALYZE_DURATION
+from .planner import Planner, write_csv, write_json
+from .profiles import default_profile_dirs, get_profile
+from .scanner import Scanner, write_json_line
+from .progress import ProgressReporter
+from .stream_processors import SEGMENT_LENGTH
+from .utils import parse_cpus
+from .work_queue import WorkQueue, Worker
 
 
 # Init logger with basic config
 logger = logging.getLogger()
 logging.basicConfig(format='%(levelname)s:%(message)s')
 
+
+def threads_type(value):
+    """
+    Parse number of threads argument: a positive number or "auto".
+    """
+    if value == 'auto':
+        return value
+    try:
+        threads = int(value)
+    except ValueError:
+        threads = 0
+    if threads < 1:
+        raise argparse.ArgumentTypeError('must be a positive number or "auto"')
+    return threads
+
+
+# Init parser for probe options, shared by conversion and scan commands
+probe_parser = argparse.ArgumentParser(add_help=False)
+probe_parser.add_argument('--fast-probe', action='store_true',
+                          help='Probe only the headers and the fields used, probing fully if any is missing')
+probe_parser.add_argument('--probe-size', type=int, default=FAST_PROBE_SIZE,
+                          help='Maximum bytes read by fast probes')
+probe_parser.add_argument('--analyze-duration', type=float, default=FAST_ANALYZE_DURATION,
+                          help='Maximum seconds of media analyzed by fast probes')
+
+# Init parser for options shared by all conversion commands
+options_parser = argparse.ArgumentParser(add_help=False, parents=[probe_parser])
+options_parser.add_argument('--single-pass', '-s', action='store_true',
+                            help='Convert all streams with a single command, without intermediate stream files')
+options_parser.add_argument('--stream-jobs', '-S', type=int, default=1,
+                            help='Maximum number of streams of a file converted at once (not in single pass)')
+options_parser.add_argument('--segment-jobs', '-G', type=int, default=1,
+                            help='Maximum number of segments of a long video stream encoded at once '
+                                 '(not in single pass)')
+options_parser.add_argument('--segment-length', type=float, default=SEGMENT_LENGTH,
+                            help='Minimum length in seconds of the segments of a video stream encoded at once')
+options_parser.add_argument('--threads', '-t', type=threads_type,
+                            help='Number of video encoding threads for each file, or "auto" to divide the CPUs '
+                                 'between video jobs running at once (profile\'s or ffmpeg\'s default otherwise)')
+options_parser.add_argument('--nice', type=int,
+                            help='Niceness increment for conversion commands')
+options_parser.add_argument('--affinity', type=parse_cpus,
+                            help='CPUs conversion commands can run on (eg, 0-3,6)')
+options_parser.add_argument('--scratch-dir', type=str,
+                            help='Directory where scratch directories for intermediate files are created '
+                                 '(system temporary directory by default)')
+options_parser.add_argument('--cache-dir', type=str,
+                            help='Directory for the probe cache, verdict index and job journal (~/.cache/ffconv by default)')
+options_parser.add_argument('--no-cache', action='store_true',
+                            help='Do not use the probe cache')
+options_parser.add_argument('--no-index', action='store_true',
+                            help='Do not skip files already compliant or converted, nor record them')
+options_parser.add_argument('--no-journal', action='store_true',
+                            help='Do not journal jobs, so interrupted jobs are not resumed')
+options_parser.add_argument('--stream-cache-dir', type=str,
+                            help='Directory (eg, on a cache disk) where converted streams are kept, so they are '
+                                 'not converted again by later runs (not in single pass)')
+options_parser.add_argument('--stream-cache-size', type=float, default=50,
+                            help='Maximum size in GiB of the converted streams kept, least recently used ones '
+                                 'are removed')
+options_parser.add_argument('--progress', '-P', action='store_true',
+                            help='Log progress of conversions (fps, speed, ETA)')
+options_parser.add_argument('--progress-file', type=str,
+                            help='File where progress of conversions is appended as JSON lines ("-" for stdout)')
+options_parser.add_argument('--profiles-dir', type=str, action='append', default=[],
+                            help='Directory with profile files (JSON or YAML), searched before $FFCONV_PROFILES '
+                                 'and ~/.config/ffconv/profiles (can be repeated)')
+options_parser.add_argument('--debug', '-d', action='store_true',
+                            help='Use debug mode, increasing verbosity and skipping clean ups')
+
 # Init parser and add params
-parser = argparse.ArgumentParser(description='Convert media files')
+parser = argparse.ArgumentParser(description='Convert media files',
+                                 parents=[options_parser])
 parser.add_argument('input', type=str,
                     help='Name of the input file to convert')
 parser.add_argument('profile', type=str,
                     help='Name of the profile to use (roku, etc)')
 parser.add_argument('--output', '-o', type=str,
                     help='Name of the merged output file, if not supplied original file is removed')
-parser.add_argument('--debug', '-d', action='store_true',
-                    help='Use debug mode, increasing verbosity and skipping clean ups')
+parser.add_argument('--variant', '-V', type=str, nargs=2, action='append', default=[],
+                    metavar=('PROFILE', 'OUTPUT'),
+                    help='Also write the output file for another profile, from the same decode '
+                         '(can be repeated, requires --output)')
 
+# Init batch parser and add params
+batch_parser = argparse.ArgumentParser(prog='ffconv batch',
+                                       description='Convert many media files in parallel',
+                                       parents=[options_parser])
+batch_parser.add_argument('profile', type=str,
+                          help='Name of the profile to use (roku, etc)')
+batch_parser.add_argument('paths', type=str, nargs='*',
+                          help='Files, directories or glob patterns to convert')
+batch_parser.add_argument('--list', '-l', type=argparse.FileType('r'),
+                          help='File with paths to convert, one per line ("-" for stdin)')
+batch_parser.add_argument('--output-dir', '-o', type=str,
+                          help='Directory for the output files (keeping the structure of the directories given), '
+                               'if not supplied original files are replaced')
+batch_parser.add_argument('--jobs', '-j', type=int,
+                          help='Maximum number of cheap jobs (remux, audio, subtitles) running at once, '
+                               'defaults to number of CPUs')
+batch_parser.add_argument('--video-jobs', '-J', type=int, default=1,
+                          help='Maximum number of video transcoding jobs running at once')
+batch_parser.add_argument('--backend', type=str, choices=['processes', 'asyncio'], default='processes',
+                          help='Run jobs in worker processes, or all of them from a single asyncio event loop')
+batch_parser.add_argument('--timeout', type=float,
+                          help='Maximum time in seconds for each file (asyncio backend only)')
 
-def process():
-    # Parse arguments
-    args = parser.parse_args()
+# Init plan parser and add params
+plan_parser = argparse.ArgumentParser(prog='ffconv plan',
+                                      description='Report what converting media files would do, without converting',
+                                      parents=[options_parser])
+plan_parser.add_argument('profile', type=str,
+                         help='Name of the profile to use (roku, etc)')
+plan_parser.add_argument('paths', type=str, nargs='*',
+                         help='Files, directories or glob patterns to plan')
+plan_parser.add_argument('--list', '-l', type=argparse.FileType('r'),
+                         help='File with paths to plan, one per line ("-" for stdin)')
+plan_parser.add_argument('--format', '-f', type=str, choices=['json', 'csv'], default='json',
+                         help='Format of the plan')
+plan_parser.add_argument('--output', '-o', type=argparse.FileType('w'), default=sys.stdout,
+                         help='File for the plan (stdout by default)')
+
+# Init scan parser and add params
+scan_parser = argparse.ArgumentParser(prog='ffconv scan',
+                                      description='Probe many media files at once, to build an inventory '
+                                                  'and fill the probe cache',
+                                      parents=[probe_parser])
+scan_parser.add_argument('paths', type=str, nargs='*',
+                         help='Files, directories or glob patterns to scan')
+scan_parser.add_argument('--list', '-l', type=argparse.FileType('r'),
+                         help='File with paths to scan, one per line ("-" for stdin)')
+scan_parser.add_argument('--io-jobs', '-I', type=int, default=16,
+                         help='Maximum number of probes running at once, mostly waiting for storage '
+                              '(raise it for network filesystems)')
+scan_parser.add_argument('--output', '-o', type=argparse.FileType('w'), default=sys.stdout,
+                         help='File for the results, as JSON lines (stdout by default)')
+scan_parser.add_argument('--cache-only', action='store_true',
+                         help='Only fill the probe cache, without writing results')
+scan_parser.add_argument('--cache-dir', type=str,
+                         help='Directory for the probe cache (~/.cache/ffconv by default)')
+scan_parser.add_argument('--no-cache', action='store_true',
+                         help='Do not use the probe cache')
+scan_parser.add_argument('--debug', '-d', action='store_true',
+                         help='Use debug mode, increasing verbosity')
+
+# Init cache parser and add params
+cache_parser = argparse.ArgumentParser(prog='ffconv cache',
+                                       description='Manage the probe cache, verdict index and job journal')
+cache_parser.add_argument('action', type=str, choices=['clear', 'gc', 'info'],
+                          help='Remove entries (for the given files, or all), remove orphan jobs that cannot '
+                               'be resumed or show cache info')
+cache_parser.add_argument('paths', type=str, nargs='*',
+                          help='Files to remove from the cache')
+cache_parser.add_argument('--cache-dir', type=str,
+                          help='Directory for the probe cache, verdict index and job journal (~/.cache/ffconv by default)')
+cache_parser.add_argument('--stream-cache-dir', type=str,
+                          help='Directory of the converted streams cache, to include it')
+
+# Init enqueue parser and add params
+enqueue_parser = argparse.ArgumentParser(prog='ffconv enqueue',
+                                         description='Add media files to the work queue shared by workers')
+enqueue_parser.add_argument('profile', type=str,
+                            help='Name of the profile to use (roku, etc)')
+enqueue_parser.add_argument('paths', type=str, nargs='*',
+                            help='Files, directories or glob patterns to convert')
+enqueue_parser.add_argument('--list', '-l', type=argparse.FileType('r'),
+                            help='File with paths to convert, one per line ("-" for stdin)')
+enqueue_parser.add_argument('--output-dir', '-o', type=str,
+                            help='Directory for the output files (keeping the structure of the directories given), '
+                              'if not supplied original files are replaced')
+enqueue_parser.add_argument('--queue-dir', '-q', type=str,
+                            help='Directory for the work queue, on storage shared by all workers '
+                                 '(~/.cache/ffconv by default)')
+enqueue_parser.add_argument('--profiles-dir', type=str, action='append', default=[],
+                            help='Directory with profile files (JSON or YAML), searched before $FFCONV_PROFILES '
+                                 'and ~/.config/ffconv/profiles (can be repeated)')
+
+# Init worker parser and add params
+worker_parser = argparse.ArgumentParser(prog='ffconv worker',
+                                        description='Convert media files from the work queue shared by workers',
+                                        parents=[options_parser])
+worker_parser.add_argument('--queue-dir', '-q', type=str,
+                           help='Directory for the work queue, on storage shared by all workers '
+                                '(~/.cache/ffconv by default)')
+worker_parser.add_argument('--name', type=str,
+                           help='Name of the worker (host:pid by default)')
+worker_parser.add_argument('--lease', type=float, default=120,
+                           help='Lease time in seconds, after which files of workers that stopped sending '
+                                'heartbeats are taken over')
+worker_parser.add_argument('--wait', '-w', action='store_true',
+                           help='Wait for more files when the queue is empty, instead of exiting')
+worker_parser.add_argument('--poll', type=float, default=10,
+                           help='Seconds between checks of the queue while waiting')
+worker_parser.add_argument('--max-jobs', type=int,
+                           help='Exit after processing this many files')
 
-    # Set logger level to debug
+
+def load_profile(args, profile=None):
+    """
+    Load the profile given in arguments (or the given one), by name or file
+    (see profiles.ProfileLoader), searching the given directories first.
+    """
+    return get_profile(profile or args.profile, args.profiles_dir + default_profile_dirs())
+
+
+def get_options(args):
+    """
+    Set logger level and build file processor options from arguments.
+    """
+    # Set logger level to debug (or info, to see progress)
     if args.debug:
         logger.setLevel(logging.DEBUG)
+    elif args.progress:
+        logger.setLevel(logging.INFO)
+
+    # Report progress if requested
+    on_progress = None
+    if args.progress or args.progress_file:
+        on_progress = ProgressReporter(args.progress_file)
+
+    return {
+        'single_pass': args.single_pass,
+        'stream_jobs': args.stream_jobs,
+        'segment_jobs': args.segment_jobs,
+        'segment_length': args.segment_length,
+        'threads': args.threads,
+        'nice': args.nice,
+        'affinity': args.affinity,
+        'scratch_root': args.scratch_dir,
+        'probe_cache': None if args.no_cache else ProbeCache(args.cache_dir),
+        'fast_probe': args.fast_probe,
+        'probe_size': args.probe_size,
+        'analyze_duration': args.analyze_duration,
+        'verdict_index': None if args.no_index else VerdictIndex(args.cache_dir),
+        'journal': None if args.no_journal else JobJournal(args.cache_dir),
+        'stream_cache': StreamCache(args.stream_cache_dir, int(args.stream_cache_size * 2 ** 30))
+                        if args.stream_cache_dir else None,
+        'on_progress': on_progress,
+    }
+
+
+def convert(argv):
+    # Parse arguments
+    args = parser.parse_args(argv)
+    options = get_options(args)
 
     try:
         # Process
-        processor = FileProcessor(args.input, args.output, args.profile)
+        variants = [(output, load_profile(args, profile)) for profile, output in args.variant]
+        processor = FileProcessor(args.input, args.output, load_profile(args),
+                                  variants=variants, **options)
         processor.process()
 
     except Exception as e:
@@ -44,3 +284,177 @@ def process():
     else:
         # All good, exit with 0
         exit(0)
+
+
+def batch(argv):
+    # Parse arguments
+    args = batch_parser.parse_args(argv)
+    options = get_options(args)
+
+    try:
+        # Collect files and process them
+        paths = args.paths + (read_list(args.list) if args.list else [])
+        names = dict(walk_paths(paths))
+        processor = BatchProcessor(list(names), load_profile(args),
+                                   output_dir=args.output_dir, jobs=args.jobs,
+                                   video_jobs=args.video_jobs, names=names, **options)
+        if args.backend == 'asyncio':
+            asyncio.run(processor.process_async(args.timeout))
+        else:
+            processor.process()
+
+    except Exception as e:
+        # Error, exit with 1
+        logger.critical(e)
+        exit(1)
+
+    # Print summary, exit with 1 if anything failed
+    print(processor.summary())
+    exit(1 if processor.failures else 0)
+
+
+def plan(argv):
+    # Parse arguments
+    args = plan_parser.parse_args(argv)
+    options = get_options(args)
+    for key in ('scratch_root', 'on_progress', 'stream_jobs', 'segment_jobs', 'segment_length',
+                'threads', 'nice', 'affinity', 'journal', 'stream_cache'):
+        options.pop(key)
+
+    try:
+        # Collect files and write plans as they are built
+        paths = args.paths + (read_list(args.list) if args.list else [])
+        planner = Planner(load_profile(args), **options)
+        writer = write_csv if args.format == 'csv' else write_json
+        writer(planner.plan(collect_files(paths)), args.output)
+
+    except Exception as e:
+        # Error, exit with 1
+        logger.critical(e)
+        exit(1)
+
+
+def scan(argv):
+    # Parse arguments
+    args = scan_parser.parse_args(argv)
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+    if args.cache_only and args.no_cache:
+        scan_parser.error('--cache-only requires the probe cache')
+
+    try:
+        # Collect files and write results as they are probed
+        paths = args.paths + (read_list(args.list) if args.list else [])
+        scanner = Scanner(io_jobs=args.io_jobs,
+                          probe_cache=None if args.no_cache else ProbeCache(args.cache_dir),
+                          fast_probe=args.fast_probe, probe_size=args.probe_size,
+                          analyze_duration=args.analyze_duration)
+        on_result = None if args.cache_only else lambda res: write_json_line(res, args.output)
+        stats = scanner.scan(collect_files(paths), on_result)
+
+    except Exception as e:
+        # Error, exit with 1
+        logger.critical(e)
+        exit(1)
+
+    # Summary goes to stderr, results may be on stdout
+    print('{files} files scanned, {errors} failed, {probes} probes run ({fallbacks} full after fast), '
+          '{bytes_read} bytes read'.format(**stats), file=sys.stderr)
+    exit(1 if stats['errors'] else 0)
+
+
+def cache(argv):
+    # Parse arguments
+    args = cache_parser.parse_args(argv)
+
+    if args.action == 'gc':
+        # Remove orphan jobs (and their files) that cannot be resumed
+        journal = JobJournal(args.cache_dir)
+        print('{} orphan jobs removed from {}'.format(journal.collect_garbage(), journal.db_file))
+        return
+
+    stores = [ProbeCache(args.cache_dir), VerdictIndex(args.cache_dir), JobJournal(args.cache_dir)]
+    if args.stream_cache_dir:
+        stores.append(StreamCache(args.stream_cache_dir))
+
+    for store in stores:
+        if args.action == 'clear':
+            # Remove entries for given paths, or everything
+            count = store.invalidate(args.paths or None)
+            print('{} entries removed from {}'.format(count, store.db_file))
+
+        elif isinstance(store, StreamCache):
+            # Show location, size and disk used
+            print('{} entries ({:.1f} GiB) in {}'.format(len(store), store.size() / 2 ** 30, store.db_file))
+
+        else:
+            # Show location and size
+            print('{} entries in {}'.format(len(store), store.db_file))
+
+
+def enqueue(argv):
+    # Parse arguments
+    args = enqueue_parser.parse_args(argv)
+
+    try:
+        # Check profile (workers load it by name, or by file on shared
+        # storage), collect files and add them to the queue
+        load_profile(args)
+        profile = args.profile
+        if os.path.isfile(profile):
+            profile = os.path.abspath(profile)
+        paths = args.paths + (read_list(args.list) if args.list else [])
+        queue = WorkQueue(args.queue_dir)
+        names = dict(walk_paths(paths))
+        count = queue.enqueue(list(names), profile, args.output_dir, names)
+
+    except Exception as e:
+        # Error, exit with 1
+        logger.critical(e)
+        exit(1)
+
+    print('{} files added to {}'.format(count, queue.db_file))
+
+
+def worker(argv):
+    # Parse arguments
+    args = worker_parser.parse_args(argv)
+    options = get_options(args)
+
+    try:
+        # Process files from the queue until done
+        processor = Worker(WorkQueue(args.queue_dir), name=args.name,
+                           lease_time=args.lease, poll_interval=args.poll,
+                           wait=args.wait, max_jobs=args.max_jobs,
+                           profile_dirs=args.profiles_dir + default_profile_dirs(), **options)
+        results = processor.run()
+
+    except Exception as e:
+        # Error, exit with 1
+        logger.critical(e)
+        exit(1)
+
+    # Exit with 1 if anything failed
+    failures = [r for r in results if r.get('error')]
+    print('{} files processed, {} failed'.format(len(results), len(failures)))
+    exit(1 if failures else 0)
+
+
+# Commands available besides the default (convert a single file)
+commands = {
+    'batch': batch,
+    'cache': cache,
+    'enqueue': enqueue,
+    'plan': plan,
+    'scan': scan,
+    'worker': worker,
+}
+
+
+def process():
+    # Dispatch to command if given, otherwise convert a single file
+    argv = sys.argv[1:]
+    if argv and argv[0] in commands:
+        commands[argv[0]](argv[1:])
+    else:
+        convert(argv)
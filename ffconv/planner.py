@@ -0,0 +1,178 @@
+"""
+This module contains the planner, which reports what processing files
+would do (and roughly how much it would cost) without converting anything.
+"""
+import csv
+import json
+
+from . import profiles
+from .file_processor import FileProcessor
+from .utils import file_duration, stream_bitrate, stream_duration
+
+
+# CPU seconds per second of media to transcode 1080p video with x264 (slow
+# preset), scaled by number of pixels and preset. These are rough numbers,
+# meant for scheduling, not for accounting.
+VIDEO_CPU_FACTOR = 3.0
+VIDEO_PIXELS = 1920 * 1080
+PRESET_FACTORS = {
+    'ultrafast': 0.1, 'superfast': 0.15, 'veryfast': 0.25, 'faster': 0.4,
+    'fast': 0.5, 'medium': 0.6, 'slow': 1.0, 'slower': 2.0, 'veryslow': 4.0,
+}
+
+# CPU seconds per second of media to transcode audio or extract subtitles
+AUDIO_CPU_FACTOR = 0.02
+COPY_CPU_FACTOR = 0.001
+
+# Bit rates assumed when the stream does not say (or for converted audio)
+DEFAULT_BITRATES = {'video': 4000000, 'audio': 192000, 'subtitle': 100}
+
+# Columns for CSV output
+CSV_FIELDS = ['input', 'duration', 'transcode', 'copy', 'extract', 'downmix',
+              'cpu_seconds', 'bytes_written', 'verdict', 'error']
+
+
+class Planner(object):
+    """
+    Planner for files with a profile, which probes them (using the probe
+    cache, if any) and evaluates each stream processor's decision, to report
+    which streams would be transcoded, copied or extracted, and the
+    estimated CPU time and bytes written.
+    """
+
+    def __init__(self, profile, single_pass=False, **kwargs):
+        """
+        Set profile (resolved once for all files), engine mode and options
+        for the file processors.
+        """
+        self.profile = profiles.get_profile(profile)
+        self.single_pass = single_pass
+        self.options = kwargs
+
+    def estimate(self, processor, stream, duration):
+        """
+        Estimate CPU seconds and bytes written for a stream.
+
+        :param processor: stream processor
+        :param stream: stream data as probed
+        :param duration: duration in seconds
+        :return: tuple with CPU seconds and bytes of the stream's output
+        """
+        bitrate = stream_bitrate(stream) or DEFAULT_BITRATES[processor.media_type]
+
+        if processor.action not in ('transcode', 'downmix'):
+            # Copy or extract, cheap
+            cpu = COPY_CPU_FACTOR * duration
+
+        elif processor.media_type == 'video':
+            # Transcode video, scale by size and preset
+            pixels = int(stream.get('width') or 0) * int(stream['height']) or VIDEO_PIXELS
+            preset = PRESET_FACTORS.get(processor.target_preset, 1.0)
+            cpu = VIDEO_CPU_FACTOR * preset * pixels / VIDEO_PIXELS * duration
+
+        else:
+            # Transcode (or downmix) audio, cheap-ish, and we know the target
+            # bit rate
+            cpu = AUDIO_CPU_FACTOR * duration
+            bitrate = DEFAULT_BITRATES['audio']
+
+        return cpu, bitrate * duration / 8
+
+    def plan_file(self, in_file):
+        """
+        Build the plan for a file.
+
+        :param in_file: input file name
+        :return: plan data
+        """
+        plan = {'input': in_file, 'duration': None, 'streams': [],
+                'cpu_seconds': 0.0, 'bytes_written': 0}
+        try:
+            processor = FileProcessor(in_file, None, self.profile,
+                                      single_pass=self.single_pass, **self.options)
+
+            # If already done, there's nothing to plan
+            verdict = processor.get_verdict()
+            if verdict:
+                plan['verdict'] = verdict['verdict']
+                return plan
+
+            streams = processor.probe()
+            processors = processor.get_processors(streams)
+            if processor.error:
+                raise processor.error
+
+        except Exception as e:
+            plan['error'] = str(e) or e.__class__.__name__
+            return plan
+
+        by_index = {s['index']: s for s in streams}
+        duration = file_duration(streams) or 0.0
+        plan['duration'] = duration
+
+        total_bytes = 0
+        for stream_proc in processors:
+            stream = by_index[stream_proc.index]
+            cpu, size = self.estimate(stream_proc, stream,
+                                      stream_duration(stream) or duration)
+            plan['streams'].append({
+                'index': stream_proc.index, 'media_type': stream_proc.media_type,
+                'codec': stream_proc.codec, 'action': stream_proc.action,
+                'target_codec': stream_proc.target_codec if stream_proc.action != 'copy' else stream_proc.codec,
+            })
+            plan['cpu_seconds'] += cpu
+            total_bytes += size
+
+            # Multi-pass writes converted streams twice (stream file + merge)
+            if stream_proc.action != 'copy' and not self.single_pass:
+                plan['bytes_written'] += size
+
+        # Nothing is written if no stream is converted
+        if any(s['action'] != 'copy' for s in plan['streams']):
+            plan['bytes_written'] += total_bytes
+        plan['bytes_written'] = int(plan['bytes_written'])
+        plan['cpu_seconds'] = round(plan['cpu_seconds'], 1)
+        return plan
+
+    def plan(self, files):
+        """
+        Build plans for all files, lazily.
+
+        :param files: input file names
+        :return: generator of plan data
+        """
+        for in_file in files:
+            yield self.plan_file(in_file)
+
+
+def write_json(plans, out):
+    """
+    Write plans as a JSON document with the totals.
+
+    :param plans: iterable of plan data
+    :param out: file object
+    """
+    plans = list(plans)
+    totals = {'files': len(plans),
+              'cpu_seconds': round(sum(p['cpu_seconds'] for p in plans), 1),
+              'bytes_written': sum(p['bytes_written'] for p in plans)}
+    json.dump({'files': plans, 'totals': totals}, out, indent=2)
+    out.write('\n')
+
+
+def write_csv(plans, out):
+    """
+    Write plans as CSV, one row per file with the indexes of the streams
+    for each action.
+
+    :param plans: iterable of plan data
+    :param out: file object
+    """
+    writer = csv.DictWriter(out, CSV_FIELDS, extrasaction='ignore')
+    writer.writeheader()
+    for plan in plans:
+        row = dict(plan)
+        for action in ('transcode', 'copy', 'extract', 'downmix'):
+            row[action] = ' '.join(str(s['index']) for s in plan['streams']
+                                   if s['action'] == action)
+        writer.writerow(row)
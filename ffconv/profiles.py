@@ -14,7 +14,51 @@ output:
     index: index of the stream in the input file
     language (optional): metadata for the stream
 
+Profiles
+
+video (optional):
+    max_height: maximum height, taller videos are scaled down to it
+    threads: number of encoding threads, or "auto" for all CPUs available
+    lookahead_threads: number of x264 lookahead threads
+
+audio (optional):
+    keep_original: keep tracks with more channels than max_channels if their
+        codec is allowed, adding a downmixed track (see AudioProcessor)
+
+Sections (video, audio, subtitle) can be left out, or set to null when
+extending a profile, to drop those streams (eg, an audio-only profile).
+
+Profiles are compiled once into immutable rules (see compile_profile), which
+is what stream processors use.
+
+Besides the built-in ones, profiles can be loaded from JSON or YAML files
+(see ProfileLoader), with the same keys plus "extends", the name of the
+profile they're based on (built-in or another file), eg:
+
+    name: Mobile
+    extends: roku
+    video:
+        preset: veryfast
+        quality: 26
 """
+import bisect
+import copy
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+# Maximum reference frames for video taller than any in max_refs
+DEFAULT_MAX_REFS = 4
+
+# Maximum number of compiled profiles kept (see compile_profile)
+COMPILED_CACHE_SIZE = 64
 
 ROKU = {
     'name': 'Roku',
@@ -42,3 +86,394 @@ ROKU = {
         'encodings': ['utf-8', 'iso-8859-1']
     }
 }
+
+# Built-in profiles by name
+BUILTIN = {
+    'roku': ROKU,
+}
+
+
+class Rules(object):
+    """
+    Base class for the compiled rules of a profile for a media type: target
+    codecs (as a tuple, and a set for lookups) and container, validated when
+    compiled. Rules are immutable, so they're shared by all the processors
+    using the profile.
+    """
+    __slots__ = ('codecs', 'codec_set', 'container')
+    media_type = None
+
+    # Keys allowed in the profile data for the media type
+    keys = ('codecs', 'container')
+
+    def __init__(self, name, data):
+        """
+        Validate and set rules from the profile data for the media type.
+
+        :param name: profile name, for errors
+        :param data: profile data for the media type
+        """
+        unknown = sorted(set(data) - set(self.keys))
+        if unknown:
+            raise ValueError('Profile {}: unknown {} keys {}'.format(name, self.media_type, ', '.join(unknown)))
+
+        codecs = self._get(name, data, 'codecs', list)
+        if not codecs or not all(isinstance(codec, str) for codec in codecs):
+            raise ValueError('Profile {}: {}.codecs must be a non-empty list of codec names'.format(
+                name, self.media_type))
+        self._set('codecs', tuple(codecs))
+        self._set('codec_set', frozenset(codecs))
+        self._set('container', self._get(name, data, 'container', str))
+
+    def __setattr__(self, key, value):
+        raise AttributeError('{} are immutable'.format(self.__class__.__name__))
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, ', '.join(
+            '{}={!r}'.format(key, getattr(self, key)) for key in self._keys() if key != 'codec_set'))
+
+    def _keys(self):
+        """
+        Get all slot names, including those of base classes.
+        """
+        return [key for cls in reversed(type(self).__mro__) for key in getattr(cls, '__slots__', ())]
+
+    def _set(self, key, value):
+        """
+        Set a rule (only while compiling).
+        """
+        object.__setattr__(self, key, value)
+
+    def _get(self, name, data, key, types, required=True):
+        """
+        Get a value from the profile data, checking its type.
+        """
+        if key not in data:
+            if required:
+                raise ValueError('Profile {}: {}.{} is required'.format(name, self.media_type, key))
+            return None
+
+        value = data[key]
+        types = types if isinstance(types, tuple) else (types,)
+        if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+            raise ValueError('Profile {}: {}.{} has an invalid value {!r}'.format(
+                name, self.media_type, key, value))
+        return value
+
+    def allows(self, codec):
+        """
+        Check whether the codec is one of the target codecs.
+        """
+        return codec in self.codec_set
+
+
+class VideoRules(Rules):
+    """
+    Video rules: besides codecs, target H.264 profile, level, preset and
+    quality (CRF), maximum height, encoder threads and maximum reference
+    frames by height (sorted, for lookups by bisection).
+    """
+    __slots__ = ('profile', 'level', 'preset', 'quality', 'heights', 'refs',
+                 'max_height', 'threads', 'lookahead_threads')
+    media_type = 'video'
+    keys = Rules.keys + ('profile', 'level', 'preset', 'quality', 'max_refs',
+                         'max_height', 'threads', 'lookahead_threads')
+
+    def __init__(self, name, data):
+        super(VideoRules, self).__init__(name, data)
+        self._set('profile', self._get(name, data, 'profile', str))
+        self._set('level', str(self._get(name, data, 'level', (str, int, float))))
+        self._set('preset', self._get(name, data, 'preset', str))
+        self._set('quality', self._get(name, data, 'quality', (int, float)))
+
+        # Heights might be strings (eg, keys of JSON objects)
+        try:
+            max_refs = sorted((int(h), int(f)) for h, f in self._get(name, data, 'max_refs', dict).items())
+        except ValueError:
+            raise ValueError('Profile {}: video.max_refs must map heights to reference frames'.format(name))
+        self._set('heights', tuple(h for h, _ in max_refs))
+        self._set('refs', tuple(f for _, f in max_refs))
+
+        max_height = self._get(name, data, 'max_height', int, required=False)
+        if max_height is not None and max_height <= 0:
+            raise ValueError('Profile {}: video.max_height must be a positive number'.format(name))
+        self._set('max_height', max_height)
+
+        threads = self._get(name, data, 'threads', (int, str), required=False)
+        if isinstance(threads, str) and threads != 'auto':
+            raise ValueError('Profile {}: video.threads must be a number or "auto"'.format(name))
+        self._set('threads', threads)
+        self._set('lookahead_threads', self._get(name, data, 'lookahead_threads', int, required=False))
+
+    def max_refs(self, height):
+        """
+        Get the maximum reference frames for video of the given height: the
+        limit of the first height in the table that is not lower.
+
+        :param height: video height
+        :return: maximum reference frames
+        """
+        position = bisect.bisect_left(self.heights, height)
+        return self.refs[position] if position < len(self.refs) else DEFAULT_MAX_REFS
+
+
+class AudioRules(Rules):
+    """
+    Audio rules: besides codecs, maximum channels, target quality and whether
+    to keep original multichannel tracks.
+    """
+    __slots__ = ('max_channels', 'quality', 'keep_original')
+    media_type = 'audio'
+    keys = Rules.keys + ('max_channels', 'quality', 'keep_original')
+
+    def __init__(self, name, data):
+        super(AudioRules, self).__init__(name, data)
+        self._set('max_channels', int(self._get(name, data, 'max_channels', (int, str))))
+        self._set('quality', self._get(name, data, 'quality', (int, float)))
+        self._set('keep_original', self._get(name, data, 'keep_original', bool, required=False) or False)
+
+
+class SubtitleRules(Rules):
+    """
+    Subtitle rules: besides codecs, candidate encodings of the text, in
+    order of preference.
+    """
+    __slots__ = ('encodings',)
+    media_type = 'subtitle'
+    keys = Rules.keys + ('encodings',)
+
+    def __init__(self, name, data):
+        super(SubtitleRules, self).__init__(name, data)
+        encodings = self._get(name, data, 'encodings', list)
+        if not encodings:
+            raise ValueError('Profile {}: subtitle.encodings must be a non-empty list'.format(name))
+        self._set('encodings', tuple(encodings))
+
+
+class CompiledProfile(object):
+    """
+    Compiled profile: name, hash of its contents, its original data and the
+    rules for each media type (None for sections left out, or null, whose
+    streams are dropped, eg, video for an audio-only profile).
+    """
+    __slots__ = ('name', 'hash', 'data', 'video', 'audio', 'subtitle')
+
+    def __init__(self, data, digest):
+        """
+        Compile the profile data (see compile_profile).
+
+        :param data: profile data
+        :param digest: hash of its contents
+        """
+        if not isinstance(data, dict) or not isinstance(data.get('name'), str):
+            raise ValueError('Profile must be a mapping with a name')
+        name = data['name']
+        unknown = sorted(set(data) - {'name', 'video', 'audio', 'subtitle'})
+        if unknown:
+            raise ValueError('Profile {}: unknown keys {}'.format(name, ', '.join(unknown)))
+        for rules_cls in (VideoRules, AudioRules, SubtitleRules):
+            section = data.get(rules_cls.media_type)
+            if section is not None and not isinstance(section, dict):
+                raise ValueError('Profile {}: {} section must be a mapping'.format(name, rules_cls.media_type))
+            object.__setattr__(self, rules_cls.media_type,
+                               rules_cls(name, section) if section is not None else None)
+        if not any((self.video, self.audio, self.subtitle)):
+            raise ValueError('Profile {}: at least one section is required'.format(name))
+
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'hash', digest)
+        object.__setattr__(self, 'data', data)
+
+    def __setattr__(self, key, value):
+        raise AttributeError('CompiledProfile is immutable')
+
+    def __repr__(self):
+        return 'CompiledProfile <{}>'.format(self.name)
+
+    def rules(self, media_type):
+        """
+        Get the rules for the media type (None if its streams are dropped).
+        """
+        return getattr(self, media_type)
+
+
+# Compiled profiles by contents, least recently used first
+_compiled = OrderedDict()
+
+
+def compile_profile(profile):
+    """
+    Compile a profile into immutable rules, validating it. Compiled profiles
+    are cached by contents, so compiling the same profile again (or an equal
+    one) is cheap, while modified profiles are compiled again.
+
+    :param profile: profile data (or an already compiled profile)
+    :return: CompiledProfile instance
+    :raise: ValueError if the profile is not valid
+    """
+    if isinstance(profile, CompiledProfile):
+        return profile
+
+    key = json.dumps(profile, sort_keys=True, default=str)
+    compiled = _compiled.get(key)
+    if compiled is None:
+        compiled = CompiledProfile(profile, hashlib.sha1(key.encode('utf-8')).hexdigest())
+        _compiled[key] = compiled
+        if len(_compiled) > COMPILED_CACHE_SIZE:
+            _compiled.popitem(last=False)
+    else:
+        _compiled.move_to_end(key)
+    return compiled
+
+
+def default_profile_dirs():
+    """
+    Get the default directories for profile files: those in FFCONV_PROFILES
+    (separated like PATH) and the user's (following XDG,
+    ~/.config/ffconv/profiles).
+    """
+    dirs = [d for d in os.environ.get('FFCONV_PROFILES', '').split(os.pathsep) if d]
+    root = os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser('~/.config')
+    return dirs + [os.path.join(root, 'ffconv', 'profiles')]
+
+
+def merge(base, data):
+    """
+    Merge profile data over a base profile: sections are merged key by key,
+    values (including lists and tables, like max_refs) are replaced.
+
+    :param base: base profile data (not modified)
+    :param data: profile data overriding it
+    :return: merged profile data
+    """
+    merged = copy.deepcopy(base)
+    for key, value in copy.deepcopy(data).items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key].update(value)
+        else:
+            merged[key] = value
+    return merged
+
+
+class ProfileLoader(object):
+    """
+    Loader of profiles by name: files in the profile directories (name.json,
+    name.yaml or name.yml), or built-in ones. Files can extend other profiles
+    (see merge), and are validated when loaded (see compile_profile).
+
+    Parsed files are cached by modification time, so a long running process
+    (eg, a worker) only reads them again when they change.
+    """
+    extensions = ('.json', '.yaml', '.yml')
+
+    def __init__(self, dirs=None):
+        """
+        Set profile directories (the default ones if not given) and cache.
+        """
+        self.dirs = list(dirs) if dirs is not None else default_profile_dirs()
+        self.files = {}
+
+    def find(self, name):
+        """
+        Find the file for a profile name in the profile directories.
+
+        :param name: profile name
+        :return: file name (None if not found)
+        """
+        for directory in self.dirs:
+            for ext in self.extensions:
+                path = os.path.join(directory, name + ext)
+                if os.path.isfile(path):
+                    return path
+
+    def read(self, path):
+        """
+        Read and parse a profile file, unless it's cached and did not change.
+
+        :param path: file name
+        :return: profile data (must not be modified)
+        """
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        cached = self.files.get(path)
+        if cached and cached[0] == key:
+            return cached[1]
+
+        with open(path, encoding='utf-8') as f:
+            if path.endswith('.json'):
+                try:
+                    data = json.load(f)
+                except ValueError as e:
+                    raise ValueError('Profile file {} is not valid JSON: {}'.format(path, e))
+
+            elif yaml is None:
+                raise ValueError('PyYAML is required to load profile file {}'.format(path))
+
+            else:
+                try:
+                    data = yaml.safe_load(f)
+                except yaml.YAMLError as e:
+                    raise ValueError('Profile file {} is not valid YAML: {}'.format(path, e))
+
+        if not isinstance(data, dict):
+            raise ValueError('Profile file {} must contain a mapping'.format(path))
+        self.files[path] = (key, data)
+        return data
+
+    def load(self, profile, _seen=()):
+        """
+        Load a profile: data (resolving what it extends), a profile file or
+        the name of a profile file or a built-in profile.
+
+        :param profile: profile data, file name or profile name
+        :return: profile data (validated)
+        :raise: ValueError if not found or not valid
+        """
+        if isinstance(profile, dict):
+            data, name = profile, profile.get('name')
+
+        elif os.path.splitext(profile)[1] in self.extensions:
+            data, name = self.read(profile), os.path.splitext(os.path.basename(profile))[0]
+
+        else:
+            path = self.find(profile)
+            if path is None:
+                if profile.lower() in BUILTIN:
+                    return BUILTIN[profile.lower()]
+                raise ValueError('Profile {} could not be found'.format(profile))
+            data, name = self.read(path), profile
+
+        if 'extends' in data:
+            # Merge over the base profile, keeping this name (not the base's)
+            if name in _seen:
+                raise ValueError('Profile {} extends itself'.format(name))
+            base = self.load(data['extends'], _seen + (name,))
+            own = {k: v for k, v in data.items() if k != 'extends'}
+            data = merge(base, dict(own, name=own.get('name', name)))
+
+        elif 'name' not in data:
+            data = dict(data, name=name)
+
+        compile_profile(data)
+        return data
+
+
+# Loaders by profile directories (see get_profile)
+_loaders = {}
+
+
+def get_profile(profile, dirs=None):
+    """
+    Load a profile (see ProfileLoader.load) with the loader for the given
+    profile directories (the default ones if not given), which is kept for
+    later calls so files are only parsed again if they change.
+
+    :param profile: profile data, file name or profile name
+    :param dirs: profile directories
+    :return: profile data (validated)
+    """
+    key = tuple(dirs) if dirs is not None else None
+    loader = _loaders.get(key)
+    if loader is None:
+        loader = _loaders[key] = ProfileLoader(dirs)
+    return loader.load(profile)
@@ -0,0 +1,157 @@
+"""
+This module contains the progress tracking for ffmpeg commands, which are
+run with machine-readable progress output (key=value lines) that is parsed
+incrementally and reported to callbacks.
+"""
+import json
+import logging
+import sys
+import time
+
+
+def with_progress(cmd):
+    """
+    Add progress options to an ffmpeg command: progress is written to the
+    log (stderr), instead of the usual stats.
+
+    :param cmd: ffmpeg command as list of strings
+    :return: new command as list of strings
+    """
+    return cmd[:1] + ['-progress', 'pipe:2', '-nostats'] + cmd[1:]
+
+
+def track(cmd, job, duration, on_progress):
+    """
+    Prepare a command to track its progress, if there's a callback.
+
+    :param cmd: command as list of strings
+    :param job: job name, for snapshots
+    :param duration: duration in seconds (None if unknown)
+    :param on_progress: progress callback (None to not track it)
+    :return: tuple with command and keyword arguments for execute_cmd
+    """
+    if not on_progress:
+        return cmd, {}
+    return with_progress(cmd), {'on_line': ProgressTracker(job, duration, on_progress)}
+
+
+def _parse_time(value):
+    """
+    Parse a time value like "01:02:03.456789" into seconds.
+    """
+    seconds = 0.0
+    for part in value.split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+class ProgressTracker(object):
+    """
+    Parser of ffmpeg's progress output for a job, which is fed log lines
+    (see execute_cmd's on_line) and calls back with a snapshot every time
+    ffmpeg reports a block of progress.
+
+    Snapshots are dicts with job name, fps, speed (multiplier), processed
+    time, duration, percentage and ETA (in seconds), those not known are
+    None.
+    """
+
+    def __init__(self, job, duration, callback):
+        """
+        Set job name, duration (in seconds, None if unknown), callback and
+        current values placeholder.
+        """
+        self.job = job
+        self.duration = duration
+        self.callback = callback
+        self.values = {}
+
+    def __call__(self, line):
+        """
+        Parse a line, calling back if it closes a progress block. Any other
+        log lines are ignored.
+        """
+        key, sep, value = line.partition('=')
+        if not sep or ' ' in key:
+            return
+
+        self.values[key.strip()] = value.strip()
+        if key == 'progress':
+            self.callback(self.snapshot())
+            self.values = {}
+
+    def _float(self, key, suffix=''):
+        """
+        Get a value as float (None if not available, eg "N/A").
+        """
+        try:
+            return float(self.values[key].rstrip(suffix))
+        except (KeyError, ValueError):
+            return None
+
+    def snapshot(self):
+        """
+        Build snapshot from the current values.
+
+        :return: dict with progress data
+        """
+        # Processed time, in the best unit available (out_time_ms is in
+        # microseconds too, in spite of its name)
+        out_time = self._float('out_time_us')
+        if out_time is None:
+            out_time = self._float('out_time_ms')
+        if out_time is not None:
+            out_time /= 1000000
+        elif self.values.get('out_time'):
+            out_time = _parse_time(self.values['out_time'])
+
+        speed = self._float('speed', 'x')
+        done = self.values.get('progress') == 'end'
+        percent = eta = None
+        if self.duration and out_time is not None:
+            percent = 100.0 if done else min(100.0, 100 * out_time / self.duration)
+            if speed:
+                eta = 0.0 if done else max(0.0, (self.duration - out_time) / speed)
+
+        return {'job': self.job, 'time': time.time(), 'done': done,
+                'fps': self._float('fps'), 'speed': speed,
+                'out_time': out_time, 'duration': self.duration,
+                'percent': percent, 'eta': eta,
+                'total_size': self._float('total_size')}
+
+
+class ProgressReporter(object):
+    """
+    Default progress callback, which logs snapshots and optionally appends
+    them as JSON lines to a file (or stdout, with "-").
+
+    Note: the file is opened for each snapshot, so the reporter can be sent
+    to worker processes and all of them can write to the same file.
+    """
+
+    def __init__(self, jsonl_file=None):
+        """
+        Set JSON lines file name (None to only log).
+        """
+        self.jsonl_file = jsonl_file
+
+    def __call__(self, snapshot):
+        """
+        Report a snapshot.
+        """
+        # Log human-readable progress
+        logging.getLogger().info('{job}: {percent} at {fps} fps, {speed}x, ETA {eta}'.format(
+            job=snapshot['job'],
+            percent='?%' if snapshot['percent'] is None else '{:.1f}%'.format(snapshot['percent']),
+            fps='?' if snapshot['fps'] is None else '{:.1f}'.format(snapshot['fps']),
+            speed='?' if snapshot['speed'] is None else '{:.2f}'.format(snapshot['speed']),
+            eta='?' if snapshot['eta'] is None else '{:.0f}s'.format(snapshot['eta'])))
+
+        # Write JSON line
+        if self.jsonl_file == '-':
+            sys.stdout.write(json.dumps(snapshot) + '\n')
+            sys.stdout.flush()
+
+        elif self.jsonl_file:
+            with open(self.jsonl_file, 'a') as f:
+                f.write(json.dumps(snapshot) + '\n')
@@ -0,0 +1,115 @@
+"""
+This module contains the scanner, which probes a whole library of files to
+build its inventory (and fill the probe cache), many files at once.
+
+Probing is mostly waiting for storage (specially on network filesystems,
+where each read has a high latency), so many more probes than CPUs can run
+at once, full ones included (they only decode the first few frames).
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import profiles
+from .file_processor import FileProcessor
+from .utils import file_duration
+
+
+class Scanner(object):
+    """
+    Scanner for many files, which probes them from a single event loop with
+    a bounded pool of probes (I/O concurrency).
+    """
+
+    def __init__(self, io_jobs=16, **kwargs):
+        """
+        Set concurrency limit and options for the file processors (probe
+        cache and probe mode).
+        """
+        self.io_jobs = io_jobs
+        self.options = kwargs
+        self.stats = {'files': 0, 'errors': 0, 'probes': 0, 'fallbacks': 0, 'bytes_read': 0}
+        self.logger = logging.getLogger()
+
+    def __str__(self):
+        return 'Scanner <{} probes>'.format(self.io_jobs)
+
+    def scan(self, files, on_result=None):
+        """
+        Scan all files, returning when all of them are done.
+
+        :param files: iterable of input file names (consumed lazily)
+        :param on_result: callback for the result of each file, as soon as
+                          it's done (in no particular order)
+        :return: counters of files, errors, probes run, fallbacks to full
+                 probes and bytes read
+        """
+        async def run():
+            # File system calls run in threads, as many as probes
+            asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=self.io_jobs))
+            return await self.scan_async(files, on_result)
+
+        return asyncio.run(run())
+
+    async def scan_async(self, files, on_result=None):
+        """
+        Asyncio version of scan. Each worker of the pool takes the next file
+        when done with the last one, so files are never all pending at once.
+        File system calls (stats and the probe cache) run in the loop's
+        default executor, which should have as many threads as io_jobs (see
+        scan).
+        """
+        files = iter(files)
+
+        async def work():
+            for in_file in files:
+                res = await self.scan_file_async(in_file)
+                if on_result is not None:
+                    on_result(res)
+
+        await asyncio.gather(*(work() for _ in range(self.io_jobs)))
+        return self.stats
+
+    async def scan_file_async(self, in_file):
+        """
+        Probe a single file (unless it's in the probe cache), catching any
+        errors.
+
+        :param in_file: input file name
+        :return: result data, with input, size, duration, streams, time and
+                 error (if any)
+        """
+        start = time.monotonic()
+        res = {'input': in_file}
+        try:
+            # Probing does not depend on the profile, any will do
+            processor = FileProcessor(in_file, None, profiles.ROKU, **self.options)
+            res['size'] = await asyncio.to_thread(os.path.getsize, in_file)
+            streams = await processor.probe_async()
+            res.update(duration=file_duration(streams), streams=streams)
+            for key, value in processor.probe_stats.items():
+                self.stats[key] += value
+
+        except Exception as e:
+            self.logger.debug('{}: {}: {}'.format(self, in_file, e))
+            res['error'] = str(e) or e.__class__.__name__
+            self.stats['errors'] += 1
+
+        self.stats['files'] += 1
+        res['time'] = round(time.monotonic() - start, 3)
+        return res
+
+
+def write_json_line(res, out):
+    """
+    Write a scan result as a JSON line, flushing it so the inventory can be
+    followed as it's built.
+
+    :param res: result data
+    :param out: file object
+    """
+    out.write(json.dumps(res) + '\n')
+    out.flush()
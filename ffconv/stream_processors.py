@@ -3,55 +3,137 @@ This module contains the actual stream processors, which do the actual
 media conversions.
 """
 
+import asyncio
+import copy
+import json
 import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
 
-from .utils import execute_cmd, CalledProcessError
+from .profiles import compile_profile
+from .progress import track
+from .subtitles import clean_file, detect_encoding, recode_file
+from .utils import execute_cmd, execute_cmd_async, cpu_budget, remove_files, stream_duration, \
+    CalledProcessError, ChildEvent
+
+
+# Minimum length of video segments encoded in parallel, in seconds (see
+# VideoProcessor.convert_segments)
+SEGMENT_LENGTH = 300
+
+# Maximum difference between the duration of an encoded segment and the
+# one of its part of the input, in seconds
+SEGMENT_TOLERANCE = 0.5
 
 
 class StreamProcessor(object):
     """
     Base class for all stream processors, providing the basic interface and
     common functionality.
+
+    Subclasses are registered by media type (see __init_subclass__), so the
+    processor for a stream is found with a single lookup.
     """
     media_type = None
 
-    def __init__(self, in_file, stream, profile):
+    # Processor classes by media type (the first one defined wins)
+    registry = {}
+
+    def __init_subclass__(cls, **kwargs):
         """
-        Set generic input and target specs from input file, stream and profile.
+        Register the processor class for its media type.
+        """
+        super(StreamProcessor, cls).__init_subclass__(**kwargs)
+        if cls.media_type:
+            StreamProcessor.registry.setdefault(cls.media_type, cls)
+
+    @classmethod
+    def for_stream(cls, stream):
+        """
+        Get the processor class for a stream, by its media type.
+
+        :param stream: stream data as probed
+        :return: StreamProcessor subclass (None if media type is not known)
+        """
+        return cls.registry.get(stream['codec_type'])
+
+    def __init__(self, in_file, stream, profile, work_dir='', on_progress=None):
+        """
+        Set generic input and target specs from input file, stream and profile
+        (data or compiled, see profiles.compile_profile). The output is
+        created in the given work directory (current one by default), and
+        conversion progress is reported to on_progress (if given).
         """
         # Set direct values from input and stream
         self.input = in_file
         self.index = stream['index']
         self.codec = stream['codec_name']
+        self.duration = stream_duration(stream)
         self.language = stream.get('tags', {}).get('language')
         if self.language == 'und':
             self.language = None
-        self.allowed_codecs = profile[self.media_type]['codecs']
+        self.rules = compile_profile(profile).rules(self.media_type)
+        self.allowed_codecs = self.rules.codecs
 
         # Select target values from profile
         self.target_codec = self.allowed_codecs[0]
-        self.target_container = profile[self.media_type]['container']
-        self.output = '{}-{}.{}'.format(self.media_type, self.index,
-                                        self.target_container)
+        self.target_container = self.rules.container
+        self.output = os.path.join(work_dir, '{}-{}.{}'.format(
+            self.media_type, self.index, self.target_container))
 
-        # Set logger
+        # Set logger and progress callback
         self.logger = logging.getLogger()
+        self.on_progress = on_progress
+
+        # Set key of the stream in the job journal (see
+        # FileProcessor._record_stream)
+        self.key = str(self.index)
+
+        # Set placeholders for number of encoding threads (ffmpeg's default
+        # if not set), stop event (see FileProcessor.process_streams) and
+        # CPU limits for commands (see utils.cpu_limiter)
+        self.threads = None
+        self.stop = None
+        self.cpu_limits = []
 
         # Set stream-specific data
-        self._init_stream(stream, profile)
+        self._init_stream(stream, self.rules)
 
     def __str__(self):
         return 'Stream <#{} {} {}>'.format(self.index, self.media_type, self.codec)
 
     def _init_stream(self, *args):
         """
-        Set stream-specific input and target specs from input file, stream
-        and profile.
+        Set stream-specific input and target specs from stream and rules of
+        the profile for the media type.
 
         Must be overridden by subclasses.
         """
         return NotImplementedError('{} cannot set stream-specific data.'.format(self.__class__.__name__))
 
+    def execute(self, cmd):
+        """
+        Execute a command for this stream, tracking its progress if we have
+        a callback.
+
+        :param cmd: command as list of strings
+        :return: output of command
+        """
+        cmd, kwargs = track(cmd, str(self), self.duration, self.on_progress)
+        if self.stop is not None:
+            kwargs['stop'] = self.stop
+        cmd = self.cpu_limits + cmd
+        return execute_cmd(cmd, **kwargs)
+
+    async def execute_async(self, cmd):
+        """
+        Asyncio version of execute.
+        """
+        cmd, kwargs = track(cmd, str(self), self.duration, self.on_progress)
+        cmd = self.cpu_limits + cmd
+        return await execute_cmd_async(cmd, **kwargs)
+
     @property
     def must_convert(self):
         """
@@ -60,7 +142,34 @@ class StreamProcessor(object):
 
         Subclasses might modify or replace it completely.
         """
-        return self.codec not in self.allowed_codecs
+        return not self.rules.allows(self.codec)
+
+    @property
+    def action(self):
+        """
+        What processing will do with the stream: transcode or copy it.
+        """
+        return 'transcode' if self.must_convert else 'copy'
+
+    def params(self):
+        """
+        Get the parameters that determine the converted stream (see
+        cache.StreamCache): media type, codecs and target container.
+        Subclasses add their own target values.
+
+        :return: dict of parameters
+        """
+        return {'media_type': self.media_type, 'codec': self.codec,
+                'target_codec': self.target_codec, 'container': self.target_container}
+
+    def companions(self):
+        """
+        Build the processors of extra output streams made from this one,
+        which follow it in the output (none by default).
+
+        :return: list of StreamProcessor instances
+        """
+        return []
 
     def clean_up(self):
         """
@@ -68,12 +177,69 @@ class StreamProcessor(object):
         """
         raise NotImplementedError('{} cannot clean up {} yet.'.format(self.__class__.__name__, self.media_type))
 
-    def convert(self):
+    def codec_args(self, spec):
         """
-        Conversion, must be defined by subclasses.
+        Build the encoding options for the stream, to be used in a single-pass
+        command where spec is the output stream specifier.
+
+        Must be defined by subclasses.
+        """
+        raise NotImplementedError('{} cannot encode {} in a single pass yet.'.format(self.__class__.__name__, self.media_type))
+
+    def output_args(self, out_index):
+        """
+        Build the output options for this stream when written directly to the
+        final container by a single-pass command (ie, without intermediate
+        stream files).
+
+        :param out_index: index of the stream in the output file
+        :return: list of ffmpeg output options
+        """
+        spec = str(out_index)
+        if self.must_convert:
+            # Encode with the target values
+            return self.codec_args(spec)
+
+        else:
+            # Nothing to do, just copy it
+            return ['-c:{}'.format(spec), 'copy']
+
+    def _threads_args(self):
+        """
+        Build the encoding threads option, if set.
+        """
+        return ['-threads', str(self.threads)] if self.threads else []
+
+    def build_command(self):
+        """
+        Build the conversion command, must be defined by subclasses.
         """
         raise NotImplementedError('{} cannot convert {} yet.'.format(self.__class__.__name__, self.media_type))
 
+    def convert(self):
+        """
+        Convert the stream, creating the output file to use by merger.
+        """
+        self.execute(self.build_command())
+
+    async def convert_async(self):
+        """
+        Asyncio version of convert.
+        """
+        await self.execute_async(self.build_command())
+
+    def result(self):
+        """
+        Build processed stream data: input file, index and language (used by
+        merger).
+
+        :return: processed stream data
+        """
+        res = {'input': self.input, 'index': self.index}
+        if self.language:
+            res['language'] = self.language
+        return res
+
     def process(self):
         """
         Process this stream, which might mean converting it or not.
@@ -93,12 +259,27 @@ class StreamProcessor(object):
             # Nothing to do
             self.logger.debug('{}: skipping, no conversion required'.format(self))
 
-        # Build and return data: input file, index and language
-        # (used by merger)
-        res = {'input': self.input, 'index': self.index}
-        if self.language:
-            res['language'] = self.language
-        return res
+        return self.result()
+
+    async def process_async(self):
+        """
+        Asyncio version of process.
+        """
+        if self.must_convert:
+            # Must convert, run conversion and clean-up (in a thread, it's
+            # done in Python)
+            self.logger.debug('{}: converting to {}'.format(self, self.target_codec))
+            await self.convert_async()
+            self.logger.debug('{}: cleaning up'.format(self))
+            await asyncio.to_thread(self.clean_up)
+            self.input = self.output
+            self.index = 0
+
+        else:
+            # Nothing to do
+            self.logger.debug('{}: skipping, no conversion required'.format(self))
+
+        return self.result()
 
 
 class VideoProcessor(StreamProcessor):
@@ -107,7 +288,7 @@ class VideoProcessor(StreamProcessor):
     """
     media_type = 'video'
 
-    def _init_stream(self, stream, profile):
+    def _init_stream(self, stream, rules):
         """
         Set video-specific input and target specs,
         """
@@ -118,28 +299,48 @@ class VideoProcessor(StreamProcessor):
         if 'height' not in stream:
             raise KeyError("Height not specified in video stream.")
 
-        # Get height and set target for ref frames (default is 4)
-        self.max_refs = 4
-        height = int(stream['height'])
-        for h, f in sorted(profile[self.media_type]['max_refs'].items()):
-            if height <= h:
-                self.max_refs = f
-                break
+        # Get height and set target for ref frames, and whether it must be
+        # scaled down to the maximum height (if any)
+        self.height = int(stream['height'])
+        self.max_refs = rules.max_refs(self.height)
+        self.max_height = rules.max_height
+        self.scale = self.max_height is not None and self.height > self.max_height
 
         # Set target values for profile, level, preset and quality
-        self.target_profile = profile[self.media_type]['profile']
-        self.target_level = profile[self.media_type]['level']
-        self.target_preset = profile[self.media_type]['preset']
-        self.target_quality = profile[self.media_type]['quality']
+        self.target_profile = rules.profile
+        self.target_level = rules.level
+        self.target_preset = rules.preset
+        self.target_quality = rules.quality
+
+        # Set encoder lookahead threads (optional, x264's default if not set)
+        self.lookahead_threads = rules.lookahead_threads
+
+        # Set number of segments encoded at once (whole stream at once by
+        # default) and their minimum length (see convert_segments)
+        self.segment_jobs = 1
+        self.segment_length = SEGMENT_LENGTH
 
     @property
     def must_convert(self):
         """
         Conversion check: besides base check (codec compatibility), check that
-        reference frames are acceptable.
+        reference frames and height are acceptable.
         """
         return any((super(VideoProcessor, self).must_convert,
-                    self.refs > self.max_refs))
+                    self.refs > self.max_refs, self.scale))
+
+    def params(self):
+        """
+        Besides base parameters, the target H.264 profile, level, preset and
+        quality, and height if scaled (not threads, which don't change the
+        result).
+        """
+        params = super(VideoProcessor, self).params()
+        params.update(profile=self.target_profile, level=self.target_level,
+                      preset=self.target_preset, quality=self.target_quality)
+        if self.scale:
+            params.update(height=self.max_height)
+        return params
 
     def clean_up(self):
         """
@@ -147,43 +348,393 @@ class VideoProcessor(StreamProcessor):
         """
         pass
 
+    def _threads_args(self, spec=None, threads=None):
+        """
+        Build the encoding threads options, if set: total threads (these ones
+        if given) and x264 lookahead threads (for the given output stream, if
+        any).
+        """
+        suffix = ':{}'.format(spec) if spec else ''
+        threads = threads or self.threads
+        args = []
+        if threads:
+            args.extend(['-threads' + suffix, str(threads)])
+        if self.lookahead_threads:
+            args.extend(['-x264-params' + suffix,
+                         'lookahead-threads={}'.format(self.lookahead_threads)])
+        return args
+
+    def _scale_args(self, spec='v'):
+        """
+        Build the filter that scales the video down to the maximum height
+        (keeping the aspect ratio, with an even width), if required.
+        """
+        if self.scale:
+            return ['-filter:{}'.format(spec), 'scale=-2:{}'.format(self.max_height)]
+        return []
+
+    def codec_args(self, spec):
+        """
+        Build the video encoding options for the given output stream.
+        """
+        return self._scale_args(spec) + \
+            ['-c:{}'.format(spec), self.target_codec,
+             '-preset:{}'.format(spec), str(self.target_preset),
+             '-crf:{}'.format(spec), str(self.target_quality),
+             '-profile:{}'.format(spec), self.target_profile,
+             '-level:{}'.format(spec), self.target_level] + \
+            self._threads_args(spec)
+
+    def _encode_args(self, threads=None):
+        """
+        Build the video encoding options for a stream file (whole or
+        segment).
+        """
+        return self._scale_args() + \
+            ['-c:v', self.target_codec, '-preset', str(self.target_preset),
+             '-crf', str(self.target_quality), '-profile:v',
+             self.target_profile, '-level', self.target_level] + \
+            self._threads_args(threads=threads)
+
+    def build_command(self):
+        """
+        Build the command to convert the video stream according to the
+        selected target values, creating a temporary video file.
+        """
+        return ['ffmpeg', '-i', self.input, '-map', '0:{}'.format(self.index)] + \
+            self._encode_args() + [self.output]
+
     def convert(self):
         """
-        Convert the video stream according to the selected target values,
-        creating a temporary video file to use by merger.
+        Convert the stream, in segments if they're encoded in parallel and
+        the stream is long enough (see convert_segments).
+        """
+        if self.segment_jobs > 1:
+            segments = self.split(self.execute_probe(self.build_keyframes_command()))
+            if len(segments) > 1:
+                return self.convert_segments(segments)
+        super(VideoProcessor, self).convert()
+
+    async def convert_async(self):
+        """
+        Asyncio version of convert.
+        """
+        if self.segment_jobs > 1:
+            segments = self.split(await execute_cmd_async(self.build_keyframes_command()))
+            if len(segments) > 1:
+                return await self.convert_segments_async(segments)
+        await super(VideoProcessor, self).convert_async()
+
+    def execute_probe(self, cmd):
+        """
+        Execute a probe command (not tracked, it's not a conversion).
+        """
+        kwargs = {'stop': self.stop} if self.stop is not None else {}
+        return execute_cmd(cmd, **kwargs)
+
+    def build_keyframes_command(self):
+        """
+        Build the command to list the keyframes of the stream, from packet
+        flags (without decoding anything), and the start time of the file.
+        """
+        return ['ffprobe', '-v', 'error', '-select_streams', str(self.index),
+                '-show_entries', 'packet=pts_time,flags:format=start_time', '-of', 'csv=print_section=0',
+                self.input]
+
+    def split(self, packets):
+        """
+        Split the stream in segments at keyframes, each one at least
+        segment_length long (the last one might be up to twice as long), so
+        they can be encoded independently and concatenated.
+
+        Packet times are absolute, while seeking (see build_segment_command)
+        is relative to the start time of the file, so it's subtracted.
+
+        :param packets: keyframes command output (pts time and flags lines,
+            and a start time line)
+        :return: list of (start, end) times, end is None for the last one
+        """
+        keyframes = []
+        start_time = 0.0
+        for line in packets.splitlines():
+            pts_time, comma, flags = line.partition(',')
+            if pts_time in ('', 'N/A'):
+                continue
+            if not comma:
+                start_time = float(pts_time)
+            elif 'K' in flags:
+                keyframes.append(float(pts_time))
+        keyframes = [keyframe - start_time for keyframe in keyframes]
+
+        starts = [0.0]
+        end = self.duration or (max(keyframes) if keyframes else 0)
+        for keyframe in sorted(keyframes):
+            if keyframe - starts[-1] >= self.segment_length and end - keyframe >= self.segment_length:
+                starts.append(keyframe)
+        return list(zip(starts, starts[1:] + [None]))
+
+    def segment_output(self, number):
+        """
+        Get the output file name for a segment.
+        """
+        base, ext = os.path.splitext(self.output)
+        return '{}.segment-{}{}'.format(base, number, ext)
+
+    def build_segment_command(self, number, start, end, threads=None):
+        """
+        Build the command to encode a segment (from start to end times) with
+        the selected target values. Seeking on input is frame-accurate when
+        re-encoding, and segments start at keyframes anyway.
+        """
+        cmd = ['ffmpeg', '-ss', '{:.6f}'.format(start), '-i', self.input]
+        if end is not None:
+            cmd.extend(['-t', '{:.6f}'.format(end - start)])
+        return cmd + ['-map', '0:{}'.format(self.index)] + \
+            self._encode_args(threads) + [self.segment_output(number)]
+
+    def build_check_command(self, number):
+        """
+        Build the command to probe an encoded segment, for checking it.
+        """
+        return ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+                '-show_entries', 'stream=refs:format=duration', '-of', 'json',
+                self.segment_output(number)]
+
+    def check_segment(self, number, start, end, output):
+        """
+        Check an encoded segment: its duration must match its part of the
+        input (so no frames were lost or duplicated at its boundaries) and
+        its reference frames must be acceptable.
+
+        :param number: segment number
+        :param start: start time in the input
+        :param end: end time in the input (None if it's the last one)
+        :param output: check command output
+        :raise: ValueError if the segment is not good
+        """
+        data = json.loads(output)
+        refs = int(data['streams'][0].get('refs', 0))
+        if refs > self.max_refs:
+            raise ValueError('Segment {} of {} has {} reference frames, maximum is {}'.format(
+                number, self, refs, self.max_refs))
+
+        end = self.duration if end is None else end
+        duration = float(data['format'].get('duration', 0))
+        if end is not None and abs(duration - (end - start)) > SEGMENT_TOLERANCE:
+            raise ValueError('Segment {} of {} lasts {:.3f}s, expected {:.3f}s'.format(
+                number, self, duration, end - start))
+
+    def build_concat_command(self, list_file):
+        """
+        Build the command to concatenate the segments (losslessly, without
+        re-encoding) into the output.
         """
-        cmd = ['ffmpeg', '-i', self.input, '-map', '0:{}'.format(self.index),
-               '-c:v', self.target_codec, '-preset', str(self.target_preset),
-               '-crf', str(self.target_quality), '-profile:v',
-               self.target_profile, '-level', self.target_level, self.output]
-        execute_cmd(cmd)
+        return ['ffmpeg', '-f', 'concat', '-safe', '0', '-i', list_file,
+                '-c', 'copy', self.output]
+
+    def _segment_threads(self):
+        """
+        Get the encoding threads for each segment, sharing the stream's (or
+        all CPUs) between the segments encoded at once.
+        """
+        if self.threads:
+            return max(1, self.threads // self.segment_jobs)
+        return cpu_budget(self.segment_jobs)
+
+    def _write_segments_list(self, segments):
+        """
+        Write the list of segment files for the concat demuxer.
+
+        :return: list file name
+        """
+        list_file = '{}.segments.txt'.format(os.path.splitext(self.output)[0])
+        with open(list_file, 'w') as f:
+            for number in range(len(segments)):
+                path = os.path.abspath(self.segment_output(number)).replace("'", "'\\''")
+                f.write("file '{}'\n".format(path))
+        return list_file
+
+    def _encode_segment(self, number, start, end, threads):
+        """
+        Encode and check a segment.
+        """
+        end_time = self.duration if end is None else end
+        cmd, kwargs = track(self.build_segment_command(number, start, end, threads),
+                            '{} segment {}'.format(self, number),
+                            end_time - start if end_time else None, self.on_progress)
+        if self.stop is not None:
+            kwargs['stop'] = self.stop
+        cmd = self.cpu_limits + cmd
+        execute_cmd(cmd, **kwargs)
+        self.check_segment(number, start, end, self.execute_probe(self.build_check_command(number)))
+
+    def convert_segments(self, segments):
+        """
+        Convert the stream in segments, encoding segment_jobs of them at once
+        (each one with its share of threads), then concatenate them. If one
+        fails the others are stopped (but not the rest of the file, their
+        stop event is a child of the stream's).
+
+        :param segments: list of (start, end) times (see split)
+        """
+        self.logger.debug('{}: encoding {} segments'.format(self, len(segments)))
+        threads = self._segment_threads()
+        outputs = [self.segment_output(number) for number in range(len(segments))]
+        stop, self.stop = self.stop, ChildEvent(self.stop)
+        try:
+            with ThreadPoolExecutor(max_workers=self.segment_jobs) as executor:
+                futures = [executor.submit(self._encode_segment, number, start, end, threads)
+                           for number, (start, end) in enumerate(segments)]
+                done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+
+                # Find first error, stop everything else
+                errors = [f.exception() for f in futures if f in done and f.exception()]
+                if errors:
+                    self.stop.set()
+                    for future in futures:
+                        future.cancel()
+            if errors:
+                raise errors[0]
+
+            list_file = self._write_segments_list(segments)
+            outputs.append(list_file)
+            self.execute(self.build_concat_command(list_file))
+
+        finally:
+            self.stop = stop
+            remove_files(outputs)
+
+    async def convert_segments_async(self, segments):
+        """
+        Asyncio version of convert_segments.
+        """
+        self.logger.debug('{}: encoding {} segments'.format(self, len(segments)))
+        threads = self._segment_threads()
+        semaphore = asyncio.Semaphore(self.segment_jobs)
+        outputs = [self.segment_output(number) for number in range(len(segments))]
+
+        async def encode(number, start, end):
+            async with semaphore:
+                await self.execute_async(self.build_segment_command(number, start, end, threads))
+                output = await execute_cmd_async(self.build_check_command(number))
+                self.check_segment(number, start, end, output)
+
+        tasks = [asyncio.ensure_future(encode(number, start, end))
+                 for number, (start, end) in enumerate(segments)]
+        try:
+            await asyncio.gather(*tasks)
+            list_file = self._write_segments_list(segments)
+            outputs.append(list_file)
+            await self.execute_async(self.build_concat_command(list_file))
+
+        finally:
+            # Errors or cancelled, stop everything else
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            remove_files(outputs)
 
 
 class AudioProcessor(StreamProcessor):
     """
     Audio stream processor, provides specific audio conversion functionality.
+
+    Tracks are converted to the cheapest target: if the codec is allowed and
+    only the channels must be reduced, they keep their codec (eg, AAC 5.1 to
+    AAC stereo) instead of being encoded to the profile's first codec. If the
+    profile keeps originals, those tracks are copied as they are and a
+    downmixed track is added after them instead (see companions).
     """
     media_type = 'audio'
 
-    def _init_stream(self, stream, profile):
+    # Containers for audio stream files by codec (Matroska audio for the
+    # rest, which takes any codec)
+    containers = {'mp3': 'mp3', 'aac': 'm4a', 'flac': 'flac', 'ac3': 'ac3',
+                  'opus': 'opus', 'vorbis': 'ogg'}
+
+    # Encoders for codecs whose ffmpeg encoder of the same name is
+    # experimental (fails without "-strict -2"), the rest are used by name
+    encoders = {'opus': 'libopus', 'vorbis': 'libvorbis'}
+
+    def _init_stream(self, stream, rules):
         """
         Set audio-specific input and target specs,
         """
         # Set number of channels in input stream
         self.channels = int(stream['channels'])
 
-        # Set target quality and channels
-        self.max_channels = int(profile[self.media_type]['max_channels'])
-        self.target_quality = profile[self.media_type]['quality']
+        # Set target quality and channels, and whether this is the downmix of
+        # a track kept as it is (see companions)
+        self.max_channels = rules.max_channels
+        self.target_quality = rules.quality
+        self.keep_original = rules.keep_original
+        self.downmix = False
+
+        # Keep the codec if allowed, so only channels are reduced
+        if rules.allows(self.codec):
+            self.target_codec = self.codec
+            self.target_container = self.containers.get(self.codec, 'mka')
+            self.output = os.path.join(os.path.dirname(self.output), '{}-{}.{}'.format(
+                self.media_type, self.index, self.target_container))
+
+        # Placeholder for the batch converting it with other tracks (see
+        # AudioBatch)
+        self.batch = None
+
+    def __str__(self):
+        name = super(AudioProcessor, self).__str__()
+        return name[:-1] + ' downmix>' if self.downmix else name
+
+    @property
+    def keeps_original(self):
+        """
+        Whether the track is kept as it is, with a downmixed companion: it has
+        too many channels but its codec is allowed, and the profile keeps
+        originals.
+        """
+        return self.keep_original and not self.downmix and \
+            self.rules.allows(self.codec) and self.channels > self.max_channels
 
     @property
     def must_convert(self):
         """
         Conversion check: besides base check (codec compatibility), check that
-        number of channels is acceptable.
+        number of channels is acceptable (unless the track is kept, and its
+        downmix is converted instead).
         """
-        return any((super(AudioProcessor, self).must_convert,
-                    self.channels > self.max_channels))
+        if self.downmix:
+            return True
+        return not self.keeps_original and any((super(AudioProcessor, self).must_convert,
+                                                self.channels > self.max_channels))
+
+    @property
+    def action(self):
+        """
+        What processing will do with the stream: transcode, downmix or copy it.
+        """
+        return 'downmix' if self.downmix else super(AudioProcessor, self).action
+
+    def companions(self):
+        """
+        Build the processor of the downmixed track, if the original is kept.
+        """
+        if not self.keeps_original:
+            return []
+
+        downmix = copy.copy(self)
+        downmix.downmix = True
+        downmix.key = '{}-downmix'.format(self.index)
+        downmix.output = os.path.join(os.path.dirname(self.output), '{}-{}-downmix.{}'.format(
+            self.media_type, self.index, self.target_container))
+        return [downmix]
+
+    def params(self):
+        """
+        Besides base parameters, the encoding options (quality and channels).
+        """
+        params = super(AudioProcessor, self).params()
+        params.update(args=self.codec_args('a'))
+        return params
 
     def clean_up(self):
         """
@@ -191,15 +742,118 @@ class AudioProcessor(StreamProcessor):
         """
         pass
 
+    @property
+    def encoder(self):
+        """
+        Name of the ffmpeg encoder for the target codec.
+        """
+        return self.encoders.get(self.target_codec, self.target_codec)
+
+    def _quality_args(self, spec):
+        """
+        Build the quality option, only for the profile's first codec (what its
+        quality is meant for, others get the encoder's default).
+        """
+        if self.target_codec == self.allowed_codecs[0]:
+            return ['-q:{}'.format(spec), str(self.target_quality)]
+        return []
+
+    def codec_args(self, spec):
+        """
+        Build the audio encoding options for the given output stream.
+        """
+        return ['-c:{}'.format(spec), self.encoder] + self._quality_args(spec) + \
+            ['-ac:{}'.format(spec), str(self.max_channels)]
+
+    def output_file_args(self):
+        """
+        Build the options of the output file of the conversion: map, encoding
+        options and the file itself.
+        """
+        return ['-map', '0:{}'.format(self.index), '-c:a', self.encoder] + \
+            self._quality_args('a') + ['-ac:0', str(self.max_channels)] + \
+            self._threads_args() + [self.output]
+
+    def build_command(self):
+        """
+        Build the command to convert the audio stream according to the
+        selected target values, creating a temporary audio file.
+        """
+        return ['ffmpeg', '-i', self.input] + self.output_file_args()
+
     def convert(self):
         """
-        Convert the audio stream according to the selected target values,
-        creating a temporary audio file to use by merger.
+        Convert the stream, with the rest of its batch if any.
+        """
+        if self.batch is None:
+            super(AudioProcessor, self).convert()
+        else:
+            self.batch.convert(self)
+
+    async def convert_async(self):
+        """
+        Asyncio version of convert.
         """
-        cmd = ['ffmpeg', '-i', self.input, '-map', '0:{}'.format(self.index),
-               '-c:a', self.target_codec, '-q:a', str(self.target_quality),
-               '-ac:0', str(self.max_channels), self.output]
-        execute_cmd(cmd)
+        if self.batch is None:
+            await super(AudioProcessor, self).convert_async()
+        else:
+            await self.batch.convert_async(self)
+
+
+class AudioBatch(object):
+    """
+    Batch of audio conversions of the same input, run by a single command
+    which reads (and decodes) the input once and writes all their outputs.
+    The first processor of the batch to convert runs the command for all of
+    them, the rest just wait for it and share its result.
+    """
+
+    def __init__(self, processors):
+        """
+        Set processors (joining them to the batch), lock and placeholders for
+        the command run (or task, for asyncio) and its error.
+        """
+        self.processors = list(processors)
+        for processor in self.processors:
+            processor.batch = self
+        self.lock = threading.Lock()
+        self.done = False
+        self.error = None
+        self.task = None
+
+    def build_command(self):
+        """
+        Build the command converting all the streams of the batch.
+        """
+        cmd = ['ffmpeg', '-i', self.processors[0].input]
+        for processor in self.processors:
+            cmd.extend(processor.output_file_args())
+        return cmd
+
+    def convert(self, processor):
+        """
+        Convert all the streams with the given processor (its progress
+        callback, stop event and CPU limits), unless done already.
+
+        :param processor: processor of the batch
+        """
+        with self.lock:
+            if not self.done:
+                self.done = True
+                try:
+                    processor.execute(self.build_command())
+                except Exception as e:
+                    self.error = e
+        if self.error:
+            raise self.error
+
+    async def convert_async(self, processor):
+        """
+        Asyncio version of convert.
+        """
+        if self.task is None:
+            self.task = asyncio.ensure_future(processor.execute_async(self.build_command()))
+        await self.task
 
 
 class SubtitleProcessor(StreamProcessor):
@@ -211,49 +865,181 @@ class SubtitleProcessor(StreamProcessor):
 
     # Override super property to always convert (we always want to clean-up)
     must_convert = True
+    action = 'extract'
+
+    # Text codecs that can be extracted as they are (to detect their
+    # encoding), and their containers
+    raw_containers = {'srt': 'srt', 'subrip': 'srt', 'ass': 'ass', 'ssa': 'ass',
+                      'webvtt': 'vtt'}
 
-    def _init_stream(self, stream, profile):
+    def _init_stream(self, stream, rules):
         """
         Set audio-specific input and target specs,
         """
         # Set target encodings
-        self.target_encodings = profile[self.media_type]['encodings']
+        self.target_encodings = list(rules.encodings)
+
+        # Set file for the stream extracted as is (if it's text)
+        self.raw_container = self.raw_containers.get(self.codec)
+        self.raw_output = None
+        if self.raw_container:
+            self.raw_output = '{}.raw.{}'.format(os.path.splitext(self.output)[0],
+                                                 self.raw_container)
+
+    def params(self):
+        """
+        Besides base parameters, the candidate encodings.
+        """
+        params = super(SubtitleProcessor, self).params()
+        params.update(encodings=self.target_encodings)
+        return params
 
     def clean_up(self):
         """
         Cleanup for subtitles consists of removing "weird tags", such as fonts
-        and comments (eg, <i></i>, {lala}).
+        and comments (eg, <i></i>, {lala}), keeping the cues structure (see
+        subtitles.strip_tags).
+        """
+        clean_file(self.output)
+
+    def codec_args(self, spec):
+        """
+        Build the subtitle encoding options for the given output stream.
+
+        Note: the character encoding is an input option, so it's set by the
+        file processor for the whole command (see FileProcessor.transcode).
+        """
+        return ['-c:{}'.format(spec), self.target_codec]
+
+    def build_command(self, encoding):
+        """
+        Build the command to extract the subtitle stream with the given
+        encoding.
+        """
+        return ['ffmpeg', '-sub_charenc', encoding, '-i', self.input,
+                '-map', '0:{}'.format(self.index)] + \
+            self._threads_args() + [self.output]
+
+    def build_extract_command(self):
+        """
+        Build the command to extract the subtitle stream as it is (copying
+        its bytes, without decoding them).
+        """
+        return ['ffmpeg', '-i', self.input, '-map', '0:{}'.format(self.index),
+                '-c:s', 'copy', self.raw_output]
+
+    def build_recoded_command(self):
         """
-        cmd = ['sed', '-i', '-e', r"s/<[^>]*>//ig", '-e', r"s/{[^}]*}//ig",
-               self.output]
-        execute_cmd(cmd)
+        Build the command to convert the extracted stream (once recoded to
+        UTF-8) to the target format.
+        """
+        return ['ffmpeg', '-i', self.raw_output] + self._threads_args() + \
+            [self.output]
+
+    def recode(self):
+        """
+        Detect the encoding of the extracted stream and recode it to UTF-8,
+        which is the output if it's already in the target format.
+
+        :return: whether the recoded stream must still be converted
+        """
+        with open(self.raw_output, 'rb') as raw:
+            encoding = detect_encoding(raw.read(), self.target_encodings)
+        self.logger.debug('{}: recoding from {}'.format(self, encoding))
+        recode_file(self.raw_output, encoding)
+
+        if self.raw_container == self.target_container:
+            os.replace(self.raw_output, self.output)
+            return False
+        return True
 
     def convert(self):
+        """
+        Convert the subtitle stream to UTF-8 and the target format: extract
+        it as it is, detect its encoding and recode it (see subtitles module),
+        then convert it if it's not in the target format already. That's one
+        or two commands, whatever the encoding.
+
+        Codecs that cannot be extracted as text are converted with each of
+        the target encodings until one works (see convert_encodings).
+        """
+        if not self.raw_output:
+            return self.convert_encodings()
+
+        try:
+            self.execute(self.build_extract_command())
+            if self.recode():
+                self.execute(self.build_recoded_command())
+
+        except (CalledProcessError, ValueError) as e:
+            # Failed: erase output file (if created)
+            remove_files([self.output])
+            raise ValueError('Could not extract stream 0:{} ({})'.format(self.index, e))
+
+        finally:
+            remove_files([self.raw_output])
+
+    async def convert_async(self):
+        """
+        Asyncio version of convert.
+        """
+        if not self.raw_output:
+            return await self.convert_encodings_async()
+
+        try:
+            await self.execute_async(self.build_extract_command())
+            if await asyncio.to_thread(self.recode):
+                await self.execute_async(self.build_recoded_command())
+
+        except (CalledProcessError, ValueError) as e:
+            # Failed: erase output file (if created)
+            remove_files([self.output])
+            raise ValueError('Could not extract stream 0:{} ({})'.format(self.index, e))
+
+        finally:
+            remove_files([self.raw_output])
+
+    def convert_encodings(self):
         """
         Convert the subtitle stream with the target encoding and extract it.
 
         Note: this will attempt to convert with all target encodings until one
-        works or raise and exception if none did. Dumb? We've no way to detect
-        the encoding, so it's our only choice.
+        works or raise and exception if none did.
         """
-        index = '0:{}'.format(self.index)
+        # Cycle through encodings
+        for encoding in self.target_encodings:
+            try:
+                # Try to extract with current encoding
+                self.execute(self.build_command(encoding))
+
+            except CalledProcessError:
+                # Failed: erase output file (if created)
+                remove_files([self.output])
 
+            else:
+                # Worked
+                return
+
+        # If none worked, we raise an exception
+        raise ValueError('Could not extract stream 0:{}'.format(self.index))
+
+    async def convert_encodings_async(self):
+        """
+        Asyncio version of convert_encodings.
+        """
         # Cycle through encodings
         for encoding in self.target_encodings:
             try:
                 # Try to extract with current encoding
-                cmd = ['ffmpeg', '-sub_charenc', encoding, '-i', self.input,
-                       '-map', index, self.output]
-                execute_cmd(cmd)
+                await self.execute_async(self.build_command(encoding))
 
             except CalledProcessError:
-                # Failed: erase output file
-                cmd = ['rm', self.output]
-                execute_cmd(cmd)
+                # Failed: erase output file (if created)
+                remove_files([self.output])
 
             else:
                 # Worked
                 return
 
         # If none worked, we raise an exception
-        raise ValueError('Could not extract stream {}'.format(index))
+        raise ValueError('Could not extract stream 0:{}'.format(self.index))
@@ -0,0 +1,158 @@
+"""
+This module contains the subtitle text handling done in Python (instead of
+running ffmpeg or sed several times for each stream): charset detection,
+recoding to UTF-8 and clean-up of formatting tags.
+"""
+import codecs
+import os
+import re
+import shutil
+import tempfile
+import unicodedata
+
+
+# Tags removed from cue text: HTML-like (eg, <i></i>, <font ...>) and
+# SSA/ASS overrides or comments (eg, {\an8}, {lala})
+TAGS = re.compile(rb'<[^>]*>|{[^}]*}')
+
+# Cue timing lines (eg, 00:00:01,000 --> 00:00:02,500), never modified
+TIMING = re.compile(rb'^\s*\d+:\d+:\d+[,.]\d+\s*-->')
+
+# Byte order marks and their encodings (longest first, UTF-32 LE starts
+# like UTF-16 LE)
+BOMS = [(codecs.BOM_UTF32_LE, 'utf-32'), (codecs.BOM_UTF32_BE, 'utf-32'),
+        (codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'),
+        (codecs.BOM_UTF16_BE, 'utf-16')]
+
+# Characters that are unlikely in subtitles text (controls other than
+# whitespace, private use and unassigned), a sign of the wrong charset
+UNLIKELY_CATEGORIES = {'Cc', 'Co', 'Cn'}
+
+# Size of reads when recoding
+CHUNK_SIZE = 64 * 1024
+
+
+def _score(text):
+    """
+    Score a decoded text by how likely it is to be the right decoding:
+    letters and common punctuation count for it, unlikely characters
+    (eg, the C1 controls ISO-8859-1 yields for Windows-1252 quotes) count a
+    lot against it.
+    """
+    score = 0
+    for char in text:
+        if char in '\r\n\t':
+            continue
+        category = unicodedata.category(char)
+        if category in UNLIKELY_CATEGORIES:
+            score -= 10
+        elif category[0] in 'LNZ' or category in ('Po', 'Pd', 'Ps', 'Pe', 'Pi', 'Pf'):
+            score += 1
+    return score
+
+
+def detect_encoding(data, encodings):
+    """
+    Detect the charset of subtitles text: byte order mark, then UTF-8
+    validation, then the best scoring of the given encodings among those
+    that can decode it (first one wins ties).
+
+    :param data: subtitles text (bytes)
+    :param encodings: candidate encodings, in order of preference
+    :return: encoding name (for Python codecs)
+    """
+    for bom, encoding in BOMS:
+        if data.startswith(bom):
+            return encoding
+
+    try:
+        data.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+
+    best, best_score = None, None
+    for encoding in encodings:
+        try:
+            score = _score(data.decode(encoding))
+        except (UnicodeDecodeError, LookupError):
+            continue
+        if best_score is None or score > best_score:
+            best, best_score = encoding, score
+
+    if best is None:
+        raise ValueError('Could not detect encoding, tried {}'.format(', '.join(encodings)))
+    return best
+
+
+def _rewrite(path, transform):
+    """
+    Rewrite a file through the given transform, which reads the original and
+    writes to a temporary file in the same directory. The temporary file then
+    replaces the original (keeping its mode), so it's never left half-done.
+
+    :param path: file name
+    :param transform: function receiving input and output binary files
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    with open(path, 'rb') as in_file, \
+            tempfile.NamedTemporaryFile('wb', dir=directory, suffix='.tmp', delete=False) as out_file:
+        try:
+            transform(in_file, out_file)
+        except BaseException:
+            out_file.close()
+            os.remove(out_file.name)
+            raise
+
+    shutil.copymode(path, out_file.name)
+    os.replace(out_file.name, path)
+
+
+def recode_file(path, encoding):
+    """
+    Recode a subtitles file from the given encoding to UTF-8 in place, in
+    chunks (in constant memory). Any byte order mark is dropped.
+
+    :param path: subtitles file name
+    :param encoding: current encoding
+    """
+    def recode(in_file, out_file):
+        decoder = codecs.getincrementaldecoder(encoding)()
+        for chunk in iter(lambda: in_file.read(CHUNK_SIZE), b''):
+            out_file.write(decoder.decode(chunk).encode('utf-8'))
+        out_file.write(decoder.decode(b'', final=True).encode('utf-8'))
+
+    _rewrite(path, recode)
+
+
+def strip_tags(lines):
+    """
+    Strip tags from the text lines of an SRT file, keeping cue numbers,
+    timings and blank lines (which separate cues) as they are.
+
+    Lines are bytes, with their line endings: tags are ASCII, so this works
+    with any ASCII-compatible encoding (UTF-8, ISO-8859-1, etc) without
+    decoding. Text lines left empty by stripping are dropped, so they're not
+    mistaken for the end of the cue.
+
+    :param lines: iterable of lines (bytes)
+    :return: generator of cleaned lines
+    """
+    for line in lines:
+        if TIMING.match(line) or not line.strip():
+            yield line
+            continue
+
+        cleaned = TAGS.sub(b'', line)
+        if cleaned.strip():
+            yield cleaned
+
+
+def clean_file(path):
+    """
+    Strip tags from an SRT file in place, line by line (in constant memory,
+    however large it is).
+
+    :param path: subtitle file name
+    """
+    _rewrite(path, lambda in_file, out_file: out_file.writelines(strip_tags(in_file)))
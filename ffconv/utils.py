@@ -1,30 +1,455 @@
 """
 Utility functions used by processors.
 """
+import asyncio
+import functools
 import logging
+import os
+import re
+import shutil
 import subprocess
+import threading
+import time
+from collections import deque
 from subprocess import CalledProcessError
 
 
-def execute_cmd(cmd):
+# Size of reads from process pipes
+CHUNK_SIZE = 64 * 1024
+
+# Number of log lines kept for error reports
+TAIL_LINES = 50
+
+# Line separators in logs (ffmpeg uses carriage returns for its stats)
+LINE_SEP = re.compile(b'[\r\n]')
+
+
+class LineSplitter(object):
+    """
+    Splitter of chunks of a log into lines, on new lines and carriage
+    returns, skipping empty ones.
+    """
+
+    def __init__(self):
+        """
+        Set placeholder for the incomplete last line.
+        """
+        self.pending = b''
+
+    def feed(self, chunk):
+        """
+        Add a chunk, returning the lines it completed.
+
+        :param chunk: bytes read
+        :return: list of lines (bytes, without separators)
+        """
+        lines = LINE_SEP.split(self.pending + chunk)
+        self.pending = lines.pop()
+        return [line for line in lines if line]
+
+    def flush(self):
+        """
+        Get the last line, if not empty (at the end of the log).
+
+        :return: list of lines
+        """
+        lines, self.pending = [self.pending] if self.pending else [], b''
+        return lines
+
+
+def iter_lines(stream, chunk_size=CHUNK_SIZE):
+    """
+    Read lines from a binary stream in large chunks, splitting on new lines
+    and carriage returns, skipping empty ones.
+
+    :param stream: binary file object (eg, a process pipe)
+    :param chunk_size: maximum size of each read
+    :return: generator of lines (bytes, without separators)
+    """
+    splitter = LineSplitter()
+    for chunk in iter(lambda: stream.read1(chunk_size), b''):
+        yield from splitter.feed(chunk)
+    yield from splitter.flush()
+
+
+class CommandStopped(Exception):
+    """
+    Raised when a command is killed because it was asked to stop (eg,
+    because a sibling command failed).
+    """
+
+
+class LogError(ValueError):
+    """
+    Raised when a command logs an error (the command is killed), with the
+    tail of its log up to that line as stderr, just like CalledProcessError.
+    """
+
+    def __init__(self, line, log):
+        super(LogError, self).__init__(line.decode('utf-8', 'replace'))
+        self.stderr = b'\n'.join(log)
+
+
+class ChildEvent(threading.Event):
+    """
+    Stop event for a group of commands, which is also set when its parent
+    is (eg, the caller's), while setting it does not set the parent. So a
+    failure stops the group without stopping everything else.
+    """
+
+    def __init__(self, parent=None, interval=0.2):
+        super(ChildEvent, self).__init__()
+        self.parent = parent
+        self.interval = interval
+
+    def is_set(self):
+        return super(ChildEvent, self).is_set() or \
+            (self.parent is not None and self.parent.is_set())
+
+    def wait(self, timeout=None):
+        # Wake up every interval to check the parent
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.is_set():
+            remaining = self.interval if deadline is None else min(self.interval, deadline - time.monotonic())
+            if remaining <= 0:
+                return False
+            super(ChildEvent, self).wait(remaining)
+        return True
+
+
+def _kill_on_stop(process, stop, interval=0.2):
+    """
+    Wait until the process ends, killing it if the stop event is set.
+    """
+    while process.poll() is None:
+        if stop.wait(interval):
+            process.kill()
+            return
+
+
+def parse_cpus(spec):
+    """
+    Parse a list of CPUs, as in taskset (eg, "0-3,6").
+
+    :param spec: comma-separated CPU numbers or ranges
+    :return: set of CPU numbers
+    """
+    cpus = set()
+    for part in spec.split(','):
+        first, _, last = part.strip().partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def cpu_budget(jobs=1, affinity=None):
+    """
+    Get the number of CPUs for each of the given number of jobs running at
+    once, out of the ones available (or the given affinity).
+
+    :param jobs: number of jobs sharing the CPUs
+    :param affinity: set of CPUs the jobs are restricted to
+    :return: number of CPUs (at least 1)
+    """
+    if affinity:
+        cpus = len(affinity)
+    elif hasattr(os, 'sched_getaffinity'):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    return max(1, cpus // max(1, jobs))
+
+
+def cpu_limiter(nice=None, affinity=None):
     """
-    Wrapper around subprocess' Popen/communicate usage pattern, capturing
-    output and errors (which are raised).
+    Build the prefix for commands that sets their niceness increment and CPU
+    affinity, with nice and taskset (so nothing runs in the child process
+    between fork and exec, which is not safe with threads running).
 
-    :param cmd: shell command as string
+    :param nice: niceness increment
+    :param affinity: set of CPUs
+    :return: list of strings (empty if there's nothing to set)
+    """
+    prefix = []
+    if nice:
+        prefix += ['nice', '-n', str(nice)]
+    if affinity:
+        prefix += ['taskset', '-c', ','.join(str(cpu) for cpu in sorted(affinity))]
+    return prefix
+
+
+def _read_all(stream, chunks, chunk_size=CHUNK_SIZE):
+    """
+    Read a binary stream until the end, appending chunks to the given list.
+    """
+    chunks.extend(iter(lambda: stream.read1(chunk_size), b''))
+
+
+def process_io(pid):
+    """
+    Get the I/O counters of a finished child process, from /proc (Linux
+    only), before it's reaped: bytes read (rchar, including from cache and
+    network filesystems) and bytes read from storage (read_bytes).
+
+    :param pid: process id (waited for to exit, without reaping it)
+    :return: dict with the counters (empty if not available)
+    """
+    try:
+        if hasattr(os, 'waitid'):
+            os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+        with open('/proc/{}/io'.format(pid)) as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+    except (OSError, ValueError):
+        return {}
+    return {key: int(counters[key]) for key in ('rchar', 'read_bytes') if key in counters}
+
+
+def execute_cmd(cmd, on_line=None, tail=TAIL_LINES, stop=None, io_stats=None):
+    """
+    Wrapper around subprocess' Popen usage pattern, capturing output and
+    errors (which are raised).
+
+    The output (stdout) is captured unmodified, while the log (stderr) is
+    read line by line, passing each line to on_line (if given) and keeping
+    only the last ones for error reports.
+
+    :param cmd: command as list of strings
+    :param on_line: callback for each log line (as unicode)
+    :param tail: number of log lines kept for error reports
+    :param stop: event that kills the command when set (threading.Event)
+    :param io_stats: dict updated with the I/O counters of the command, if
+                     available (see process_io)
     :return: output of command as unicode
     """
-    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT) as process:
-        output = b''
-        for line in iter(process.stdout.readline, b''):
-            if b'Error' in line:
-                raise ValueError(line.decode('utf-8'))
-            else:
-                output += line
+    if stop is not None and stop.is_set():
+        raise CommandStopped('Not running {}, stopped'.format(cmd[0]))
 
-        retcode = process.poll()
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as process:
+        # Capture output in another thread, so neither pipe blocks the other
+        chunks = []
+        reader = threading.Thread(target=_read_all, args=(process.stdout, chunks))
+        reader.start()
+
+        # Watch stop event in another thread too, if given
+        if stop is not None:
+            threading.Thread(target=_kill_on_stop, args=(process, stop), daemon=True).start()
+
+        log = deque(maxlen=tail)
+        try:
+            for line in iter_lines(process.stderr):
+                log.append(line)
+                if b'Error' in line:
+                    raise LogError(line, log)
+                if on_line:
+                    on_line(line.decode('utf-8', 'replace'))
+
+        except BaseException:
+            # Failed (or interrupted), do not leave the process running
+            process.kill()
+            raise
+
+        finally:
+            reader.join()
+
+        output = b''.join(chunks)
+        if io_stats is not None:
+            io_stats.update(process_io(process.pid))
+        retcode = process.wait()
+        if stop is not None and stop.is_set():
+            raise CommandStopped('Killed {}, stopped'.format(cmd[0]))
         if retcode:
-            raise CalledProcessError(retcode, process.args, output=output)
+            raise CalledProcessError(retcode, process.args, output=output,
+                                     stderr=b'\n'.join(log))
+
+    # All good, decode output and return it
+    return output.decode('utf-8')
+
+
+async def _read_log_async(stream, log, on_line=None, chunk_size=CHUNK_SIZE):
+    """
+    Read a log from an asyncio stream in large chunks, keeping lines in the
+    given log (a bounded deque) and passing them to on_line (if given).
+    Lines with errors raise a LogError.
+    """
+    splitter = LineSplitter()
+    while True:
+        chunk = await stream.read(chunk_size)
+        lines = splitter.feed(chunk) if chunk else splitter.flush()
+        for line in lines:
+            log.append(line)
+            if b'Error' in line:
+                raise LogError(line, log)
+            if on_line:
+                on_line(line.decode('utf-8', 'replace'))
+        if not chunk:
+            return
+
+
+async def _popen_async(cmd):
+    """
+    Start a command with subprocess instead of as an asyncio subprocess, so
+    the event loop does not reap it as soon as it exits (see process_io),
+    reading its pipes with asyncio.
+
+    :param cmd: command as list of strings
+    :return: Popen instance, and stream readers for its output and log
+    """
+    loop = asyncio.get_running_loop()
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    readers = []
+    for pipe in (process.stdout, process.stderr):
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(lambda reader=reader: asyncio.StreamReaderProtocol(reader), pipe)
+        readers.append(reader)
+    return process, readers
+
+
+def _wait_io(process, io_stats):
+    """
+    Wait for a Popen process, updating io_stats with its I/O counters right
+    before reaping it.
+    """
+    io_stats.update(process_io(process.pid))
+    return process.wait()
+
+
+async def execute_cmd_async(cmd, on_line=None, tail=TAIL_LINES, timeout=None,
+                            io_stats=None):
+    """
+    Asyncio version of execute_cmd, which runs the command as an asyncio
+    subprocess so many of them can be supervised by a single event loop.
+
+    If the command fails, times out or is cancelled the process is killed.
+
+    :param cmd: command as list of strings
+    :param on_line: callback for each log line (as unicode)
+    :param tail: number of log lines kept for error reports
+    :param timeout: maximum time in seconds (None to wait forever)
+    :param io_stats: dict updated with the I/O counters of the command, if
+                     available (see process_io). The event loop reaps its
+                     subprocesses as soon as they exit, so these commands are
+                     started with subprocess instead and waited for in a
+                     thread (see _popen_async)
+    :return: output of command as unicode
+    """
+    if io_stats is None:
+        process = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        stdout, stderr = process.stdout, process.stderr
+        wait, reap = process.wait, process.wait
+    else:
+        process, (stdout, stderr) = await _popen_async(cmd)
+        wait = functools.partial(asyncio.to_thread, _wait_io, process, io_stats)
+        reap = functools.partial(asyncio.to_thread, process.wait)
+
+    log = deque(maxlen=tail)
+    try:
+        output, _ = await asyncio.wait_for(asyncio.gather(
+            stdout.read(), _read_log_async(stderr, log, on_line)),
+            timeout)
+        retcode = await wait()
+
+    except BaseException:
+        # Failed, timed out or cancelled, do not leave the process running
+        if process.returncode is None:
+            process.kill()
+            await reap()
+        raise
+
+    if retcode:
+        raise CalledProcessError(retcode, cmd, output=output,
+                                 stderr=b'\n'.join(log))
 
     # All good, decode output and return it
-    return output.decode('utf-8').lower()
+    return output.decode('utf-8')
+
+
+def remove_files(paths):
+    """
+    Remove the given files, ignoring those that don't exist.
+
+    :param paths: file names
+    """
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def link_or_copy(src, dst):
+    """
+    Hard link a file, or copy it if linking is not possible (eg, across
+    filesystems). An existing destination is replaced.
+
+    :param src: source file name
+    :param dst: destination file name
+    """
+    tmp = '{}.ffconv-link'.format(dst)
+    try:
+        os.link(src, tmp)
+        os.replace(tmp, dst)
+    except OSError:
+        remove_files([tmp])
+        shutil.copy2(src, dst)
+
+
+def fingerprint(path, inode=False):
+    """
+    Get the identity of a file, which changes whenever the file is modified
+    or replaced: real path, size and modification time (and inode, if
+    requested).
+
+    :param path: file name
+    :param inode: whether to include the inode
+    :return: tuple with path, size, mtime (ns) and inode (0 if not included)
+    """
+    stat = os.stat(path)
+    return (os.path.realpath(path), stat.st_size, stat.st_mtime_ns,
+            stat.st_ino if inode else 0)
+
+
+def stream_duration(stream):
+    """
+    Get the duration of a stream in seconds, from its data or its tags
+    (matroska sets it as a tag, like "01:02:03.456000000").
+
+    :param stream: stream data as probed
+    :return: duration in seconds (None if unknown)
+    """
+    if stream.get('duration'):
+        return float(stream['duration'])
+
+    tags = {k.lower(): v for k, v in stream.get('tags', {}).items()}
+    if tags.get('duration'):
+        seconds = 0.0
+        for part in tags['duration'].split(':'):
+            seconds = seconds * 60 + float(part)
+        return seconds
+
+
+def file_duration(streams):
+    """
+    Get the duration of a file in seconds, which is the longest of its
+    streams.
+
+    :param streams: list of streams data as probed
+    :return: duration in seconds (None if unknown)
+    """
+    durations = [d for d in map(stream_duration, streams) if d]
+    return max(durations) if durations else None
+
+
+def stream_bitrate(stream):
+    """
+    Get the bit rate of a stream in bits per second, from its data or its
+    tags (matroska sets it as the BPS tag).
+
+    :param stream: stream data as probed
+    :return: bit rate (None if unknown)
+    """
+    if stream.get('bit_rate'):
+        return int(stream['bit_rate'])
+
+    tags = {k.lower(): v for k, v in stream.get('tags', {}).items()}
+    if tags.get('bps'):
+        return int(tags['bps'])
@@ -0,0 +1,330 @@
+"""
+This module contains the work queue, which lets workers on several hosts
+share a backlog of files to convert: files are enqueued once, and each
+worker leases them one at a time, keeping the lease alive with heartbeats
+while converting. If a worker dies, its lease expires and another worker
+takes the file over.
+
+The queue is a SQLite database, so it can live on shared storage (eg, a NAS
+mounted on all the hosts) as long as it supports file locks (NFS with lockd,
+SMB). Leases are based on wall clock time, so hosts should be kept in sync
+(eg, with NTP), well within the lease time.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from .batch import output_files, process_file
+from .cache import SQLiteStore
+from .profiles import get_profile
+
+
+class WorkQueue(SQLiteStore):
+    """
+    Queue of file jobs (file, profile and output), keyed by file and profile
+    so files are never queued twice. Jobs go from queued to leased, and then
+    to done or failed (or back to queued if their lease expires or is
+    released).
+    """
+    file_name = 'queue.sqlite'
+    table = 'jobs'
+    schema = ('CREATE TABLE IF NOT EXISTS jobs ('
+              'id INTEGER PRIMARY KEY, path TEXT, profile TEXT, output TEXT, '
+              'state TEXT, worker TEXT, expires REAL, attempts INTEGER, '
+              'result TEXT, enqueued REAL, updated REAL, UNIQUE (path, profile))',
+              'CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, expires)')
+    columns = ('id', 'path', 'profile', 'output', 'state', 'worker', 'expires',
+               'attempts', 'result', 'enqueued', 'updated')
+
+    # Job states
+    QUEUED = 'queued'
+    LEASED = 'leased'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, queue_dir=None, max_attempts=3):
+        """
+        Set database file name and maximum number of leases of a job (those
+        that expire count, so a file that kills its workers is given up).
+        """
+        super(WorkQueue, self).__init__(queue_dir)
+        self.max_attempts = max_attempts
+
+    def _transaction(self):
+        """
+        Open a connection and start a write transaction right away, so
+        reading and updating jobs is atomic among all workers.
+        """
+        conn = self._connect()
+        conn.isolation_level = None
+        conn.execute('BEGIN IMMEDIATE')
+        return conn
+
+    def enqueue(self, paths, profile, output_dir=None, names=None):
+        """
+        Add jobs for the given files, unless already queued with the profile.
+        Failed jobs are queued again.
+
+        :param paths: file names
+        :param profile: profile name
+        :param output_dir: directory for the outputs (None to replace inputs)
+        :param names: names of the outputs relative to the output directory
+                      (see batch.output_files)
+        :return: number of jobs added
+        """
+        now = time.time()
+        jobs = []
+        for path, output in output_files(paths, output_dir, names).items():
+            # Paths are absolute, workers on other hosts run elsewhere
+            output = os.path.abspath(output) if output is not None else None
+            jobs.append((os.path.abspath(path), profile, output, self.QUEUED, now, now))
+
+        conn = self._transaction()
+        try:
+            added = 0
+            for job in jobs:
+                added += conn.execute('INSERT OR IGNORE INTO jobs '
+                                      '(path, profile, output, state, attempts, enqueued, updated) '
+                                      'VALUES (?, ?, ?, ?, 0, ?, ?)', job).rowcount
+                added += conn.execute('UPDATE jobs SET output = ?, state = ?, attempts = 0, '
+                                      'result = NULL, updated = ? '
+                                      'WHERE path = ? AND profile = ? AND state = ?',
+                                      (job[2], self.QUEUED, now, job[0], job[1], self.FAILED)).rowcount
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+        return added
+
+    def claim(self, worker, lease_time):
+        """
+        Lease the next job (queued, or leased by a worker that stopped
+        sending heartbeats) to the given worker. Jobs whose leases expired too
+        many times are failed instead.
+
+        :param worker: worker name
+        :param lease_time: lease time in seconds
+        :return: job data (None if there's nothing to do)
+        """
+        now = time.time()
+        conn = self._transaction()
+        try:
+            conn.execute('UPDATE jobs SET state = ?, result = ?, updated = ? '
+                         'WHERE state = ? AND expires < ? AND attempts >= ?',
+                         (self.FAILED, json.dumps({'error': 'Lease expired {} times'.format(self.max_attempts)}),
+                          now, self.LEASED, now, self.max_attempts))
+            row = conn.execute('SELECT id FROM jobs WHERE state = ? OR (state = ? AND expires < ?) '
+                               'ORDER BY id LIMIT 1', (self.QUEUED, self.LEASED, now)).fetchone()
+            if row is not None:
+                conn.execute('UPDATE jobs SET state = ?, worker = ?, expires = ?, '
+                             'attempts = attempts + 1, updated = ? WHERE id = ?',
+                             (self.LEASED, worker, now + lease_time, now, row[0]))
+                row = conn.execute('SELECT * FROM jobs WHERE id = ?', row).fetchone()
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+        return dict(zip(self.columns, row)) if row else None
+
+    def heartbeat(self, job_id, worker, lease_time):
+        """
+        Extend the lease of a job, if the worker still holds it.
+
+        :param job_id: job id
+        :param worker: worker name
+        :param lease_time: lease time in seconds (from now)
+        :return: whether the worker still holds the lease
+        """
+        now = time.time()
+        return self._update_leased(job_id, worker, 'expires = ?, updated = ?',
+                                   (now + lease_time, now))
+
+    def complete(self, job_id, worker, result):
+        """
+        Record the result of a job, as done or failed (if it has an error),
+        if the worker still holds its lease.
+
+        :param job_id: job id
+        :param worker: worker name
+        :param result: result data
+        :return: whether the worker still held the lease
+        """
+        state = self.FAILED if result.get('error') else self.DONE
+        return self._update_leased(job_id, worker, 'state = ?, result = ?, updated = ?',
+                                   (state, json.dumps(result), time.time()))
+
+    def release(self, job_id, worker):
+        """
+        Give a job back to the queue (eg, when a worker is stopped), so other
+        workers take it without waiting for the lease to expire.
+
+        :param job_id: job id
+        :param worker: worker name
+        :return: whether the worker still held the lease
+        """
+        return self._update_leased(job_id, worker,
+                                   'state = ?, attempts = attempts - 1, updated = ?',
+                                   (self.QUEUED, time.time()))
+
+    def _update_leased(self, job_id, worker, assignments, params):
+        """
+        Update a leased job, only if leased by the given worker.
+        """
+        conn = self._connect()
+        try:
+            with conn:
+                return conn.execute('UPDATE jobs SET {} WHERE id = ? AND state = ? AND worker = ?'.format(assignments),
+                                    params + (job_id, self.LEASED, worker)).rowcount == 1
+        finally:
+            conn.close()
+
+    def get(self, job_id):
+        """
+        Get a job by id.
+
+        :param job_id: job id
+        :return: job data (None if not found)
+        """
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        finally:
+            conn.close()
+        return dict(zip(self.columns, row)) if row else None
+
+    def stats(self):
+        """
+        Count jobs by state.
+
+        :return: dict of states and counts
+        """
+        conn = self._connect()
+        try:
+            rows = conn.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall()
+        finally:
+            conn.close()
+        return dict(rows)
+
+
+class Worker(object):
+    """
+    Worker that converts files leased from a work queue, one at a time, until
+    the queue is empty (or forever, if waiting for more). While converting,
+    a thread sends heartbeats to keep the lease; if the lease is lost (eg,
+    the host was suspended and another worker took the file over), the
+    conversion is stopped.
+    """
+
+    def __init__(self, queue, name=None, lease_time=120, poll_interval=10,
+                 wait=False, max_jobs=None, profile_dirs=None, **kwargs):
+        """
+        Set queue, worker name, lease time, polling, limits, directories for
+        profile files and options for the file processors.
+        """
+        self.queue = queue
+        self.profile_dirs = profile_dirs
+        self.name = name or '{}:{}'.format(os.uname().nodename, os.getpid())
+        self.lease_time = lease_time
+        self.poll_interval = poll_interval
+        self.wait = wait
+        self.max_jobs = max_jobs
+        self.options = kwargs
+        self.results = []
+        self.logger = logging.getLogger()
+
+    def __str__(self):
+        return 'Worker <{}>'.format(self.name)
+
+    def run(self):
+        """
+        Process jobs until there are no more (or max_jobs are done).
+
+        :return: list of results
+        """
+        self.collect_garbage()
+        while self.max_jobs is None or len(self.results) < self.max_jobs:
+            job = self.queue.claim(self.name, self.lease_time)
+            if job is None:
+                if not self.wait:
+                    break
+                time.sleep(self.poll_interval)
+                continue
+
+            if job['attempts'] > 1:
+                # Taken over from a worker that stopped sending heartbeats,
+                # remove what it left (if it was on this host)
+                self.collect_garbage()
+
+            res = self.process_job(job)
+            if res is not None:
+                self.results.append(res)
+        return self.results
+
+    def collect_garbage(self):
+        """
+        Remove orphan jobs left by interrupted runs that cannot be resumed
+        (see BatchProcessor.collect_garbage).
+        """
+        journal = self.options.get('journal')
+        if journal is not None:
+            removed = journal.collect_garbage()
+            if removed:
+                self.logger.debug('{}: removed {} orphan jobs'.format(self, removed))
+
+    def process_job(self, job):
+        """
+        Process a leased job, sending heartbeats while at it, and record its
+        result. If the worker is interrupted the job is released.
+
+        :param job: job data
+        :return: result data (None if the lease was lost)
+        """
+        self.logger.debug('{}: processing {} ({})'.format(self, job['path'], job['profile']))
+        try:
+            # Profile files are only parsed again if they changed
+            profile = get_profile(job['profile'], self.profile_dirs)
+
+        except ValueError as e:
+            # Not found or not valid, fail right away
+            res = {'input': job['path'], 'error': str(e), 'time': 0}
+            return res if self.queue.complete(job['id'], self.name, res) else None
+
+        stop = threading.Event()
+        done = threading.Event()
+        heartbeats = threading.Thread(target=self._send_heartbeats, args=(job, stop, done), daemon=True)
+        heartbeats.start()
+        try:
+            res = process_file(job['path'], job['output'], profile, stop=stop, **self.options)
+
+        except BaseException:
+            # Interrupted, let others take it
+            self.queue.release(job['id'], self.name)
+            raise
+
+        finally:
+            done.set()
+            heartbeats.join()
+
+        if not self.queue.complete(job['id'], self.name, res):
+            self.logger.debug('{}: lost lease of {}'.format(self, job['path']))
+            return None
+        return res
+
+    def _send_heartbeats(self, job, stop, done):
+        """
+        Extend the lease of the job periodically until done, setting the stop
+        event if it's lost.
+        """
+        while not done.wait(self.lease_time / 4):
+            try:
+                held = self.queue.heartbeat(job['id'], self.name, self.lease_time)
+            except sqlite3.Error as e:
+                # Queue busy or storage unreachable, try again on next beat
+                self.logger.debug('{}: heartbeat failed: {}'.format(self, e))
+                continue
+
+            if not held:
+                stop.set()
+                return
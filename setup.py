@@ -43,11 +43,13 @@ setup(
     ],
 
     keywords='media conversion streaming roku',
-    packages=find_packages(exclude=['contrib', 'docs', 'tests*']),
+    packages=find_packages(exclude=['contrib', 'docs', 'tests*', 'benchmarks*']),
 
     # https://packaging.python.org/en/latest/requirements.html
     install_requires=[],
-    extras_require={},
+    extras_require={
+        'yaml': ['PyYAML'],
+    },
     package_data={},
 
     # http://docs.python.org/3.4/distutils/setupscript.html#installing-additional-files # noqa
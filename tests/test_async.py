@@ -0,0 +1,228 @@
+__author__ = 'kako'
+
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+
+from unittest import IsolatedAsyncioTestCase, skipUnless
+from unittest.mock import patch, AsyncMock, MagicMock
+
+from ffconv.batch import BatchProcessor
+from ffconv.file_processor import FileProcessor
+from ffconv.utils import execute_cmd_async
+
+
+STREAMS = [
+    {'index': 0, 'codec_type': 'video', 'codec_name': 'h264', 'refs': 4, 'height': 720},
+    {'index': 1, 'codec_type': 'audio', 'codec_name': 'aac', 'channels': 6, 'tags': {'language': 'eng'}},
+    {'index': 2, 'codec_type': 'subtitle', 'codec_name': 'ass', 'tags': {'language': 'spa'}},
+]
+
+
+class ExecuteCommandAsyncTest(IsolatedAsyncioTestCase):
+
+    @staticmethod
+    def _python(code):
+        return [sys.executable, '-c', code]
+
+    async def test_output(self):
+        # Output is returned unmodified, log lines go to callback
+        lines = []
+        cmd = self._python('import sys; print("{\\"Streams\\": []}"); sys.stderr.write("frame=1\\rframe=2\\n")')
+        output = await execute_cmd_async(cmd, on_line=lines.append)
+        self.assertEqual(output.strip(), '{"Streams": []}')
+        self.assertEqual(lines, ['frame=1', 'frame=2'])
+
+    async def test_errors(self):
+        # Return value 1, raise CalledProcessError with log tail
+        cmd = self._python('import sys; sys.stderr.write("one\\ntwo\\nthree\\n"); sys.exit(1)')
+        with self.assertRaises(subprocess.CalledProcessError) as ctx:
+            await execute_cmd_async(cmd, tail=2)
+        self.assertEqual(ctx.exception.stderr, b'two\nthree')
+
+        # Errors in log, raise ValueError
+        cmd = self._python('import sys, time; sys.stderr.write("Error opening file\\n"); sys.stderr.flush(); time.sleep(10)')
+        with self.assertRaises(ValueError):
+            await asyncio.wait_for(execute_cmd_async(cmd), 5)
+
+        # Timeout, process is killed
+        cmd = self._python('import time; time.sleep(10)')
+        with self.assertRaises(asyncio.TimeoutError):
+            await execute_cmd_async(cmd, timeout=0.1)
+
+        # Same with I/O counters
+        with self.assertRaises(asyncio.TimeoutError):
+            await execute_cmd_async(cmd, timeout=0.1, io_stats={})
+
+    @skipUnless(os.path.exists('/proc/self/io'), 'needs /proc I/O counters')
+    async def test_io_stats(self):
+        # Bytes read by the command, counted before it's reaped (every time)
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b'x' * 100000)
+            f.flush()
+            for _ in range(10):
+                io_stats = {}
+                output = await execute_cmd_async(['cat', f.name], io_stats=io_stats)
+                self.assertEqual(len(output), 100000)
+                self.assertGreaterEqual(io_stats['rchar'], 100000)
+
+        # Failures are still raised
+        cmd = self._python('import sys; sys.stderr.write("one\\n"); sys.exit(1)')
+        with self.assertRaises(subprocess.CalledProcessError) as ctx:
+            await execute_cmd_async(cmd, io_stats={})
+        self.assertEqual(ctx.exception.stderr, b'one')
+
+
+class FileProcessorAsyncTest(IsolatedAsyncioTestCase):
+
+    @patch('ffconv.stream_processors.SubtitleProcessor.clean_up', MagicMock())
+    @patch('ffconv.stream_processors.SubtitleProcessor.recode', MagicMock(return_value=False))
+    @patch('ffconv.stream_processors.execute_cmd_async', new_callable=AsyncMock)
+    @patch('ffconv.file_processor.execute_cmd_async', new_callable=AsyncMock)
+    @patch('ffconv.file_processor.execute_cmd', MagicMock())
+    @patch('ffconv.file_processor.os.replace', MagicMock())
+    async def test_process(self, file_ecmd, stream_ecmd):
+        file_ecmd.return_value = '{"streams": %s}' % str(STREAMS).replace("'", '"')
+
+        # Multi-pass, probe, convert audio and subtitle, then merge
+        processor = FileProcessor('Se7en.mkv', 'seven.mkv', 'roku')
+        res = await processor.process_async()
+        self.assertEqual(res, {'streams': 3, 'output': 'seven.mkv'})
+        self.assertEqual(file_ecmd.call_count, 2)
+        self.assertEqual(file_ecmd.call_args_list[0][0][0][0], 'ffprobe')
+        self.assertTrue(file_ecmd.call_args_list[1][0][0][-1].startswith('.seven.mkv.ffconv-'))
+        self.assertEqual(stream_ecmd.call_count, 2)
+        file_ecmd.reset_mock()
+
+        # Single pass, one command
+        processor = FileProcessor('Se7en.mkv', 'seven.mkv', 'roku', single_pass=True)
+        res = await processor.process_async(STREAMS)
+        self.assertEqual(res, {'streams': 3, 'output': 'seven.mkv'})
+        self.assertEqual(file_ecmd.call_count, 1)
+
+        # Failure, error is raised
+        file_ecmd.side_effect = ValueError('Something failed')
+        processor = FileProcessor('Se7en.mkv', 'seven.mkv', 'roku', single_pass=True)
+        with self.assertRaises(ValueError):
+            await processor.process_async(STREAMS)
+
+    @patch('ffconv.stream_processors.SubtitleProcessor.clean_up', MagicMock())
+    @patch('ffconv.stream_processors.SubtitleProcessor.recode', MagicMock(return_value=False))
+    @patch('ffconv.stream_processors.execute_cmd_async', new_callable=AsyncMock)
+    @patch('ffconv.file_processor.execute_cmd_async', new_callable=AsyncMock)
+    @patch('ffconv.file_processor.os.replace', MagicMock())
+    async def test_process_threads(self, file_ecmd, stream_ecmd):
+        # Verdict index, journal and work directory (slow on network
+        # filesystems) are used from threads
+        threads = []
+        record = lambda *args, **kwargs: threads.append(threading.current_thread())
+        verdict_index = MagicMock(COMPLIANT='compliant', CONVERTED='converted')
+        verdict_index.get.side_effect = lambda *args: record() or None
+        journal = MagicMock()
+        journal.resume.side_effect = lambda *args: record() or None
+        for method in ('start', 'update', 'add_stream', 'finish'):
+            getattr(journal, method).side_effect = record
+
+        processor = FileProcessor('Se7en.mkv', 'seven.mkv', 'roku', verdict_index=verdict_index,
+                                  journal=journal)
+        with patch.object(FileProcessor, 'remove_work_dir', side_effect=record):
+            await processor.process_async(STREAMS)
+        self.assertEqual(journal.add_stream.call_count, 2)
+        self.assertEqual(len(threads), 10)
+        self.assertNotIn(threading.main_thread(), threads)
+
+    @patch('ffconv.file_processor.execute_cmd_async')
+    async def test_process_cancelled(self, file_ecmd):
+        async def transcode(cmd, **kwargs):
+            open(cmd[-1], 'w').close()
+            await asyncio.sleep(10)
+
+        # Timed out, partial output next to the destination is removed with
+        # the work directory
+        file_ecmd.side_effect = transcode
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            in_file = os.path.join(tmp_dir, 'Se7en.mkv')
+            open(in_file, 'w').close()
+            scratch_root = os.path.join(tmp_dir, 'scratch')
+            processor = FileProcessor(in_file, None, 'roku', single_pass=True,
+                                      scratch_root=scratch_root)
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(processor.process_async(STREAMS), 0.2)
+            self.assertEqual(sorted(os.listdir(tmp_dir)), ['Se7en.mkv', 'scratch'])
+            self.assertEqual(os.listdir(scratch_root), [])
+
+    @patch('ffconv.stream_processors.AudioProcessor.process_async', new_callable=AsyncMock)
+    async def test_process_stream_cache(self, audio_process):
+        # Stream cache (which may copy big files) is used from threads
+        threads = []
+        stream_cache = MagicMock()
+        stream_cache.key.return_value = 'key'
+        stream_cache.get.side_effect = lambda *args: threads.append(threading.current_thread()) or None
+        stream_cache.set.side_effect = lambda *args: threads.append(threading.current_thread())
+        audio_process.return_value = {'input': 'audio-1.m4a', 'index': 1}
+
+        processor = FileProcessor('Se7en.mkv', 'seven.mkv', 'roku', stream_cache=stream_cache)
+        audio = processor.get_processors(STREAMS)[1]
+        res = await processor._process_stream_async(audio)
+        self.assertEqual(res['input'], 'audio-1.m4a')
+        stream_cache.set.assert_called_once_with('key', 'Se7en.mkv', res)
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.main_thread(), threads)
+
+    @patch('ffconv.stream_processors.SubtitleProcessor.clean_up', MagicMock())
+    @patch('ffconv.stream_processors.SubtitleProcessor.recode', MagicMock(return_value=False))
+    @patch('ffconv.stream_processors.execute_cmd_async', new_callable=AsyncMock)
+    async def test_process_streams_parallel(self, stream_ecmd):
+        # Streams converted concurrently, results in order
+        processor = FileProcessor('Se7en.mkv', 'seven.mkv', 'roku', stream_jobs=3)
+        res = await processor.process_streams_async(STREAMS)
+        self.assertIsNone(processor.error)
+        self.assertEqual([r['input'] for r in res], ['Se7en.mkv', 'audio-1.m4a', 'subtitle-2.srt'])
+
+        # One fails, the others are cancelled and the error kept
+        async def convert(cmd, **kwargs):
+            if cmd[-1].startswith('audio'):
+                raise ValueError('Could not convert audio')
+            await asyncio.sleep(10)
+
+        stream_ecmd.side_effect = convert
+        processor = FileProcessor('Se7en.mkv', 'seven.mkv', 'roku', stream_jobs=3)
+        res = await asyncio.wait_for(processor.process_streams_async(STREAMS), 5)
+        self.assertEqual(type(processor.error), ValueError)
+        self.assertEqual(len(res), 1)
+
+
+class BatchProcessorAsyncTest(IsolatedAsyncioTestCase):
+
+    @patch('ffconv.file_processor.FileProcessor.process_async')
+    @patch('ffconv.file_processor.FileProcessor.probe_async', new_callable=AsyncMock)
+    async def test_process(self, probe, process):
+        probe.return_value = STREAMS
+        running = {'now': 0, 'max': 0}
+
+        async def fake_process(streams):
+            running['now'] += 1
+            running['max'] = max(running['max'], running['now'])
+            await asyncio.sleep(0.01)
+            running['now'] -= 1
+            return {'streams': len(streams), 'output': None}
+
+        # All files processed, within concurrency limits
+        process.side_effect = fake_process
+        processor = BatchProcessor(['{}.mkv'.format(i) for i in range(6)], 'roku', jobs=2)
+        res = await processor.process_async()
+        self.assertEqual([r['input'] for r in res], ['{}.mkv'.format(i) for i in range(6)])
+        self.assertEqual(processor.failures, [])
+        self.assertEqual(running['max'], 2)
+
+        # Timed out, failed
+        async def slow_process(streams):
+            await asyncio.sleep(10)
+
+        process.side_effect = slow_process
+        processor = BatchProcessor(['a.mkv'], 'roku')
+        res = await processor.process_async(timeout=0.01)
+        self.assertEqual(res[0]['error'], 'Timed out after 0.01s')
@@ -0,0 +1,164 @@
+__author__ = 'kako'
+
+import os
+import tempfile
+
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+
+from ffconv import profiles
+from ffconv.batch import BatchProcessor, collect_files, output_files, read_list, process_file, walk_paths
+
+
+class CollectFilesTest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = self.tmp_dir.name
+        for name in ['a.mkv', 'b.MP4', 'notes.txt', 'Film [1080p].mkv',
+                     os.path.join('season', 'e01.mkv'), os.path.join('season', 'e01.srt')]:
+            path = os.path.join(self.root, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'w').close()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_collect(self):
+        join = lambda *names: os.path.join(self.root, *names)
+
+        # Directory, walk it and keep only media files
+        files = collect_files([self.root])
+        self.assertEqual(files, [join('Film [1080p].mkv'), join('a.mkv'), join('b.MP4'),
+                                 join('season', 'e01.mkv')])
+
+        # Explicit files (even with glob characters) and patterns, no duplicates
+        files = collect_files([join('Film [1080p].mkv'), join('notes.txt'), join('*.mkv')])
+        self.assertEqual(files, [join('Film [1080p].mkv'), join('notes.txt'), join('a.mkv')])
+
+        # Missing file, error
+        self.assertRaises(ValueError, collect_files, [join('missing.mkv')])
+
+    def test_outputs(self):
+        join = lambda *names: os.path.join(self.root, *names)
+        os.makedirs(join('other'))
+        open(join('other', 'e01.mkv'), 'w').close()
+
+        # Walked files keep their names relative to their directory
+        files = walk_paths([join('season'), join('other'), join('a.mkv')])
+        self.assertEqual(files, [(join('season', 'e01.mkv'), 'e01.mkv'),
+                                 (join('other', 'e01.mkv'), 'e01.mkv'), (join('a.mkv'), 'a.mkv')])
+        files = walk_paths([self.root])
+        outputs = output_files([f for f, _ in files], '/out', dict(files))
+        self.assertEqual(outputs[join('season', 'e01.mkv')], '/out/season/e01.mkv')
+        self.assertEqual(outputs[join('other', 'e01.mkv')], '/out/other/e01.mkv')
+
+        # Same name in the output directory, error before starting
+        files = walk_paths([join('season'), join('other')])
+        self.assertRaises(ValueError, output_files, [f for f, _ in files], '/out', dict(files))
+
+        # Replacing inputs, no outputs
+        self.assertEqual(output_files([join('a.mkv')], None), {join('a.mkv'): None})
+
+    def test_read_list(self):
+        lines = ['a.mkv\n', '\n', '# comment\n', '  b.mkv  \n']
+        self.assertEqual(read_list(lines), ['a.mkv', 'b.mkv'])
+
+
+class BatchProcessorTest(TestCase):
+
+    @patch('ffconv.batch.FileProcessor')
+    def test_process_file(self, file_proc):
+        # Works, result is extended with input and time
+        file_proc.return_value.process.return_value = {'streams': 3, 'output': 'a.mkv'}
+        res = process_file('a.mkv', None, 'roku', [], single_pass=True)
+        file_proc.assert_called_once_with('a.mkv', None, 'roku', single_pass=True)
+        file_proc.return_value.process.assert_called_once_with([])
+        self.assertEqual(res['input'], 'a.mkv')
+        self.assertEqual(res['output'], 'a.mkv')
+        self.assertIn('time', res)
+
+        # Fails, error is returned instead
+        file_proc.return_value.process.side_effect = ValueError('Oops')
+        res = process_file('a.mkv', None, 'roku')
+        self.assertEqual(res['error'], 'Oops')
+
+    @patch('ffconv.batch.BatchProcessor.executor_cls', ThreadPoolExecutor)
+    @patch('ffconv.batch.process_file')
+    @patch('ffconv.file_processor.FileProcessor.probe')
+    def test_process(self, probe, proc_file):
+        video = {'index': 0, 'codec_type': 'video', 'codec_name': 'h264', 'refs': 4, 'height': 720}
+        xvid = dict(video, codec_name='xvid')
+        probe.side_effect = [[video], [xvid], ValueError('Not media')]
+        proc_file.side_effect = lambda in_file, *args, **kwargs: {'input': in_file, 'time': 1.0}
+
+        processor = BatchProcessor(['a.mkv', 'b.mkv', 'c.mkv'], 'roku',
+                                   output_dir='out', jobs=2, single_pass=True)
+        res = processor.process()
+
+        # Probe failure is not submitted, the others are with probed streams
+        # (and the profile, resolved once)
+        self.assertEqual(proc_file.call_count, 2)
+        proc_file.assert_any_call('a.mkv', os.path.join('out', 'a.mkv'), profiles.ROKU, [video], single_pass=True)
+        proc_file.assert_any_call('b.mkv', os.path.join('out', 'b.mkv'), profiles.ROKU, [xvid], single_pass=True)
+        self.assertEqual([r['input'] for r in res], ['a.mkv', 'b.mkv', 'c.mkv'])
+        self.assertEqual(processor.failures, [res[2]])
+        self.assertEqual(res[2]['error'], 'Not media')
+
+        # Summary includes every file and the totals
+        summary = processor.summary().splitlines()
+        self.assertEqual(len(summary), 4)
+        self.assertIn('FAILED: Not media', summary[2])
+        self.assertEqual(summary[3], '3 files, 2 succeeded, 0 skipped, 1 failed (2.0s of processing)')
+
+    @patch('ffconv.batch.BatchProcessor.executor_cls', ThreadPoolExecutor)
+    @patch('ffconv.batch.process_file')
+    @patch('ffconv.file_processor.FileProcessor.probe')
+    def test_process_skipped(self, probe, proc_file):
+        verdict_index = MagicMock()
+        verdict_index.get.side_effect = [{'verdict': 'compliant', 'output': None}, None]
+        probe.return_value = []
+        proc_file.side_effect = lambda in_file, *args, **kwargs: {'input': in_file, 'time': 1.0}
+
+        # First file is skipped without probing, second one is processed
+        processor = BatchProcessor(['a.mkv', 'b.mkv'], 'roku', verdict_index=verdict_index)
+        res = processor.process()
+        self.assertEqual(probe.call_count, 1)
+        self.assertEqual(proc_file.call_count, 1)
+        self.assertEqual(res[0]['verdict'], 'compliant')
+        self.assertEqual(processor.summary().splitlines()[-1],
+                         '2 files, 1 succeeded, 1 skipped, 0 failed (1.0s of processing)')
+
+    def test_auto_threads(self):
+        # CPUs are divided between video jobs
+        processor = BatchProcessor([], 'roku', video_jobs=2, threads='auto', affinity={0, 1, 2, 3, 4})
+        self.assertEqual(processor.options['threads'], 2)
+
+        # Fixed number of threads is kept
+        processor = BatchProcessor([], 'roku', video_jobs=2, threads=3)
+        self.assertEqual(processor.options['threads'], 3)
+
+        # Auto threads of the profile are divided too, unless given
+        profile = dict(profiles.ROKU, video=dict(profiles.ROKU['video'], threads='auto'))
+        processor = BatchProcessor([], profile, video_jobs=2, affinity={0, 1, 2, 3, 4})
+        self.assertEqual(processor.options['threads'], 2)
+        processor = BatchProcessor([], profile, video_jobs=2, threads=3)
+        self.assertEqual(processor.options['threads'], 3)
+
+        # Profiles without auto threads are left alone
+        processor = BatchProcessor([], 'roku', video_jobs=2)
+        self.assertNotIn('threads', processor.options)
+
+    @patch('ffconv.file_processor.FileProcessor.probe')
+    def test_classify(self, probe):
+        processor = BatchProcessor([], 'roku')
+
+        # Compliant video, light job
+        probe.return_value = [{'index': 0, 'codec_type': 'video', 'codec_name': 'h264', 'refs': 4, 'height': 720},
+                              {'index': 1, 'codec_type': 'audio', 'codec_name': 'dts', 'channels': 6}]
+        self.assertEqual(processor.classify('a.mkv'), (probe.return_value, False))
+
+        # Video must be converted, heavy job
+        probe.return_value = [{'index': 0, 'codec_type': 'video', 'codec_name': 'h264', 'refs': 16, 'height': 720}]
+        self.assertEqual(processor.classify('a.mkv'), (probe.return_value, True))
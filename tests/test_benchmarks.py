@@ -0,0 +1,49 @@
+__author__ = 'kako'
+
+import os
+import sys
+import tempfile
+
+from unittest import TestCase
+
+from benchmarks.fixtures import FIXTURES, build_command, write_srt
+from benchmarks.run import compare, measure
+from ffconv.utils import execute_cmd
+
+
+class BenchmarksTest(TestCase):
+
+    def test_measure(self):
+        # Children CPU time and I/O are counted
+        cmd = [sys.executable, '-c', 'sum(range(10 ** 6))']
+        metrics = measure(execute_cmd, cmd)
+        self.assertEqual(sorted(metrics), ['cpu', 'read', 'rss', 'wall', 'written'])
+        self.assertGreater(metrics['cpu'], 0)
+        self.assertGreaterEqual(metrics['wall'], 0)
+        self.assertGreater(metrics['rss'], 0)
+
+    def test_compare(self):
+        baseline = {'hd/probe': {'wall': 1.0, 'cpu': 0.5}, 'hd/merge': {'wall': 2.0, 'cpu': 1.0}}
+        results = {'hd/probe': {'wall': 1.05, 'cpu': 0.8}, 'hd/merge': {'wall': 1.0, 'cpu': 1.0},
+                   'hd/process': {'wall': 10.0, 'cpu': 20.0}}
+
+        # Only growth beyond tolerance, for cases in baseline
+        self.assertEqual(compare(results, baseline), [('hd/probe', 'cpu', 0.5, 0.8)])
+        self.assertEqual(compare(results, baseline, 1), [])
+
+    def test_fixtures(self):
+        # Subtitles are written in the given encoding
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'subs.srt')
+            write_srt(path, 'iso-8859-1', 4)
+            with open(path, 'rb') as srt:
+                data = srt.read()
+            self.assertTrue(data.startswith(b'1\r\n00:00:00,000 --> 00:00:01,000\r\n'))
+            self.assertIn('¿Qué pasó aquí?'.encode('iso-8859-1'), data)
+
+        # Video with requested refs, audio and subtitles copied
+        cmd = build_command(FIXTURES['hd-refs'], ['a.srt', 'b.ass'], 'hd-refs.mkv')
+        self.assertIn('ref=12', cmd)
+        self.assertEqual(cmd[cmd.index('-map'):cmd.index('-c:v')],
+                         ['-map', '0:v', '-map', '1:a', '-map', '2:s', '-map', '3:s'])
+        self.assertEqual(cmd[-3:], ['-c:s', 'copy', 'hd-refs.mkv'])
@@ -0,0 +1,295 @@
+__author__ = 'kako'
+
+import os
+import tempfile
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from ffconv import profiles
+from ffconv.cache import JobJournal, ProbeCache, StreamCache, VerdictIndex
+
+
+class ProbeCacheTest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = ProbeCache(os.path.join(self.tmp_dir.name, 'cache'), max_entries=2)
+        self.files = []
+        for name in ['a.mkv', 'b.mkv', 'c.mkv']:
+            path = os.path.join(self.tmp_dir.name, name)
+            with open(path, 'w') as f:
+                f.write(name)
+            self.files.append(path)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_get_set(self):
+        a, b, c = self.files
+        streams = [{'index': 0, 'codec_type': 'video', 'codec_name': 'h264'}]
+
+        # Not cached yet
+        self.assertEqual(self.cache.get(a), None)
+
+        # Set and get, should be the same
+        self.cache.set(a, streams)
+        self.assertEqual(self.cache.get(a), streams)
+        self.assertEqual(len(self.cache), 1)
+
+        # Modify file, should be invalid (and removed)
+        with open(a, 'w') as f:
+            f.write('modified')
+        self.assertEqual(self.cache.get(a), None)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_eviction(self):
+        a, b, c = self.files
+
+        # Fill cache, then access first one so second is least recently used
+        self.cache.set(a, [])
+        self.cache.set(b, [])
+        self.cache.get(a)
+        self.cache.set(c, [])
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.get(a), [])
+        self.assertEqual(self.cache.get(b), None)
+        self.assertEqual(self.cache.get(c), [])
+
+    def test_invalidate(self):
+        a, b, c = self.files
+        self.cache.max_entries = 10
+        for path in self.files:
+            self.cache.set(path, [])
+
+        # Invalidate some files
+        self.assertEqual(self.cache.invalidate([a, b]), 2)
+        self.assertEqual(self.cache.get(a), None)
+        self.assertEqual(self.cache.get(c), [])
+
+        # Invalidate everything
+        self.assertEqual(self.cache.invalidate(), 1)
+        self.assertEqual(len(self.cache), 0)
+
+
+class VerdictIndexTest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.index = VerdictIndex(os.path.join(self.tmp_dir.name, 'cache'))
+        self.input = os.path.join(self.tmp_dir.name, 'a.mkv')
+        self.output = os.path.join(self.tmp_dir.name, 'b.mkv')
+        for path in (self.input, self.output):
+            with open(path, 'w') as f:
+                f.write('original')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_get_set(self):
+        profile = profiles.ROKU
+
+        # Not recorded yet
+        self.assertEqual(self.index.get(self.input, profile), None)
+
+        # Record compliant, found
+        self.index.set(self.input, profile, VerdictIndex.COMPLIANT)
+        self.assertEqual(self.index.get(self.input, profile),
+                         {'verdict': 'compliant', 'output': None})
+
+        # Profile changed, not valid
+        tuned = dict(profile, video=dict(profile['video'], quality=20))
+        self.assertEqual(self.index.get(self.input, tuned), None)
+
+        # File changed, not valid
+        with open(self.input, 'w') as f:
+            f.write('modified')
+        self.assertEqual(self.index.get(self.input, profile), None)
+
+    def test_converted_output(self):
+        profile = profiles.ROKU
+        self.index.set(self.input, profile, VerdictIndex.CONVERTED, self.output)
+
+        # Same output, found
+        self.assertEqual(self.index.get(self.input, profile, self.output),
+                         {'verdict': 'converted', 'output': self.output})
+
+        # Different output, not valid
+        self.assertEqual(self.index.get(self.input, profile, 'other.mkv'), None)
+
+        # Output removed, not valid
+        os.remove(self.output)
+        self.assertEqual(self.index.get(self.input, profile, self.output), None)
+
+    def test_compliant_output(self):
+        profile = profiles.ROKU
+        self.index.set(self.input, profile, VerdictIndex.COMPLIANT, self.output)
+
+        # Linked to the same output, found
+        self.assertEqual(self.index.get(self.input, profile, self.output),
+                         {'verdict': 'compliant', 'output': self.output})
+
+        # Different output (or in place), not valid
+        self.assertEqual(self.index.get(self.input, profile, 'other.mkv'), None)
+        self.assertEqual(self.index.get(self.input, profile), None)
+
+        # Output removed, not valid
+        os.remove(self.output)
+        self.assertEqual(self.index.get(self.input, profile, self.output), None)
+
+
+class JobJournalTest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.journal = JobJournal(os.path.join(self.tmp_dir.name, 'cache'))
+        self.input = os.path.join(self.tmp_dir.name, 'a.mkv')
+        self.work_dir = os.path.join(self.tmp_dir.name, 'work')
+        self.tmp_file = os.path.join(self.tmp_dir.name, '.a.mkv.work.mkv')
+        with open(self.input, 'w') as f:
+            f.write('original')
+        os.mkdir(self.work_dir)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def start(self, profile=profiles.ROKU):
+        self.journal.start(self.input, profile, None, self.work_dir, self.tmp_file)
+
+    def test_states(self):
+        profile = profiles.ROKU
+        self.start()
+        job = self.journal.get(self.input, profile)
+        self.assertEqual(job['state'], JobJournal.STARTED)
+        self.assertEqual(job['work_dir'], self.work_dir)
+        self.assertEqual(job['pid'], os.getpid())
+
+        # Advance and record converted streams
+        self.journal.update(self.input, profile, JobJournal.PROBED)
+        self.journal.add_stream(self.input, profile, 1, {'input': 'audio-1.mp3', 'index': 0})
+        self.journal.add_stream(self.input, profile, 2, {'input': 'subtitle-2.srt', 'index': 0})
+        job = self.journal.get(self.input, profile)
+        self.assertEqual(job['state'], JobJournal.PROBED)
+        self.assertEqual(sorted(job['streams']), ['1', '2'])
+
+        # Done, removed
+        self.journal.finish(self.input, profile)
+        self.assertEqual(self.journal.get(self.input, profile), None)
+
+    def test_resume(self):
+        profile = profiles.ROKU
+        self.start()
+
+        # Still running, cannot be resumed
+        self.assertEqual(self.journal.resume(self.input, profile), None)
+
+        # Process gone, resumed (and taken over)
+        with patch.object(JobJournal, 'is_running', return_value=False):
+            job = self.journal.resume(self.input, profile)
+        self.assertEqual(job['work_dir'], self.work_dir)
+        self.assertEqual(len(self.journal), 1)
+
+        # Profile changed, removed with its files
+        tuned = dict(profile, video=dict(profile['video'], quality=20))
+        with patch.object(JobJournal, 'is_running', return_value=False):
+            self.assertEqual(self.journal.resume(self.input, tuned), None)
+        self.assertFalse(os.path.exists(self.work_dir))
+        self.assertEqual(len(self.journal), 0)
+
+    def test_is_running(self):
+        self.start()
+        job = self.journal.get(self.input, profiles.ROKU)
+        self.assertTrue(JobJournal.is_running(job))
+
+        # Same pid, but another process (eg, after a reboot): orphan
+        if job['process'] is not None:
+            self.assertTrue(JobJournal.is_running(dict(job, process=JobJournal.process_id(os.getpid()))))
+            self.assertFalse(JobJournal.is_running(dict(job, process='other-boot:1')))
+
+        # Process gone, or on another host (assumed running)
+        self.assertFalse(JobJournal.is_running(dict(job, pid=2 ** 22 + 1)))
+        self.assertTrue(JobJournal.is_running(dict(job, host='other', pid=2 ** 22 + 1)))
+
+    def test_collect_garbage(self):
+        profile = profiles.ROKU
+        self.start()
+
+        # Orphan but resumable, kept
+        with patch.object(JobJournal, 'is_running', return_value=False):
+            self.assertEqual(self.journal.collect_garbage(), 0)
+
+            # Merged, but temporary output is gone: removed
+            self.journal.update(self.input, profile, JobJournal.MERGED)
+            self.assertEqual(self.journal.collect_garbage(), 1)
+        self.assertFalse(os.path.exists(self.work_dir))
+        self.assertEqual(len(self.journal), 0)
+
+        # Running jobs are never removed
+        os.mkdir(self.work_dir)
+        self.start()
+        self.assertEqual(self.journal.collect_garbage(everything=True), 0)
+        self.assertEqual(self.journal.invalidate(), 0)
+        self.assertTrue(os.path.exists(self.work_dir))
+
+
+class StreamCacheTest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = StreamCache(os.path.join(self.tmp_dir.name, 'cache'), max_size=10)
+        self.input = os.path.join(self.tmp_dir.name, 'a.mkv')
+        with open(self.input, 'w') as f:
+            f.write('a.mkv')
+        self.work_dir = os.path.join(self.tmp_dir.name, 'work')
+        os.mkdir(self.work_dir)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def store(self, stream_key, data):
+        output = os.path.join(self.work_dir, 'video-{}.mp4'.format(stream_key))
+        with open(output, 'w') as f:
+            f.write(data)
+        key = self.cache.key(self.input, stream_key, {'quality': 22})
+        self.cache.set(key, self.input, {'input': output, 'index': 0, 'language': 'eng'})
+        os.remove(output)
+        return key
+
+    def test_get_set(self):
+        key = self.store('0', 'video')
+        other_dir = os.path.join(self.tmp_dir.name, 'other')
+        os.mkdir(other_dir)
+
+        # Same source, stream and parameters: file linked into work directory
+        self.assertIn(self.cache.key(self.input, '0', {'quality': 22}), self.cache)
+        stream = self.cache.get(key, other_dir)
+        self.assertEqual(stream, {'input': os.path.join(other_dir, 'video-0.mp4'), 'index': 0, 'language': 'eng'})
+        with open(stream['input']) as f:
+            self.assertEqual(f.read(), 'video')
+
+        # Other parameters or stream, or the source changed: not there
+        self.assertNotIn(self.cache.key(self.input, '0', {'quality': 20}), self.cache)
+        self.assertNotIn(self.cache.key(self.input, '1', {'quality': 22}), self.cache)
+        with open(self.input, 'a') as f:
+            f.write('changed')
+        self.assertNotIn(self.cache.key(self.input, '0', {'quality': 22}), self.cache)
+
+        # Stream file removed, entry is dropped
+        os.remove(os.path.join(self.cache.files_dir, key[:2], key + '.mp4'))
+        self.assertEqual(self.cache.get(key, other_dir), None)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_eviction(self):
+        # Over 10 bytes, least recently used evicted (with their files)
+        first = self.store('0', 'abcd')
+        second = self.store('1', 'efgh')
+        self.cache.get(first, self.work_dir)
+        self.store('2', 'ijkl')
+        self.assertIn(first, self.cache)
+        self.assertNotIn(second, self.cache)
+        self.assertEqual(self.cache.size(), 8)
+        self.assertEqual(sum(len(files) for _, _, files in os.walk(self.cache.files_dir)), 2)
+
+        # Invalidated by source file
+        self.assertEqual(self.cache.invalidate([self.input]), 2)
+        self.assertEqual(sum(len(files) for _, _, files in os.walk(self.cache.files_dir)), 0)
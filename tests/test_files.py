@@ -1,37 +1,141 @@
 __author__ = 'kako'
 
+import io
+import os
 import subprocess
+import sys
+import tempfile
+import threading
 
-from unittest import TestCase
+from unittest import TestCase, skipUnless
 from unittest.mock import patch, MagicMock
 
 from ffconv import profiles
+from ffconv.cache import JobJournal, ProbeCache, StreamCache, VerdictIndex
 from ffconv.file_processor import FileProcessor
-from ffconv.stream_processors import VideoProcessor, AudioProcessor, SubtitleProcessor, execute_cmd
+from ffconv.stream_processors import VideoProcessor, AudioProcessor, SubtitleProcessor
+from ffconv.utils import execute_cmd, iter_lines, cpu_budget, cpu_limiter, parse_cpus, ChildEvent, \
+    CommandStopped
 
 
 class ExecuteCommandTest(TestCase):
 
+    @staticmethod
+    def _process(stdout=b'', stderr=b'', retcode=0):
+        return MagicMock(stdout=io.BytesIO(stdout), stderr=io.BytesIO(stderr),
+                         wait=MagicMock(return_value=retcode))
+
     @patch('subprocess.Popen.__enter__')
     def test_errors(self, ctx_mgr):
-        ctx_mgr.return_value = MagicMock(stdout=MagicMock(readline=MagicMock(side_effect=[b''])),
-                                         poll=MagicMock(return_value=0))
-
-        # Return value 0, no error, read output
-        ctx_mgr.return_value = MagicMock(stdout=MagicMock(readline=MagicMock(side_effect=[b'lala', b''])),
-                                         poll=MagicMock(return_value=0))
+        # Return value 0, no error, read output unmodified
+        ctx_mgr.return_value = self._process(b'{"Streams": []}\n', b'some log\n')
         output = execute_cmd(['ls', '-al'])
-        self.assertEqual(output, 'lala')
+        self.assertEqual(output, '{"Streams": []}\n')
+
+        # Return value 1, raise CalledProcessError with output and log tail
+        log = b''.join(b'line %d\n' % i for i in range(100))
+        ctx_mgr.return_value = self._process(b'lala', log, 1)
+        with self.assertRaises(subprocess.CalledProcessError) as ctx:
+            execute_cmd(['ls', '-al'], tail=3)
+        self.assertEqual(ctx.exception.output, b'lala')
+        self.assertEqual(ctx.exception.stderr, b'line 97\nline 98\nline 99')
+
+        # Errors in log, kill process and raise ValueError (with log tail)
+        ctx_mgr.return_value = self._process(b'lala', b'some log\nError opening file\n', 1)
+        with self.assertRaises(ValueError) as ctx:
+            execute_cmd(['ls', '-al'])
+        self.assertEqual(ctx.exception.stderr, b'some log\nError opening file')
+        self.assertTrue(ctx_mgr.return_value.kill.called)
+
+        # Errors in output are fine
+        ctx_mgr.return_value = self._process(b'{"title": "Error 404"}')
+        self.assertEqual(execute_cmd(['ls', '-al']), '{"title": "Error 404"}')
 
-        # Return value 1, raise CalledProcessError
-        ctx_mgr.return_value = MagicMock(stdout=MagicMock(readline=MagicMock(side_effect=[b'lala', b''])),
-                                         poll=MagicMock(return_value=1))
-        self.assertRaises(subprocess.CalledProcessError, execute_cmd, ['ls', '-al'])
+    @patch('subprocess.Popen.__enter__')
+    def test_on_line(self, ctx_mgr):
+        # Each log line is passed to callback, splitting on carriage returns too
+        lines = []
+        ctx_mgr.return_value = self._process(b'', b'first\nframe=1\rframe=2\r\nlast')
+        execute_cmd(['ls', '-al'], on_line=lines.append)
+        self.assertEqual(lines, ['first', 'frame=1', 'frame=2', 'last'])
 
-        # Return value 0 with errors, raise ValueError
-        ctx_mgr.return_value = MagicMock(stdout=MagicMock(readline=MagicMock(side_effect=[b'lala', b'Error', b''])),
-                                         poll=MagicMock(return_value=1))
-        self.assertRaises(ValueError, execute_cmd, ['ls', '-al'])
+    @patch('subprocess.Popen.__enter__')
+    def test_stop(self, ctx_mgr):
+        # Already stopped, don't even start
+        stop = threading.Event()
+        stop.set()
+        self.assertRaises(CommandStopped, execute_cmd, ['ls', '-al'], stop=stop)
+        self.assertFalse(ctx_mgr.called)
+
+        # Stopped while running, kill process and raise
+        killed = threading.Event()
+        process = self._process(b'', b'', -9)
+        process.kill.side_effect = killed.set
+        process.wait.side_effect = lambda: killed.wait(5) and -9
+        process.poll.return_value = None
+        ctx_mgr.return_value = process
+        stop.clear()
+        threading.Timer(0.05, stop.set).start()
+        self.assertRaises(CommandStopped, execute_cmd, ['ls', '-al'], stop=stop)
+        self.assertTrue(process.kill.called)
+
+    def test_child_event(self):
+        # Set by its parent, but setting it leaves the parent alone
+        parent = threading.Event()
+        child = ChildEvent(parent, interval=0.01)
+        self.assertFalse(child.wait(0.02))
+        threading.Timer(0.02, parent.set).start()
+        self.assertTrue(child.wait(5))
+
+        parent.clear()
+        child = ChildEvent(parent)
+        child.set()
+        self.assertTrue(child.wait())
+        self.assertFalse(parent.is_set())
+        self.assertFalse(ChildEvent().is_set())
+
+    def test_cpu_limits(self):
+        # CPUs lists, as in taskset
+        self.assertEqual(parse_cpus('0-3,6'), {0, 1, 2, 3, 6})
+        self.assertEqual(cpu_budget(2, {0, 1, 2, 3, 6}), 2)
+        self.assertEqual(cpu_budget(8, {0, 1}), 1)
+        self.assertEqual(cpu_limiter(), [])
+        self.assertEqual(cpu_limiter(5, {6, 0, 1}), ['nice', '-n', '5', 'taskset', '-c', '0,1,6'])
+
+        # Niceness is set for the command only
+        nice = os.nice(0)
+        cmd = [sys.executable, '-c', 'import os; print(os.nice(0))']
+        output = execute_cmd(cpu_limiter(nice=3) + cmd)
+        self.assertEqual(int(output), min(nice + 3, 19))
+        self.assertEqual(os.nice(0), nice)
+
+        # Commands of file and stream processors are prefixed
+        processor = FileProcessor('input.mkv', None, 'roku', nice=3, affinity={0})
+        with patch('ffconv.file_processor.execute_cmd') as ecmd:
+            processor.execute(['ffmpeg', '-i', 'input.mkv'])
+        self.assertEqual(ecmd.call_args[0][0], ['nice', '-n', '3', 'taskset', '-c', '0', 'ffmpeg', '-i', 'input.mkv'])
+        stream_proc = processor.get_processors([{'index': 1, 'codec_type': 'audio', 'codec_name': 'dts', 'channels': 6}])[0]
+        with patch('ffconv.stream_processors.execute_cmd') as ecmd:
+            stream_proc.execute(['ffmpeg'])
+        self.assertEqual(ecmd.call_args[0][0][:3], ['nice', '-n', '3'])
+
+    @skipUnless(os.path.exists('/proc/self/io'), 'needs /proc I/O counters')
+    def test_io_stats(self):
+        # Bytes read by the command, counted before it's reaped
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b'x' * 100000)
+            f.flush()
+            io_stats = {}
+            output = execute_cmd([sys.executable, '-c', 'print(len(open({!r}, "rb").read()))'.format(f.name)],
+                                 io_stats=io_stats)
+        self.assertEqual(int(output), 100000)
+        self.assertGreaterEqual(io_stats['rchar'], 100000)
+
+    def test_iter_lines(self):
+        # Lines are split correctly across chunks
+        stream = io.BytesIO(b'one\ntwo\nthree\n\nfour')
+        self.assertEqual(list(iter_lines(stream, chunk_size=5)),
+                         [b'one', b'two', b'three', b'four'])
 
 
 class FileProcessorTest(TestCase):
@@ -69,24 +173,82 @@ class FileProcessorTest(TestCase):
             self.assertFalse(ecmd.called)
             processor.probe()
             cmd = ['ffprobe', '-v', 'quiet', '-show_streams', '-of', 'json', 'input.mkv']
-            ecmd.assert_called_once_with(cmd)
+            ecmd.assert_called_once_with(cmd, io_stats={})
 
-        # Check correct result parsing
+        # Check correct result parsing (tag names are normalized)
         with patch('subprocess.Popen.__enter__') as ctx_mgr:
-            # Mock the process's stdout.readline and poll methods
-            res = [b'{"streams": [',
-                   b'{"codec_type": "video", "codec_name": "h264", "index": 0},',
-                   b'{"codec_type": "AUDIO", "codec_name": "MP3", "index": 1, "tags": {"LANGUAGE": "POR"}}',
-                   b']}',
-                   b'']
-            ctx_mgr.return_value = MagicMock(stdout=MagicMock(readline=MagicMock(side_effect=res)),
-                                             poll=MagicMock(return_value=0))
+            # Mock the process's stdout and stderr
+            res = (b'{"streams": [\n'
+                   b'{"codec_type": "video", "codec_name": "h264", "index": 0},\n'
+                   b'{"codec_type": "audio", "codec_name": "mp3", "index": 1, "tags": {"LANGUAGE": "por"}}\n'
+                   b']}\n')
+            ctx_mgr.return_value = MagicMock(stdout=io.BytesIO(res), stderr=io.BytesIO(b''),
+                                             wait=MagicMock(return_value=0))
 
             # Run probe, make sure it returns the correct result
             res = processor.probe()
             self.assertEqual(res, [{"codec_type": "video", "codec_name": "h264", "index": 0},
                                    {"codec_type": "audio", "codec_name": "mp3", "index": 1, "tags": {"language": "por"}}])
 
+    @patch('ffconv.file_processor.execute_cmd')
+    def test_fast_probe(self, ecmd):
+        fast = '{"streams": [{"index": 0, "codec_type": "video", "codec_name": "h264", "refs": 4, "height": 720}]}'
+        ecmd.side_effect = lambda cmd, io_stats: io_stats.update(rchar=1000) or fast
+        processor = FileProcessor('input.mkv', 'output.mkv', 'roku', fast_probe=True,
+                                  probe_size=65536, analyze_duration=0.5)
+
+        # Only headers and the fields we use, enough
+        self.assertEqual(processor.probe()[0]['refs'], 4)
+        cmd = ecmd.call_args[0][0]
+        self.assertEqual(cmd[cmd.index('-probesize') + 1], '65536')
+        self.assertEqual(cmd[cmd.index('-analyzeduration') + 1], '500000')
+        self.assertIn('refs', cmd[cmd.index('-show_entries') + 1])
+        self.assertEqual(processor.probe_stats, {'probes': 1, 'fallbacks': 0, 'bytes_read': 1000})
+
+        # Refs missing (eg, not found in the headers), probe fully
+        fast = '{"streams": [{"index": 0, "codec_type": "video", "codec_name": "h264", "height": 720}]}'
+        full = '{"streams": [{"index": 0, "codec_type": "video", "codec_name": "h264", "refs": 1, "height": 720}]}'
+        ecmd.side_effect = [fast, full]
+        self.assertEqual(processor.probe()[0]['refs'], 1)
+        self.assertNotIn('-show_entries', ecmd.call_args[0][0])
+        self.assertEqual(processor.probe_stats, {'probes': 3, 'fallbacks': 1, 'bytes_read': 1000})
+
+    @patch('ffconv.file_processor.execute_cmd')
+    def test_probe_cache(self, ecmd):
+        ecmd.return_value = '{"streams": [{"codec_type": "video", "index": 0}]}'
+        probe_cache = MagicMock(get=MagicMock(return_value=None))
+        processor = FileProcessor('input.mkv', 'output.mkv', 'roku', probe_cache=probe_cache)
+
+        # Not in cache, probe and store it
+        res = processor.probe()
+        self.assertEqual(res, [{"codec_type": "video", "index": 0}])
+        self.assertEqual(ecmd.call_count, 1)
+        probe_cache.set.assert_called_once_with('input.mkv', res)
+
+        # In cache, should not probe
+        probe_cache.get.return_value = [{"codec_type": "audio", "index": 0}]
+        res = processor.probe()
+        self.assertEqual(res, [{"codec_type": "audio", "index": 0}])
+        self.assertEqual(ecmd.call_count, 1)
+
+    @patch('ffconv.file_processor.execute_cmd')
+    def test_probe_cache_empty(self, ecmd):
+        ecmd.return_value = '{"streams": [{"codec_type": "video", "index": 0}]}'
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            in_file = os.path.join(tmp_dir, 'input.mkv')
+            open(in_file, 'wb').close()
+
+            # Empty cache (falsy, it has no entries) is used and filled
+            probe_cache = ProbeCache(tmp_dir)
+            self.assertEqual(len(probe_cache), 0)
+            FileProcessor(in_file, None, 'roku', probe_cache=probe_cache).probe()
+            self.assertEqual(len(probe_cache), 1)
+            self.assertEqual(probe_cache.get(in_file), [{"codec_type": "video", "index": 0}])
+
+            # Probed again, from the cache
+            FileProcessor(in_file, None, 'roku', probe_cache=probe_cache).probe()
+            self.assertEqual(ecmd.call_count, 1)
+
     @patch('ffconv.stream_processors.VideoProcessor.process',
            MagicMock(return_value={'input': 'input.mkv', 'index': 0}))
     @patch('ffconv.stream_processors.AudioProcessor.process',
@@ -151,6 +313,56 @@ class FileProcessorTest(TestCase):
         res = processor.process_streams(streams)
         self.assertEqual(type(processor.error), ValueError)
 
+    def test_process_streams_parallel(self):
+        processor = FileProcessor('input.mkv', 'output.mkv', 'roku', stream_jobs=3, threads=8)
+        streams = [{'codec_type': 'video', 'codec_name': 'h264', 'index': 0, 'refs': 12, 'height': 720},
+                   {'codec_type': 'audio', 'codec_name': 'dts', 'index': 1, 'channels': 6},
+                   {'codec_type': 'audio', 'codec_name': 'aac', 'index': 2, 'channels': 2},
+                   {'codec_type': 'subtitle', 'codec_name': 'srt', 'index': 3}]
+
+        # Results keep stream order, converting streams get thread budget
+        seen = {}
+
+        def process(self):
+            seen[self.index] = (self.threads, self.stop)
+            return {'input': self.input, 'index': self.index}
+
+        with patch('ffconv.stream_processors.StreamProcessor.process', process):
+            res = processor.process_streams(streams)
+        self.assertIsNone(processor.error)
+        self.assertEqual([r['index'] for r in res], [0, 1, 2, 3])
+        self.assertEqual(seen[0][0], 6)
+        self.assertEqual(seen[1][0], 1)
+        self.assertIsNone(seen[2][0])
+        self.assertEqual(seen[3][0], 1)
+        self.assertFalse(seen[0][1].is_set())
+
+        # One fails: error is kept, stop is set for the rest
+        seen.clear()
+
+        def fail(self):
+            seen[self.index] = (self.threads, self.stop)
+            if self.media_type == 'subtitle':
+                raise ValueError('Could not convert ass!')
+            return {'input': self.input, 'index': self.index}
+
+        stop = threading.Event()
+        processor = FileProcessor('input.mkv', 'output.mkv', 'roku', stream_jobs=2, stop=stop)
+        with patch('ffconv.stream_processors.StreamProcessor.process', fail):
+            res = processor.process_streams(streams)
+        self.assertEqual(type(processor.error), ValueError)
+        self.assertTrue(all(r['index'] != 3 for r in res))
+        self.assertTrue(seen[3][1].is_set())
+
+        # The caller's stop event is left alone, but stops them when set
+        self.assertFalse(stop.is_set())
+        processor = FileProcessor('input.mkv', 'output.mkv', 'roku', stream_jobs=2, stop=stop)
+        with patch('ffconv.stream_processors.StreamProcessor.process', process):
+            processor.process_streams(streams)
+        self.assertFalse(seen[0][1].is_set())
+        stop.set()
+        self.assertTrue(seen[0][1].is_set())
+
     @patch('ffconv.file_processor.execute_cmd')
     def test_merge(self, ecmd):
         processor = FileProcessor('input.mkv', 'output.mkv', 'roku')
@@ -177,13 +389,13 @@ class FileProcessorTest(TestCase):
                '-i', 'subtitle-4.srt', '-map', '0:0', '-map', '1:0', '-map', '0:2',
                '-map', '2:0', '-map', '3:0', '-metadata:s:1', 'language=jap',
                '-metadata:s:2', 'language=eng', '-metadata:s:3', 'language=eng',
-               '-metadata:s:4', 'language=spa', '-c', 'copy', 'output.mkv']
+               '-metadata:s:4', 'language=spa', '-c', 'copy', '.output.mkv.ffconv-tmp.mkv']
         ecmd.assert_called_once_with(cmd)
         ecmd.reset_mock()
 
-        # Do the same without output, should do the same but use tmp.mkv as output
+        # Do the same without output, should use temp file next to input
         processor.output = None
-        cmd[-1] = 'tmp.mkv'
+        cmd[-1] = '.input.mkv.ffconv-tmp.mkv'
         res = processor.merge(streams)
         self.assertEqual(res, ['audio-1.mp3', 'subtitle-3.srt', 'subtitle-4.srt'])
         self.assertEqual(processor.error, None)
@@ -193,31 +405,61 @@ class FileProcessorTest(TestCase):
         # Simulate failure, should add output to cleanup and update error
         ecmd.side_effect = ValueError('Something failed')
         res = processor.merge(streams)
-        self.assertEqual(res, ['audio-1.mp3', 'subtitle-3.srt', 'subtitle-4.srt', 'tmp.mkv'])
+        self.assertEqual(res, ['audio-1.mp3', 'subtitle-3.srt', 'subtitle-4.srt', '.input.mkv.ffconv-tmp.mkv'])
         self.assertEqual(type(processor.error), ValueError)
 
-    @patch('ffconv.file_processor.execute_cmd')
-    def test_replace_original(self, ecmd):
-        processor = FileProcessor('another-input.mkv', None, 'roku')
-
-        # Replace original, make sure output is updated
-        processor.replace_original()
-        cmd = ['mv', 'tmp.mkv', 'another-input.mkv']
-        ecmd.assert_called_once_with(cmd)
-        self.assertEqual(processor.output, 'another-input.mkv')
-
-    @patch('ffconv.file_processor.execute_cmd')
-    def test_clean_up(self, ecmd):
+    def test_publish(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            in_file = os.path.join(tmp_dir, 'another-input.mkv')
+            with open(in_file, 'w') as f:
+                f.write('original')
+
+            # Temp file is next to the original, replaces it
+            processor = FileProcessor(in_file, None, 'roku')
+            self.assertEqual(os.path.dirname(processor.tmp_file), tmp_dir)
+            with open(processor.tmp_file, 'w') as f:
+                f.write('converted')
+            processor.publish()
+            self.assertEqual(processor.output, in_file)
+            self.assertEqual(os.listdir(tmp_dir), ['another-input.mkv'])
+            with open(in_file) as f:
+                self.assertEqual(f.read(), 'converted')
+
+            # Temp file is next to the output, with its extension
+            output = os.path.join(tmp_dir, 'out', 'output.mp4')
+            processor = FileProcessor(in_file, output, 'roku')
+            self.assertEqual(processor.tmp_file, os.path.join(tmp_dir, 'out', '.output.mp4.ffconv-tmp.mp4'))
+
+            # Nothing converted, output is linked to input
+            os.mkdir(os.path.dirname(output))
+            processor.link_output()
+            self.assertTrue(os.path.samefile(in_file, output))
+
+            # Can't link, copy
+            os.remove(output)
+            with patch('ffconv.utils.os.link', side_effect=OSError('Invalid cross-device link')):
+                processor.link_output()
+            self.assertFalse(os.path.samefile(in_file, output))
+            with open(output) as f:
+                self.assertEqual(f.read(), 'converted')
+            self.assertEqual(os.listdir(os.path.dirname(output)), ['output.mp4'])
+
+    def test_clean_up(self):
         processor = FileProcessor('another-input.mkv', 'output.mkv', 'roku')
 
-        # Clean up, make sure all files are removed
-        inputs = ['audio-2.mp3', 'audio-4.mp3', 'subtitle-5.srt']
-        processor.clean_up(inputs)
-        cmd = ['rm', 'audio-2.mp3', 'audio-4.mp3', 'subtitle-5.srt']
-        self.assertTrue(ecmd.called)
-        ecmd.assert_called_once_with(cmd)
+        # Clean up, make sure all files are removed (missing ones are fine)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            inputs = [os.path.join(tmp_dir, name) for name in ('audio-2.mp3', 'audio-4.mp3', 'subtitle-5.srt')]
+            for name in inputs[:2]:
+                open(name, 'w').close()
+            processor.clean_up(inputs)
+            self.assertEqual(os.listdir(tmp_dir), [])
 
     @patch('ffconv.stream_processors.execute_cmd', MagicMock())
+    @patch('ffconv.stream_processors.SubtitleProcessor.clean_up', MagicMock())
+    @patch('ffconv.stream_processors.SubtitleProcessor.recode', MagicMock(return_value=False))
+    @patch('ffconv.file_processor.remove_files', MagicMock())
+    @patch('ffconv.file_processor.os.replace', MagicMock())
     @patch('ffconv.file_processor.execute_cmd', MagicMock())
     @patch('ffconv.file_processor.FileProcessor.probe', MagicMock(return_value=[
         {'index': 0, 'codec_type': 'video', 'codec_name': 'h264', 'refs': 4, 'height': 720},
@@ -235,3 +477,485 @@ class FileProcessorTest(TestCase):
         processor.output = None
         res = processor.process()
         self.assertEqual(res, {'streams': 4, 'output': 'Se7en.mkv'})
+
+    @patch('ffconv.file_processor.FileProcessor.link_output')
+    @patch('ffconv.file_processor.FileProcessor.publish')
+    @patch('ffconv.file_processor.remove_files', MagicMock())
+    @patch('ffconv.file_processor.execute_cmd')
+    @patch('ffconv.stream_processors.AudioProcessor.process',
+           MagicMock(return_value={'input': 'audio-0.mp3', 'index': 0}))
+    @patch('ffconv.file_processor.FileProcessor.probe', MagicMock(return_value=[
+        {'index': 0, 'codec_type': 'audio', 'codec_name': 'dts', 'channels': 6},
+    ]))
+    def test_process_single_stream(self, ecmd, publish, link_output):
+        # Only stream converted, remuxed and published (not linked)
+        processor = FileProcessor('Se7en.mkv', 'seven.mkv', 'roku')
+        res = processor.process()
+        self.assertEqual(res, {'streams': 1, 'output': 'seven.mkv'})
+        self.assertEqual(ecmd.call_args[0][0][:-1],
+                         ['ffmpeg', '-i', 'audio-0.mp3', '-map', '0:0', '-c', 'copy'])
+        self.assertTrue(processor.converted)
+        self.assertTrue(publish.called)
+        self.assertFalse(link_output.called)
+
+    @patch('ffconv.file_processor.remove_files', MagicMock())
+    @patch('ffconv.utils.subprocess.Popen')
+    def test_transcode_charset(self, popen):
+        def process(stderr, retcode=0):
+            return MagicMock(stdout=io.BytesIO(b''), stderr=io.BytesIO(stderr),
+                             wait=MagicMock(return_value=retcode))
+
+        processor = FileProcessor('input.mkv', 'output.mkv', 'roku')
+        processors = processor.get_processors([
+            {'index': 0, 'codec_type': 'video', 'codec_name': 'h264', 'refs': 4, 'height': 720},
+            {'index': 1, 'codec_type': 'subtitle', 'codec_name': 'subrip'},
+        ])
+
+        # Subtitles in another charset: ffmpeg logs the recode failure and
+        # then a decoding error, which kills it, next encoding is tried
+        for log in (b'[srt @ 0x55d5c8a4] Unable to recode subtitle event "Qu\xe9 tal" from utf-8 to UTF-8\n'
+                    b'Error while decoding stream #0:1: Invalid argument\n',
+                    b'Invalid UTF-8 in decoded subtitles text; maybe missing -sub_charenc option\n'
+                    b'Error while decoding stream #0:1: Invalid data found when processing input\n'):
+            popen.return_value.__enter__.side_effect = [
+                process(log, 1), process(b'frame=  100 fps=50 time=00:00:04.00 speed=2x\n')]
+            processor.transcode(processors)
+            encodings = [c[0][0][c[0][0].index('-sub_charenc') + 1] for c in popen.call_args_list]
+            self.assertEqual(encodings, ['utf-8', 'iso-8859-1'])
+            self.assertEqual(processor.error, None)
+            self.assertTrue(processor.converted)
+            popen.reset_mock()
+
+        # Other errors are not retried
+        popen.return_value.__enter__.side_effect = [
+            process(b'Error while opening encoder for output stream #0:0 - maybe incorrect parameters\n', 1),
+        ]
+        processor.transcode(processors)
+        self.assertEqual(popen.call_count, 1)
+        self.assertIsInstance(processor.error, ValueError)
+
+    @patch('ffconv.file_processor.remove_files')
+    @patch('ffconv.file_processor.execute_cmd')
+    def test_transcode(self, ecmd, remove):
+        processor = FileProcessor('input.mkv', 'output.mkv', 'roku')
+        processors = processor.get_processors([
+            {'index': 0, 'codec_type': 'video', 'codec_name': 'h264', 'refs': 4, 'height': 720},
+            {'index': 1, 'codec_type': 'audio', 'codec_name': 'aac', 'channels': 6, 'tags': {'language': 'eng'}},
+            {'index': 2, 'codec_type': 'attachment', 'codec_name': 'ttf'},
+            {'index': 3, 'codec_type': 'subtitle', 'codec_name': 'ass', 'tags': {'language': 'spa'}},
+        ])
+        self.assertEqual(len(processors), 3)
+
+        # Transcode, should use a single command with first encoding
+        processor.transcode(processors)
+        cmd = ['ffmpeg', '-sub_charenc', 'utf-8', '-i', 'input.mkv',
+               '-map', '0:0', '-map', '0:1', '-map', '0:3',
+               '-c:0', 'copy',
+               '-c:1', 'aac', '-ac:1', '2', '-metadata:s:1', 'language=eng',
+               '-c:2', 'srt', '-metadata:s:2', 'language=spa',
+               '.output.mkv.ffconv-tmp.mkv']
+        ecmd.assert_called_once_with(cmd)
+        self.assertEqual(processor.error, None)
+        ecmd.reset_mock()
+
+        # First encoding fails, should remove output and retry with next one
+        charset_error = subprocess.CalledProcessError(
+            1, cmd, stderr=b'Unable to recode subtitle event "Hola" from utf-8 to UTF-8')
+        ecmd.side_effect = [charset_error, None]
+        processor.transcode(processors)
+        self.assertEqual(ecmd.call_count, 2)
+        remove.assert_called_once_with(['.output.mkv.ffconv-tmp.mkv'])
+        self.assertEqual(ecmd.call_args_list[1][0][0][:3], ['ffmpeg', '-sub_charenc', 'iso-8859-1'])
+        self.assertEqual(processor.error, None)
+        ecmd.reset_mock()
+        remove.reset_mock()
+
+        # Failed for another reason, should remove output but not retry
+        ecmd.side_effect = subprocess.CalledProcessError(1, cmd, stderr=b'No space left on device')
+        processor.transcode(processors)
+        self.assertEqual(ecmd.call_count, 1)
+        remove.assert_called_once_with(['.output.mkv.ffconv-tmp.mkv'])
+        self.assertEqual(type(processor.error), subprocess.CalledProcessError)
+        ecmd.reset_mock()
+
+        # Other errors are not retried
+        ecmd.side_effect = ValueError('Something failed')
+        processor.transcode(processors)
+        self.assertEqual(ecmd.call_count, 1)
+        self.assertEqual(type(processor.error), ValueError)
+
+    def test_downmix(self):
+        profile = dict(profiles.ROKU, audio=dict(profiles.ROKU['audio'], keep_original=True))
+        processor = FileProcessor('input.mkv', 'output.mkv', profile)
+        processors = processor.get_processors([
+            {'index': 0, 'codec_type': 'video', 'codec_name': 'h264', 'refs': 4, 'height': 720},
+            {'index': 1, 'codec_type': 'audio', 'codec_name': 'aac', 'channels': 6},
+            {'index': 2, 'codec_type': 'audio', 'codec_name': 'dts', 'channels': 6},
+        ])
+
+        # Compliant 5.1 track kept, followed by its downmix
+        self.assertEqual([(p.index, p.action) for p in processors],
+                         [(0, 'copy'), (1, 'copy'), (1, 'downmix'), (2, 'transcode')])
+        cmd = processor._build_transcode_command('input.mkv', processors, 'output.mkv')
+        self.assertEqual(cmd[3:11], ['-map', '0:0', '-map', '0:1', '-map', '0:1', '-map', '0:2'])
+
+        # Audio tracks to convert are batched in multi-pass
+        processor._batch_audio(processors)
+        self.assertIs(processors[2].batch, processors[3].batch)
+        self.assertEqual(processors[2].batch.processors, processors[2:])
+
+    @patch('ffconv.file_processor.os.replace')
+    @patch('ffconv.file_processor.execute_cmd')
+    @patch('ffconv.file_processor.FileProcessor.probe', MagicMock(return_value=[
+        {'index': 0, 'codec_type': 'video', 'codec_name': 'h264', 'refs': 4, 'height': 720},
+        {'index': 1, 'codec_type': 'audio', 'codec_name': 'aac', 'channels': 6, 'tags': {'LANGUAGE': 'eng'}},
+        {'index': 2, 'codec_type': 'subtitle', 'codec_name': 'ass', 'tags': {'LANGUAGE': 'spa'}},
+    ]))
+    def test_process_single_pass(self, ecmd, replace):
+        # Run single pass with output, transcode to temp file next to it and
+        # move it there
+        processor = FileProcessor('Se7en.mkv', 'seven.mkv', 'roku', single_pass=True)
+        res = processor.process()
+        self.assertEqual(res, {'streams': 3, 'output': 'seven.mkv'})
+        self.assertEqual(ecmd.call_count, 1)
+        tmp_file, output = replace.call_args[0]
+        self.assertEqual(ecmd.call_args[0][0][-1], tmp_file)
+        self.assertEqual(output, 'seven.mkv')
+        self.assertTrue(tmp_file.startswith('.seven.mkv.ffconv-'))
+        ecmd.reset_mock()
+
+        # Run without output, should transcode to temp file and replace original
+        with tempfile.TemporaryDirectory() as scratch_root:
+            processor = FileProcessor('Se7en.mkv', None, 'roku', single_pass=True,
+                                      scratch_root=scratch_root)
+            res = processor.process()
+            self.assertEqual(res, {'streams': 3, 'output': 'Se7en.mkv'})
+            self.assertEqual(ecmd.call_count, 1)
+            tmp_file, in_file = replace.call_args[0]
+            self.assertEqual(in_file, 'Se7en.mkv')
+            self.assertTrue(tmp_file.startswith('.Se7en.mkv.ffconv-'))
+
+            # Scratch directory was removed
+            self.assertEqual(os.listdir(scratch_root), [])
+
+    @patch('ffconv.file_processor.os.replace')
+    @patch('ffconv.file_processor.execute_cmd')
+    @patch('ffconv.file_processor.FileProcessor.probe', MagicMock(return_value=[
+        {'index': 0, 'codec_type': 'video', 'codec_name': 'h264', 'refs': 8, 'height': 720},
+        {'index': 1, 'codec_type': 'audio', 'codec_name': 'aac', 'channels': 2, 'tags': {'language': 'eng'}},
+        {'index': 2, 'codec_type': 'subtitle', 'codec_name': 'srt'},
+    ]))
+    def test_process_fan_out(self, ecmd, replace):
+        mobile = {'name': 'Mobile', 'extends': 'roku', 'video': {'max_refs': {720: 4}}}
+        audio = {'name': 'Audio', 'audio': profiles.ROKU['audio']}
+        processor = FileProcessor('Se7en.mkv', 'seven.mkv', 'roku',
+                                  variants=[('seven.mobile.mkv', mobile), ('seven.m4a', audio)])
+
+        # Single command reading the input once, with an output for each
+        # profile: video is only encoded for mobile, audio is copied, and
+        # audio-only drops the other streams
+        res = processor.process()
+        self.assertEqual(res, {'streams': 3, 'output': 'seven.mkv',
+                               'variants': ['seven.mobile.mkv', 'seven.m4a']})
+        self.assertEqual(ecmd.call_count, 1)
+        cmd = ecmd.call_args[0][0]
+        self.assertEqual(cmd.count('-i'), 1)
+        outputs = [i for i, arg in enumerate(cmd) if arg.startswith('.seven.')]
+        self.assertEqual(len(outputs), 3)
+        main, variant, audio_only = cmd[cmd.index('Se7en.mkv') + 1:outputs[0]], \
+            cmd[outputs[0] + 1:outputs[1]], cmd[outputs[1] + 1:outputs[2]]
+        self.assertEqual(main[:8], ['-map', '0:0', '-map', '0:1', '-map', '0:2', '-c:0', 'copy'])
+        self.assertEqual(variant[6:8], ['-c:0', 'h264'])
+        self.assertEqual(audio_only, ['-map', '0:1', '-c:0', 'copy', '-metadata:s:0', 'language=eng'])
+
+        # Variants are published first
+        self.assertEqual([c[0][1] for c in replace.call_args_list],
+                         ['seven.mobile.mkv', 'seven.m4a', 'seven.mkv'])
+        ecmd.reset_mock()
+        replace.reset_mock()
+
+        # Failed, all partial outputs are removed and nothing is published
+        ecmd.side_effect = ValueError('Something failed')
+        with patch('ffconv.file_processor.remove_files') as remove:
+            self.assertRaises(ValueError, processor.process)
+        self.assertEqual(len(remove.call_args[0][0]), 3)
+        replace.assert_not_called()
+
+        # Variants require an output
+        self.assertRaises(ValueError, FileProcessor, 'Se7en.mkv', None, 'roku', variants=[(None, audio)])
+
+        # And so does this one, replacing the original would change the file
+        # their verdicts are recorded for
+        self.assertRaises(ValueError, FileProcessor, 'Se7en.mkv', None, 'roku',
+                          variants=[('seven.m4a', audio)])
+
+    @patch('ffconv.file_processor.os.replace')
+    @patch('ffconv.file_processor.execute_cmd')
+    @patch('ffconv.file_processor.FileProcessor.probe', MagicMock(return_value=[
+        {'index': 0, 'codec_type': 'video', 'codec_name': 'h264', 'refs': 4, 'height': 720},
+    ]))
+    def test_process_no_streams(self, ecmd, replace):
+        audio = {'name': 'Audio', 'audio': profiles.ROKU['audio']}
+
+        # Audio-only output of a file without audio fails, without writing it
+        for single_pass in (False, True):
+            processor = FileProcessor('Se7en.mkv', 'seven.m4a', audio, single_pass=single_pass)
+            self.assertRaisesRegex(ValueError, 'no streams to write', processor.process)
+        processor = FileProcessor('Se7en.mkv', 'seven.mkv', 'roku', variants=[('seven.m4a', audio)])
+        self.assertRaisesRegex(ValueError, 'no streams to write', processor.process)
+        ecmd.assert_not_called()
+        replace.assert_not_called()
+
+        # Stream processors that cannot be built fail too, even if the output
+        # could be written without them
+        processor = FileProcessor('Se7en.mkv', 'seven.m4a', audio, single_pass=True)
+        processor.probe.return_value = processor.probe.return_value + [
+            {'index': 1, 'codec_type': 'audio', 'codec_name': 'dts'}]
+        self.assertRaises(KeyError, processor.process)
+        ecmd.assert_not_called()
+        replace.assert_not_called()
+
+    def test_work_dir(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            scratch_root = os.path.join(tmp_dir, 'scratch')
+            processor = FileProcessor('input.mkv', None, 'roku', scratch_root=scratch_root)
+            other = FileProcessor('input.mkv', None, 'roku', scratch_root=scratch_root)
+
+            # Each job gets its own directory (root is created if missing)
+            processor.create_work_dir()
+            other.create_work_dir()
+            self.assertNotEqual(processor.work_dir, other.work_dir)
+            self.assertEqual(os.path.dirname(processor.work_dir), scratch_root)
+            self.assertEqual(processor.tmp_file, '.input.mkv.{}.mkv'.format(os.path.basename(processor.work_dir)))
+            self.assertNotEqual(processor.tmp_file, other.tmp_file)
+
+            # Stream outputs are created there too
+            stream = {'index': 1, 'codec_type': 'audio', 'codec_name': 'dts', 'channels': 6}
+            stream_proc = processor.get_processors([stream])[0]
+            self.assertEqual(stream_proc.output, os.path.join(processor.work_dir, 'audio-1.mp3'))
+
+            # Remove, should remove directory and contents
+            open(stream_proc.output, 'w').close()
+            processor.remove_work_dir()
+            self.assertEqual(processor.work_dir, '')
+            self.assertEqual(os.listdir(scratch_root), [os.path.basename(other.work_dir)])
+
+            # Output directory is created when the job starts
+            output = os.path.join(tmp_dir, 'out', 'season', 'e01.mkv')
+            processor = FileProcessor('input.mkv', output, 'roku', scratch_root=scratch_root)
+            processor.start_job()
+            self.assertTrue(os.path.isdir(os.path.dirname(output)))
+            processor.remove_work_dir()
+
+    @patch('ffconv.file_processor.execute_cmd')
+    @patch('ffconv.file_processor.FileProcessor.probe', MagicMock(return_value=[
+        {'index': 0, 'codec_type': 'audio', 'codec_name': 'dts', 'channels': 6},
+    ]))
+    def test_process_interrupted(self, ecmd):
+        def transcode(cmd, **kwargs):
+            open(cmd[-1], 'w').close()
+            raise KeyboardInterrupt
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            in_file = os.path.join(tmp_dir, 'Se7en.mkv')
+            open(in_file, 'w').close()
+            scratch_root = os.path.join(tmp_dir, 'scratch')
+            ecmd.side_effect = transcode
+
+            # Interrupted without journal, partial output next to the
+            # destination is removed with the work directory
+            processor = FileProcessor(in_file, None, 'roku', single_pass=True,
+                                      scratch_root=scratch_root)
+            with self.assertRaises(KeyboardInterrupt):
+                processor.process()
+            self.assertEqual(sorted(os.listdir(tmp_dir)), ['Se7en.mkv', 'scratch'])
+            self.assertEqual(os.listdir(scratch_root), [])
+
+            # Interrupted with journal, both are kept to resume the job
+            processor = FileProcessor(in_file, None, 'roku', single_pass=True,
+                                      scratch_root=scratch_root,
+                                      journal=JobJournal(os.path.join(tmp_dir, 'cache')))
+            with self.assertRaises(KeyboardInterrupt):
+                processor.process()
+            self.assertIn(os.path.basename(processor.tmp_file), os.listdir(tmp_dir))
+            self.assertEqual(len(os.listdir(scratch_root)), 1)
+
+    @patch('ffconv.file_processor.os.replace', MagicMock())
+    @patch('ffconv.file_processor.execute_cmd', MagicMock())
+    @patch('ffconv.stream_processors.VideoProcessor.process',
+           MagicMock(side_effect=KeyboardInterrupt))
+    @patch('ffconv.stream_processors.AudioProcessor.process')
+    @patch('ffconv.file_processor.FileProcessor.probe', MagicMock(return_value=[
+        {'index': 0, 'codec_type': 'audio', 'codec_name': 'dts', 'channels': 6},
+        {'index': 1, 'codec_type': 'video', 'codec_name': 'h264', 'refs': 12, 'height': 720},
+    ]))
+    def test_process_resume(self, audio_process):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            in_file = os.path.join(tmp_dir, 'Se7en.mkv')
+            open(in_file, 'w').close()
+            journal = JobJournal(os.path.join(tmp_dir, 'cache'))
+            scratch_root = os.path.join(tmp_dir, 'scratch')
+
+            # Audio converted, then interrupted while converting video: job
+            # and work directory are kept
+            def convert_audio():
+                output = os.path.join(processor.work_dir, 'audio-0.mp3')
+                open(output, 'w').close()
+                return {'input': output, 'index': 0}
+            audio_process.side_effect = convert_audio
+
+            processor = FileProcessor(in_file, None, 'roku', scratch_root=scratch_root,
+                                      journal=journal)
+            with self.assertRaises(KeyboardInterrupt):
+                processor.process()
+            job = journal.get(in_file, profiles.ROKU)
+            self.assertEqual(job['state'], JobJournal.PROBED)
+            self.assertEqual(job['streams'], {'0': convert_audio()})
+
+            # Next run resumes it, reusing the converted audio
+            VideoProcessor.process.side_effect = None
+            VideoProcessor.process.return_value = {'input': 'video-1.mp4', 'index': 0}
+            audio_process.reset_mock()
+            with patch.object(JobJournal, 'is_running', return_value=False):
+                processor = FileProcessor(in_file, None, 'roku', scratch_root=scratch_root,
+                                          journal=journal)
+                res = processor.process()
+            self.assertEqual(res['streams'], 2)
+            self.assertEqual(processor.work_dir, '')
+            self.assertEqual(audio_process.call_count, 0)
+
+            # Done, removed from journal with its work directory
+            self.assertEqual(len(journal), 0)
+            self.assertEqual(os.listdir(scratch_root), [])
+
+    @patch('ffconv.file_processor.FileProcessor.publish', MagicMock())
+    @patch('ffconv.file_processor.execute_cmd', MagicMock())
+    @patch('ffconv.stream_processors.VideoProcessor.process')
+    @patch('ffconv.file_processor.FileProcessor.probe', MagicMock(return_value=[
+        {'index': 0, 'codec_type': 'video', 'codec_name': 'h264', 'refs': 12, 'height': 720},
+        {'index': 1, 'codec_type': 'audio', 'codec_name': 'aac', 'channels': 2},
+    ]))
+    def test_process_stream_cache(self, video_process):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            in_file = os.path.join(tmp_dir, 'Se7en.mkv')
+            open(in_file, 'w').close()
+            output = os.path.join(tmp_dir, 'seven.mkv')
+            stream_cache = StreamCache(os.path.join(tmp_dir, 'streams'))
+
+            def convert_video():
+                output = os.path.join(processor.work_dir, 'video-0.mp4')
+                open(output, 'w').close()
+                return {'input': output, 'index': 0}
+            video_process.side_effect = convert_video
+
+            # Video encoded and cached
+            processor = FileProcessor(in_file, output, 'roku', stream_cache=stream_cache)
+            processor.process()
+            self.assertEqual(video_process.call_count, 1)
+            self.assertEqual(len(stream_cache), 1)
+
+            # Other subtitle rules, same video: reused
+            profile = dict(profiles.ROKU, subtitle=dict(profiles.ROKU['subtitle'], encodings=['latin-1']))
+            processor = FileProcessor(in_file, output, profile, stream_cache=stream_cache)
+            with patch('ffconv.file_processor.FileProcessor.merge', return_value=[]) as merge:
+                processor.process()
+            self.assertEqual(video_process.call_count, 1)
+            merged = merge.call_args[0][0][0]['input']
+            self.assertTrue(merged.endswith('video-0.mp4'))
+
+            # Other video rules: encoded again
+            profile = dict(profiles.ROKU, video=dict(profiles.ROKU['video'], quality=24))
+            processor = FileProcessor(in_file, output, profile, stream_cache=stream_cache)
+            processor.process()
+            self.assertEqual(video_process.call_count, 2)
+            self.assertEqual(len(stream_cache), 2)
+
+    @patch('ffconv.file_processor.os.replace', MagicMock())
+    @patch('ffconv.file_processor.execute_cmd', MagicMock())
+    @patch('ffconv.file_processor.FileProcessor.probe', MagicMock(return_value=[
+        {'index': 0, 'codec_type': 'video', 'codec_name': 'h264', 'refs': 4, 'height': 720},
+        {'index': 1, 'codec_type': 'audio', 'codec_name': 'aac', 'channels': 2},
+    ]))
+    def test_process_verdict(self):
+        verdict_index = MagicMock(COMPLIANT='compliant', CONVERTED='converted')
+
+        # Already done, skip without probing
+        verdict_index.get.return_value = {'verdict': 'compliant', 'output': None}
+        processor = FileProcessor('Se7en.mkv', None, 'roku', verdict_index=verdict_index)
+        res = processor.process()
+        self.assertEqual(res, {'streams': 0, 'output': None, 'verdict': 'compliant'})
+        verdict_index.get.assert_called_once_with('Se7en.mkv', profiles.ROKU, None)
+        self.assertFalse(processor.probe.called)
+
+        # Nothing to convert, record as compliant
+        verdict_index.get.return_value = None
+        res = processor.process()
+        self.assertEqual(res, {'streams': 2, 'output': None})
+        verdict_index.set.assert_called_once_with('Se7en.mkv', profiles.ROKU, 'compliant', None)
+        verdict_index.set.reset_mock()
+
+        # Converted to output, record it
+        processor = FileProcessor('Se7en.mkv', 'seven.mkv', 'roku', single_pass=True,
+                                  verdict_index=verdict_index)
+        processor.probe.return_value = processor.probe.return_value + [
+            {'index': 2, 'codec_type': 'subtitle', 'codec_name': 'srt'}]
+        processor.process()
+        verdict_index.set.assert_called_once_with('Se7en.mkv', profiles.ROKU, 'converted', 'seven.mkv')
+
+    @patch('ffconv.file_processor.FileProcessor.publish')
+    @patch('ffconv.file_processor.remove_files', MagicMock())
+    @patch('ffconv.file_processor.execute_cmd', MagicMock())
+    @patch('ffconv.stream_processors.AudioProcessor.process',
+           MagicMock(return_value={'input': 'audio-0.mp3', 'index': 0}))
+    @patch('ffconv.file_processor.FileProcessor.probe', MagicMock(return_value=[
+        {'index': 0, 'codec_type': 'audio', 'codec_name': 'dts', 'channels': 6},
+    ]))
+    def test_process_verdict_publish(self, publish):
+        verdict_index = MagicMock(COMPLIANT='compliant', CONVERTED='converted')
+        verdict_index.get.return_value = None
+
+        # Publish failed, no verdict recorded
+        publish.side_effect = OSError('No space left on device')
+        processor = FileProcessor('Se7en.mkv', None, 'roku', verdict_index=verdict_index)
+        self.assertRaises(OSError, processor.process)
+        self.assertFalse(verdict_index.set.called)
+
+        # Only stream converted and published, recorded as converted
+        publish.side_effect = None
+        processor.process()
+        verdict_index.set.assert_called_once_with('Se7en.mkv', profiles.ROKU, 'converted', None)
+
+        # Verdict follows the converted streams, even if merge did not say so
+        verdict_index.set.reset_mock()
+        processor = FileProcessor('Se7en.mkv', None, 'roku', verdict_index=verdict_index)
+        with patch('ffconv.file_processor.FileProcessor.merge', return_value=[]):
+            processor.process()
+        self.assertFalse(processor.converted)
+        verdict_index.set.assert_called_once_with('Se7en.mkv', profiles.ROKU, 'converted', None)
+
+    @patch('ffconv.file_processor.FileProcessor.probe', MagicMock(return_value=[
+        {'index': 0, 'codec_type': 'video', 'codec_name': 'h264', 'refs': 4, 'height': 720},
+    ]))
+    def test_process_verdict_empty(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            in_file = os.path.join(tmp_dir, 'Se7en.mkv')
+            open(in_file, 'wb').close()
+
+            # Empty index (falsy, it has no entries) records the verdict
+            verdict_index = VerdictIndex(tmp_dir)
+            self.assertEqual(len(verdict_index), 0)
+            FileProcessor(in_file, None, 'roku', verdict_index=verdict_index).process()
+            self.assertEqual(verdict_index.get(in_file, profiles.ROKU)['verdict'], 'compliant')
+
+            # Processed again, skipped without probing
+            processor = FileProcessor(in_file, None, 'roku', verdict_index=verdict_index)
+            processor.probe.reset_mock()
+            self.assertEqual(processor.process()['verdict'], 'compliant')
+            self.assertFalse(processor.probe.called)
+
+            # Compliant linked to an output, another output is still linked
+            first, second = os.path.join(tmp_dir, 'a.mkv'), os.path.join(tmp_dir, 'b.mkv')
+            FileProcessor(in_file, first, 'roku', verdict_index=verdict_index).process()
+            res = FileProcessor(in_file, second, 'roku', verdict_index=verdict_index).process()
+            self.assertEqual(res['output'], second)
+            self.assertTrue(os.path.samefile(in_file, second))
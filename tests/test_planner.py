@@ -0,0 +1,102 @@
+__author__ = 'kako'
+
+import csv
+import io
+import json
+
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+
+from ffconv import profiles
+from ffconv.planner import Planner, write_csv, write_json
+
+
+STREAMS = [
+    {'index': 0, 'codec_type': 'video', 'codec_name': 'h264', 'refs': 16,
+     'width': 1920, 'height': 1080, 'tags': {'DURATION': '00:10:00.000000000', 'BPS': '8000000'}},
+    {'index': 1, 'codec_type': 'audio', 'codec_name': 'aac', 'channels': 2,
+     'duration': '600.0', 'bit_rate': '128000', 'tags': {'language': 'eng'}},
+    {'index': 2, 'codec_type': 'audio', 'codec_name': 'dts', 'channels': 6,
+     'duration': '600.0', 'bit_rate': '1536000'},
+    {'index': 3, 'codec_type': 'subtitle', 'codec_name': 'ass'},
+    {'index': 4, 'codec_type': 'attachment', 'codec_name': 'ttf'},
+]
+
+
+class PlannerTest(TestCase):
+
+    @patch('ffconv.file_processor.FileProcessor.probe', MagicMock(return_value=STREAMS))
+    def test_plan_file(self):
+        planner = Planner('roku')
+        plan = planner.plan_file('film.mkv')
+
+        # Streams with actions, unknown types are ignored
+        self.assertEqual(plan['duration'], 600.0)
+        self.assertEqual([(s['index'], s['action'], s['target_codec']) for s in plan['streams']],
+                         [(0, 'transcode', 'h264'), (1, 'copy', 'aac'),
+                          (2, 'transcode', 'mp3'), (3, 'extract', 'srt')])
+
+        # Video: 3 CPU-s/s at 1080p slow, audio: 0.02, rest 0.001
+        self.assertAlmostEqual(plan['cpu_seconds'], 1800 + 12 + 0.6 + 0.6)
+
+        # Converted streams are written twice, then copied ones once
+        video, aac, mp3, srt = 600000000, 9600000, 14400000, 7500
+        self.assertEqual(plan['bytes_written'], 2 * (video + mp3 + srt) + aac)
+
+        # Single pass writes everything once
+        planner = Planner('roku', single_pass=True)
+        plan = planner.plan_file('film.mkv')
+        self.assertEqual(plan['bytes_written'], video + mp3 + srt + aac)
+
+    @patch('ffconv.file_processor.FileProcessor.probe', MagicMock(return_value=[
+        {'index': 0, 'codec_type': 'video', 'codec_name': 'h264', 'refs': 4, 'height': 720, 'duration': '600.0'},
+        {'index': 1, 'codec_type': 'audio', 'codec_name': 'aac', 'channels': 6,
+         'duration': '600.0', 'bit_rate': '640000'},
+    ]))
+    def test_plan_downmix(self):
+        profile = dict(profiles.ROKU, audio=dict(profiles.ROKU['audio'], keep_original=True))
+        plan = Planner(profile).plan_file('film.mkv')
+
+        # Downmix is an audio transcode (0.02 CPU-s/s at the target bit rate)
+        self.assertEqual([(s['index'], s['action']) for s in plan['streams']],
+                         [(0, 'copy'), (1, 'copy'), (1, 'downmix')])
+        self.assertAlmostEqual(plan['cpu_seconds'], 0.6 + 0.6 + 12)
+        video, aac, downmix = 300000000, 48000000, 14400000
+        self.assertEqual(plan['bytes_written'], 2 * downmix + video + aac)
+
+    @patch('ffconv.file_processor.FileProcessor.probe', MagicMock(side_effect=ValueError('Not media')))
+    def test_plan_errors(self):
+        # Failed probe, error in plan
+        planner = Planner('roku')
+        plan = planner.plan_file('notes.txt')
+        self.assertEqual(plan['error'], 'Not media')
+        self.assertEqual(plan['streams'], [])
+
+        # Already done, skipped
+        verdict_index = MagicMock(get=MagicMock(return_value={'verdict': 'compliant', 'output': None}))
+        planner = Planner('roku', verdict_index=verdict_index)
+        plan = planner.plan_file('film.mkv')
+        self.assertEqual(plan['verdict'], 'compliant')
+        self.assertEqual(plan['cpu_seconds'], 0)
+
+    def test_writers(self):
+        plans = [{'input': 'film.mkv', 'duration': 60.0, 'cpu_seconds': 180.0, 'bytes_written': 1000,
+                  'streams': [{'index': 0, 'action': 'transcode'}, {'index': 1, 'action': 'copy'},
+                              {'index': 2, 'action': 'extract'}, {'index': 3, 'action': 'extract'},
+                              {'index': 2, 'action': 'downmix'}]},
+                 {'input': 'notes.txt', 'duration': None, 'cpu_seconds': 0, 'bytes_written': 0,
+                  'streams': [], 'error': 'Not media'}]
+
+        # JSON includes totals
+        out = io.StringIO()
+        write_json(plans, out)
+        res = json.loads(out.getvalue())
+        self.assertEqual(res['totals'], {'files': 2, 'cpu_seconds': 180.0, 'bytes_written': 1000})
+
+        # CSV has stream indexes per action
+        out = io.StringIO()
+        write_csv(plans, out)
+        rows = list(csv.DictReader(io.StringIO(out.getvalue())))
+        self.assertEqual((rows[0]['transcode'], rows[0]['copy'], rows[0]['extract'], rows[0]['downmix']),
+                         ('0', '1', '2 3', '2'))
+        self.assertEqual(rows[1]['error'], 'Not media')
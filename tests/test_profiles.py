@@ -0,0 +1,179 @@
+__author__ = 'kako'
+
+import copy
+import json
+import os
+import tempfile
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from ffconv import profiles
+from ffconv.cache import profile_hash
+from ffconv.stream_processors import StreamProcessor, VideoProcessor, AudioProcessor, SubtitleProcessor
+
+
+class CompileProfileTest(TestCase):
+
+    def test_compile(self):
+        compiled = profiles.compile_profile(profiles.ROKU)
+        self.assertEqual(compiled.name, 'Roku')
+        self.assertEqual(compiled.hash, profile_hash(profiles.ROKU))
+        self.assertEqual(compiled.video.codecs, ('h264',))
+        self.assertTrue(compiled.audio.allows('aac'))
+        self.assertFalse(compiled.audio.allows('dts'))
+        self.assertEqual(compiled.subtitle.encodings, ('utf-8', 'iso-8859-1'))
+
+        # Compiled once, equal profiles share it, modified ones do not
+        self.assertIs(profiles.compile_profile(profiles.ROKU), compiled)
+        self.assertIs(profiles.compile_profile(copy.deepcopy(profiles.ROKU)), compiled)
+        self.assertIs(profiles.compile_profile(compiled), compiled)
+        tuned = dict(profiles.ROKU, video=dict(profiles.ROKU['video'], quality=20))
+        self.assertEqual(profiles.compile_profile(tuned).video.quality, 20)
+
+        # Immutable
+        with self.assertRaises(AttributeError):
+            compiled.video.quality = 18
+        with self.assertRaises(AttributeError):
+            compiled.name = 'Other'
+
+    def test_max_refs(self):
+        video = profiles.compile_profile(profiles.ROKU).video
+
+        # First height not lower wins, default over the highest one
+        self.assertEqual(video.max_refs(480), 9)
+        self.assertEqual(video.max_refs(720), 9)
+        self.assertEqual(video.max_refs(1080), 5)
+        self.assertEqual(video.max_refs(2160), profiles.DEFAULT_MAX_REFS)
+
+        # Heights as strings (eg, from JSON) are fine
+        data = copy.deepcopy(profiles.ROKU)
+        data['video']['max_refs'] = {'1080': 5, '720': 9}
+        self.assertEqual(profiles.compile_profile(data).video.max_refs(720), 9)
+
+    def test_validation(self):
+        def broken(media_type, **values):
+            data = copy.deepcopy(profiles.ROKU)
+            data[media_type].update(values)
+            for key in [k for k, v in values.items() if v is None]:
+                del data[media_type][key]
+            return data
+
+        # Missing sections and values, or invalid values
+        self.assertRaises(ValueError, profiles.compile_profile, {'name': 'Empty'})
+        self.assertRaises(ValueError, profiles.compile_profile, broken('video', preset=None))
+        self.assertRaises(ValueError, profiles.compile_profile, broken('video', codecs=[]))
+        self.assertRaises(ValueError, profiles.compile_profile, broken('video', quality='high'))
+        self.assertRaises(ValueError, profiles.compile_profile, broken('video', max_refs={'hd': 4}))
+        self.assertRaises(ValueError, profiles.compile_profile, broken('video', threads='many'))
+        self.assertRaises(ValueError, profiles.compile_profile, broken('video', max_height=0))
+        self.assertRaises(ValueError, profiles.compile_profile, broken('audio', max_channels=True))
+        self.assertRaises(ValueError, profiles.compile_profile, broken('subtitle', encodings=[]))
+
+        # Sections can be left out (their streams are dropped), but not all
+        audio = profiles.compile_profile({'name': 'Audio', 'audio': profiles.ROKU['audio']})
+        self.assertEqual((audio.video, audio.rules('subtitle')), (None, None))
+        self.assertRaises(ValueError, profiles.compile_profile, {'name': 'Empty', 'video': None})
+        self.assertRaises(ValueError, profiles.compile_profile, dict(profiles.ROKU, video=['h264']))
+
+        # Numeric level is fine, as a string
+        self.assertEqual(profiles.compile_profile(broken('video', level=4.1)).video.level, '4.1')
+
+
+class ProfileLoaderTest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.loader = profiles.ProfileLoader([self.tmp_dir.name])
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write(self, name, text):
+        path = os.path.join(self.tmp_dir.name, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_load(self):
+        # Built-in, by name (any case), or data as is
+        self.assertIs(self.loader.load('roku'), profiles.ROKU)
+        self.assertIs(self.loader.load('Roku'), profiles.ROKU)
+        self.assertIs(self.loader.load(profiles.ROKU), profiles.ROKU)
+        self.assertRaises(ValueError, self.loader.load, 'toaster')
+
+        # From a file by name, extending a built-in (named after the file)
+        self.write('mobile.yaml', 'extends: roku\nvideo:\n  preset: veryfast\n  max_refs: {720: 4}\n')
+        mobile = self.loader.load('mobile')
+        self.assertEqual(mobile['name'], 'mobile')
+        self.assertEqual(mobile['video']['preset'], 'veryfast')
+        self.assertEqual(mobile['video']['max_refs'], {720: 4})
+        self.assertEqual(mobile['video']['quality'], 22)
+        self.assertEqual(profiles.ROKU['video']['preset'], 'slow')
+
+        # From a file by path, extending another file
+        path = self.write('tiny.json', json.dumps({'name': 'Tiny', 'extends': 'mobile',
+                                                   'audio': {'max_channels': 1}}))
+        tiny = self.loader.load(path)
+        self.assertEqual(tiny['name'], 'Tiny')
+        self.assertEqual(tiny['video']['preset'], 'veryfast')
+        self.assertEqual(tiny['audio']['max_channels'], 1)
+
+        # Dropping a section of the base profile
+        self.write('mute.yaml', 'extends: roku\naudio: null\n')
+        self.assertEqual(profiles.compile_profile(self.loader.load('mute')).audio, None)
+
+    def test_invalid(self):
+        # Not parseable, or not a mapping
+        self.write('broken.json', '{"name": ')
+        self.assertRaises(ValueError, self.loader.load, 'broken')
+        self.write('list.yaml', '- roku\n')
+        self.assertRaises(ValueError, self.loader.load, 'list')
+
+        # Unknown keys (eg, typos) or invalid values
+        self.write('typo.yaml', 'extends: roku\nvideo:\n  qualty: 20\n')
+        self.assertRaises(ValueError, self.loader.load, 'typo')
+        self.write('bad.yaml', 'extends: roku\naudio:\n  max_channels: many\n')
+        self.assertRaises(ValueError, self.loader.load, 'bad')
+
+        # Extending itself, or something missing
+        self.write('loop.yaml', 'extends: loop\n')
+        self.assertRaises(ValueError, self.loader.load, 'loop')
+        self.write('orphan.yaml', 'extends: toaster\n')
+        self.assertRaises(ValueError, self.loader.load, 'orphan')
+
+    def test_cache(self):
+        path = self.write('mobile.json', json.dumps({'extends': 'roku', 'video': {'quality': 26}}))
+
+        # Parsed once while it does not change
+        with patch('ffconv.profiles.json.load', wraps=json.load) as load:
+            self.assertEqual(self.loader.load('mobile')['video']['quality'], 26)
+            self.loader.load('mobile')
+            self.assertEqual(load.call_count, 1)
+
+            # Modified, parsed again
+            self.write('mobile.json', json.dumps({'extends': 'roku', 'video': {'quality': 28}}))
+            os.utime(path, ns=(0, 0))
+            self.assertEqual(self.loader.load('mobile')['video']['quality'], 28)
+            self.assertEqual(load.call_count, 2)
+
+    def test_examples(self):
+        examples = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'examples', 'profiles')
+        loader = profiles.ProfileLoader([examples])
+        for name in sorted(os.listdir(examples)):
+            profile = loader.load(os.path.splitext(name)[0])
+            self.assertIsInstance(profiles.compile_profile(profile), profiles.CompiledProfile)
+
+
+class RegistryTest(TestCase):
+
+    def test_for_stream(self):
+        self.assertIs(StreamProcessor.for_stream({'codec_type': 'video'}), VideoProcessor)
+        self.assertIs(StreamProcessor.for_stream({'codec_type': 'audio'}), AudioProcessor)
+        self.assertIs(StreamProcessor.for_stream({'codec_type': 'subtitle'}), SubtitleProcessor)
+        self.assertIs(StreamProcessor.for_stream({'codec_type': 'attachment'}), None)
+
+        # Subclasses do not replace the registered processor
+        class OtherVideoProcessor(VideoProcessor):
+            pass
+        self.assertIs(StreamProcessor.for_stream({'codec_type': 'video'}), VideoProcessor)
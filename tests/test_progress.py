@@ -0,0 +1,99 @@
+__author__ = 'kako'
+
+import json
+import os
+import tempfile
+
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+
+from ffconv import profiles
+from ffconv.progress import ProgressReporter, ProgressTracker, with_progress
+from ffconv.stream_processors import VideoProcessor
+
+
+PROGRESS = '''frame=1250
+fps=25.0
+bitrate=1000.0kbits/s
+total_size=6250000
+out_time_us=50000000
+out_time_ms=50000000
+out_time=00:00:50.000000
+speed=2.5x
+progress=continue
+frame=2500
+fps=N/A
+out_time=00:01:40.000000
+speed=N/A
+progress=end'''
+
+
+class ProgressTrackerTest(TestCase):
+
+    def test_with_progress(self):
+        cmd = ['ffmpeg', '-i', 'input.mkv', 'output.mkv']
+        self.assertEqual(with_progress(cmd), ['ffmpeg', '-progress', 'pipe:2', '-nostats',
+                                              '-i', 'input.mkv', 'output.mkv'])
+
+    def test_parse(self):
+        snapshots = []
+        tracker = ProgressTracker('job', 100.0, snapshots.append)
+
+        # Regular log lines are ignored, a snapshot per block
+        tracker('Stream mapping:')
+        tracker('  Stream #0:0 -> #0:0 (h264 (native) -> h264 (libx264))')
+        for line in PROGRESS.splitlines():
+            tracker(line)
+        self.assertEqual(len(snapshots), 2)
+
+        # First one, in progress
+        snapshot = snapshots[0]
+        self.assertEqual(snapshot['job'], 'job')
+        self.assertEqual((snapshot['fps'], snapshot['speed'], snapshot['out_time']), (25.0, 2.5, 50.0))
+        self.assertEqual((snapshot['percent'], snapshot['eta'], snapshot['done']), (50.0, 20.0, False))
+        self.assertEqual(snapshot['total_size'], 6250000)
+
+        # Second one, done (and values not available)
+        snapshot = snapshots[1]
+        self.assertEqual((snapshot['fps'], snapshot['speed'], snapshot['out_time']), (None, None, 100.0))
+        self.assertEqual((snapshot['percent'], snapshot['eta'], snapshot['done']), (100.0, None, True))
+
+        # Without duration, no percentage nor ETA
+        snapshots = []
+        tracker = ProgressTracker('job', None, snapshots.append)
+        for line in PROGRESS.splitlines():
+            tracker(line)
+        self.assertEqual((snapshots[0]['percent'], snapshots[0]['eta']), (None, None))
+
+    def test_reporter(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            jsonl_file = os.path.join(tmp_dir, 'progress.jsonl')
+            reporter = ProgressReporter(jsonl_file)
+            snapshot = {'job': 'job', 'fps': 25.0, 'speed': None, 'percent': 50.0, 'eta': None}
+
+            # Log and append to file
+            with patch('logging.Logger.info') as info:
+                reporter(snapshot)
+                reporter(dict(snapshot, percent=100.0))
+                info.assert_called_with('job: 100.0% at 25.0 fps, ?x, ETA ?')
+
+            with open(jsonl_file) as f:
+                lines = [json.loads(line) for line in f]
+            self.assertEqual([line['percent'] for line in lines], [50.0, 100.0])
+
+    @patch('ffconv.stream_processors.execute_cmd')
+    def test_stream_progress(self, ecmd):
+        on_progress = MagicMock()
+        stream = {'index': 0, 'codec_type': 'video', 'codec_name': 'h264', 'refs': 16,
+                  'height': 720, 'duration': '100.0'}
+        processor = VideoProcessor('some-film.mkv', stream, profiles.ROKU, on_progress=on_progress)
+
+        # Convert, command has progress and log lines are tracked
+        processor.convert()
+        cmd, = ecmd.call_args[0]
+        self.assertEqual(cmd[:4], ['ffmpeg', '-progress', 'pipe:2', '-nostats'])
+        tracker = ecmd.call_args[1]['on_line']
+        self.assertEqual((tracker.job, tracker.duration), (str(processor), 100.0))
+        for line in PROGRESS.splitlines():
+            tracker(line)
+        self.assertEqual(on_progress.call_count, 2)
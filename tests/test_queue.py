@@ -0,0 +1,172 @@
+__author__ = 'kako'
+
+import json
+import os
+import tempfile
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+
+from ffconv import profiles
+from ffconv.work_queue import WorkQueue, Worker
+
+
+class WorkQueueTest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.queue = WorkQueue(os.path.join(self.tmp_dir.name, 'queue'), max_attempts=2)
+        self.files = [os.path.join(self.tmp_dir.name, name) for name in ['a.mkv', 'b.mkv', 'c.mkv']]
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_enqueue(self):
+        a, b, c = self.files
+
+        # Add files, with outputs in the given directory
+        self.assertEqual(self.queue.enqueue([a, b], 'roku', '/out'), 2)
+        job = self.queue.claim('w1', 60)
+        self.assertEqual((job['path'], job['profile'], job['output']), (a, 'roku', '/out/a.mkv'))
+
+        # Already there, not added again (unless with another profile)
+        self.assertEqual(self.queue.enqueue([a, b, c], 'roku'), 1)
+        self.assertEqual(self.queue.enqueue([a], 'other'), 1)
+        self.assertEqual(self.queue.stats(), {'queued': 3, 'leased': 1})
+
+        # Failed, queued again
+        self.queue.complete(job['id'], 'w1', {'error': 'Oops'})
+        self.assertEqual(self.queue.enqueue([a], 'roku'), 1)
+        self.assertEqual(self.queue.get(job['id'])['state'], 'queued')
+
+        # Names relative to the output directory (eg, to keep subdirectories)
+        queue = WorkQueue(os.path.join(self.tmp_dir.name, 'other'))
+        queue.enqueue([c], 'roku', '/out', {c: os.path.join('season', 'c.mkv')})
+        self.assertEqual(queue.claim('w1', 60)['output'], os.path.join('/out', 'season', 'c.mkv'))
+
+        # Relative output directory, stored as absolute (workers may run
+        # elsewhere)
+        queue.enqueue([a], 'roku', 'out')
+        self.assertEqual(queue.claim('w1', 60)['output'], os.path.abspath(os.path.join('out', 'a.mkv')))
+
+    def test_leases(self):
+        a, b, c = self.files
+        self.queue.enqueue([a, b], 'roku')
+
+        # Each worker gets its own job, then there's nothing left
+        first = self.queue.claim('w1', 60)
+        second = self.queue.claim('w2', 60)
+        self.assertEqual((first['path'], second['path']), (a, b))
+        self.assertEqual(self.queue.claim('w3', 60), None)
+
+        # Only the holder can extend or complete it
+        self.assertTrue(self.queue.heartbeat(first['id'], 'w1', 60))
+        self.assertFalse(self.queue.heartbeat(first['id'], 'w2', 60))
+        self.assertFalse(self.queue.complete(first['id'], 'w2', {}))
+        self.assertTrue(self.queue.complete(first['id'], 'w1', {'output': None}))
+        self.assertEqual(self.queue.get(first['id'])['state'], 'done')
+        self.assertEqual(json.loads(self.queue.get(first['id'])['result']), {'output': None})
+
+        # Released, taken by next worker right away
+        self.assertTrue(self.queue.release(second['id'], 'w2'))
+        self.assertEqual(self.queue.claim('w3', 60)['id'], second['id'])
+
+    def test_expiry(self):
+        a, b, c = self.files
+        self.queue.enqueue([a], 'roku')
+        job = self.queue.claim('w1', 60)
+
+        # Lease expired, taken over (and the first worker lost it)
+        with patch('ffconv.work_queue.time.time', return_value=job['expires'] + 1):
+            taken = self.queue.claim('w2', 60)
+        self.assertEqual(taken['id'], job['id'])
+        self.assertFalse(self.queue.heartbeat(job['id'], 'w1', 60))
+
+        # Expired too many times, failed
+        with patch('ffconv.work_queue.time.time', return_value=job['expires'] + 3600):
+            self.assertEqual(self.queue.claim('w3', 60), None)
+        self.assertEqual(self.queue.stats(), {'failed': 1})
+
+    def test_concurrent_claims(self):
+        paths = [os.path.join(self.tmp_dir.name, '{}.mkv'.format(i)) for i in range(20)]
+        self.queue.enqueue(paths, 'roku')
+
+        # Many workers claiming at once, no job is leased twice
+        def claim_all(worker):
+            jobs = []
+            while True:
+                job = self.queue.claim(worker, 60)
+                if job is None:
+                    return jobs
+                jobs.append(job['path'])
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            claimed = list(executor.map(claim_all, ['w1', 'w2', 'w3', 'w4']))
+        self.assertEqual(sorted(sum(claimed, [])), sorted(paths))
+
+
+class WorkerTest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.queue = WorkQueue(os.path.join(self.tmp_dir.name, 'queue'))
+        self.queue.enqueue(['a.mkv', 'b.mkv', 'c.mkv'], 'roku', '/out')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    @patch('ffconv.work_queue.process_file')
+    def test_run(self, process_file):
+        process_file.side_effect = lambda in_file, output, profile, **kwargs: \
+            {'input': in_file, 'error': 'Oops'} if in_file.endswith('b.mkv') else {'input': in_file}
+
+        # Process until max jobs, then until the queue is empty
+        worker = Worker(self.queue, name='w1', max_jobs=2, single_pass=True)
+        self.assertEqual(len(worker.run()), 2)
+        args, kwargs = process_file.call_args_list[0]
+        self.assertEqual(args, (os.path.abspath('a.mkv'), '/out/a.mkv', profiles.ROKU))
+        self.assertTrue(kwargs['single_pass'])
+        self.assertIsInstance(kwargs['stop'], threading.Event)
+
+        worker.max_jobs = None
+        self.assertEqual(len(worker.run()), 3)
+        self.assertEqual(self.queue.stats(), {'done': 2, 'failed': 1})
+
+    @patch('ffconv.work_queue.process_file')
+    def test_lost_lease(self, process_file):
+        # Lease taken over while processing, conversion is stopped and the
+        # result is not recorded
+        def process(in_file, output, profile, stop, **kwargs):
+            self.queue.release(1, 'w1')
+            self.queue.claim('w2', 60)
+            self.assertTrue(stop.wait(5))
+            return {'input': in_file, 'error': 'Stopped'}
+        process_file.side_effect = process
+
+        worker = Worker(self.queue, name='w1', lease_time=0.04, max_jobs=1)
+        self.assertEqual(worker.process_job(self.queue.claim('w1', 60)), None)
+        self.assertEqual(self.queue.get(1)['worker'], 'w2')
+        self.assertEqual(self.queue.get(1)['state'], 'leased')
+
+    @patch('ffconv.work_queue.process_file')
+    def test_collect_garbage(self, process_file):
+        process_file.side_effect = lambda in_file, output, profile, **kwargs: {'input': in_file}
+        journal = MagicMock()
+        journal.collect_garbage.return_value = 0
+
+        # Orphan jobs are removed at start, and again after taking over the
+        # lease of a worker that stopped
+        self.queue.claim('w0', -1)
+        worker = Worker(self.queue, name='w1', journal=journal)
+        self.assertEqual(len(worker.run()), 3)
+        self.assertEqual(journal.collect_garbage.call_count, 2)
+        self.assertEqual(process_file.call_args_list[0][1]['journal'], journal)
+
+    @patch('ffconv.work_queue.process_file', side_effect=KeyboardInterrupt)
+    def test_interrupted(self, process_file):
+        # Interrupted, job is released
+        worker = Worker(self.queue, name='w1')
+        self.assertRaises(KeyboardInterrupt, worker.run)
+        self.assertEqual(self.queue.stats(), {'queued': 3})
@@ -0,0 +1,106 @@
+__author__ = 'kako'
+
+import asyncio
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import patch
+
+from ffconv.cache import ProbeCache
+from ffconv.scanner import Scanner, write_json_line
+
+
+VIDEO = {'index': 0, 'codec_type': 'video', 'codec_name': 'h264', 'height': 720, 'duration': '60.0'}
+
+
+class ScannerTest(IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.files = []
+        for i in range(8):
+            self.files.append(os.path.join(self.tmp_dir.name, '{}.mkv'.format(i)))
+            with open(self.files[-1], 'wb') as f:
+                f.write(b'x' * i)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    @patch('ffconv.file_processor.execute_cmd_async')
+    async def test_scan(self, ecmd):
+        running = {'probes': 0, 'full': 0, 'max_probes': 0, 'max_full': 0}
+
+        async def probe(cmd, io_stats):
+            # Fast probes of odd files miss refs, so they are probed fully
+            full = '-show_entries' not in cmd
+            running['probes'] += 1
+            running['full'] += full
+            running['max_probes'] = max(running['max_probes'], running['probes'])
+            running['max_full'] = max(running['max_full'], running['full'])
+            await asyncio.sleep(0.05)
+            running['probes'] -= 1
+            running['full'] -= full
+            io_stats['rchar'] = 100
+            refs = 1 if full or int(os.path.basename(cmd[-1])[0]) % 2 == 0 else None
+            return json.dumps({'streams': [dict(VIDEO, refs=refs)]})
+
+        # All files scanned within limits, results as soon as they are done
+        ecmd.side_effect = probe
+        results = []
+        scanner = Scanner(io_jobs=4, fast_probe=True,
+                          probe_cache=ProbeCache(self.tmp_dir.name))
+        stats = await scanner.scan_async(self.files + ['missing.mkv'], results.append)
+        self.assertEqual(sorted(r['input'] for r in results), sorted(self.files + ['missing.mkv']))
+        self.assertEqual(running['max_probes'], 4)
+        self.assertEqual(stats, {'files': 9, 'errors': 1, 'probes': 12, 'fallbacks': 4, 'bytes_read': 1200})
+
+        # Each result has the file's size, duration and streams
+        by_input = {r['input']: r for r in results}
+        self.assertEqual(by_input[self.files[3]]['size'], 3)
+        self.assertEqual(by_input[self.files[3]]['duration'], 60.0)
+        self.assertEqual(by_input[self.files[3]]['streams'][0]['refs'], 1)
+        self.assertIn('error', by_input['missing.mkv'])
+
+        # Full probes are mostly waiting for storage too, as many run at once
+        running.update(max_probes=0, max_full=0)
+        stats = await Scanner(io_jobs=4).scan_async(self.files)
+        self.assertEqual((stats['probes'], stats['fallbacks']), (8, 0))
+        self.assertEqual(running['max_full'], 4)
+
+        # Probe cache filled, scanned again without probing
+        ecmd.reset_mock()
+        scanner = Scanner(probe_cache=ProbeCache(self.tmp_dir.name))
+        stats = await scanner.scan_async(self.files)
+        self.assertEqual((stats['files'], stats['probes']), (8, 0))
+        self.assertFalse(ecmd.called)
+
+    def test_scan_threads(self):
+        running = {'now': 0, 'max': 0}
+        lock = threading.Lock()
+
+        def cached(processor):
+            with lock:
+                running['now'] += 1
+                running['max'] = max(running['max'], running['now'])
+            time.sleep(0.02)
+            with lock:
+                running['now'] -= 1
+            return [VIDEO]
+
+        # Cache lookups (slow on network filesystems) do not block each other
+        with patch('ffconv.file_processor.FileProcessor._get_cached_probe', cached):
+            stats = Scanner(io_jobs=4).scan(self.files)
+        self.assertEqual((stats['files'], stats['errors']), (8, 0))
+        self.assertEqual(running['max'], 4)
+
+    def test_write_json_line(self):
+        out = io.StringIO()
+        write_json_line({'input': 'a.mkv', 'size': 1}, out)
+        write_json_line({'input': 'b.mkv', 'error': 'Oops'}, out)
+        self.assertEqual([json.loads(line)['input'] for line in out.getvalue().splitlines()],
+                         ['a.mkv', 'b.mkv'])
@@ -1,10 +1,17 @@
 __author__ = 'kako'
 
+import codecs
+import os
+import subprocess
+import tempfile
+import threading
+
 from unittest import TestCase
 from unittest.mock import patch, MagicMock
 
 from ffconv import profiles
-from ffconv.stream_processors import VideoProcessor, AudioProcessor, SubtitleProcessor
+from ffconv.stream_processors import VideoProcessor, AudioProcessor, AudioBatch, SubtitleProcessor
+from ffconv.subtitles import detect_encoding
 
 
 class VideoProcessorTest(TestCase):
@@ -39,6 +46,154 @@ class VideoProcessorTest(TestCase):
         self.assertTrue(ecmd.called)
         ecmd.assert_called_once_with(cmd)
 
+    def test_output_args(self):
+        input, profile = 'some-film.mkv', profiles.ROKU
+
+        # Compliant stream, just copy it
+        stream = {'index': 0, 'codec_type': 'video',
+                  'codec_name': 'h264', 'refs': 4, 'height': 720}
+        processor = VideoProcessor(input, stream, profile)
+        self.assertEqual(processor.output_args(0), ['-c:0', 'copy'])
+
+        # Too many refs, encode with target values
+        stream = {'index': 0, 'codec_type': 'video',
+                  'codec_name': 'h264', 'refs': 16, 'height': 720}
+        processor = VideoProcessor(input, stream, profile)
+        args = ['-c:0', 'h264', '-preset:0', 'slow', '-crf:0', '22',
+                '-profile:0', 'high', '-level:0', '4.1']
+        self.assertEqual(processor.output_args(0), args)
+
+    def test_scale(self):
+        input, profile = 'some-film.mkv', dict(profiles.ROKU)
+        profile['video'] = dict(profile['video'], max_height=480)
+        stream = {'index': 0, 'codec_type': 'video',
+                  'codec_name': 'h264', 'refs': 4, 'height': 720}
+
+        # Compliant but too tall, scale it down
+        processor = VideoProcessor(input, stream, profile)
+        self.assertTrue(processor.must_convert)
+        self.assertEqual(processor.build_command()[5:9], ['-filter:v', 'scale=-2:480', '-c:v', 'h264'])
+        self.assertEqual(processor.output_args(1)[:4], ['-filter:1', 'scale=-2:480', '-c:1', 'h264'])
+        self.assertEqual(processor.params()['height'], 480)
+
+        # Not taller, just copy it
+        processor = VideoProcessor(input, dict(stream, height=480), profile)
+        self.assertFalse(processor.must_convert)
+        self.assertEqual(processor.output_args(0), ['-c:0', 'copy'])
+
+        # Converted for other reasons, not scaled
+        processor = VideoProcessor(input, dict(stream, height=480, refs=16), profile)
+        self.assertNotIn('-filter:v', processor.build_command())
+        self.assertNotIn('height', processor.params())
+
+    def test_threads(self):
+        input, profile = 'some-film.mkv', dict(profiles.ROKU)
+        profile['video'] = dict(profile['video'], lookahead_threads=2)
+        stream = {'index': 0, 'codec_type': 'video',
+                  'codec_name': 'h264', 'refs': 16, 'height': 720}
+
+        # Threads and lookahead threads, for the command and single pass
+        processor = VideoProcessor(input, stream, profile)
+        processor.threads = 6
+        self.assertEqual(processor.build_command()[-5:],
+                         ['-threads', '6', '-x264-params', 'lookahead-threads=2', 'video-0.mp4'])
+        self.assertEqual(processor.output_args(1)[-4:],
+                         ['-threads:1', '6', '-x264-params:1', 'lookahead-threads=2'])
+
+    def test_split(self):
+        input, profile = 'some-film.mkv', profiles.ROKU
+        stream = {'index': 0, 'codec_type': 'video', 'codec_name': 'h264',
+                  'refs': 16, 'height': 720, 'duration': '1000.0'}
+        processor = VideoProcessor(input, stream, profile)
+        processor.segment_length = 300
+
+        # Keyframes every 100s (and other packets), split at the first
+        # keyframe after each segment length, last one is never too short
+        packets = '\n'.join('{:.6f},{}'.format(t, 'K_' if t % 100 == 0 else '__')
+                             for t in range(0, 1000, 50))
+        self.assertEqual(processor.split(packets), [(0.0, 300.0), (300.0, 600.0), (600.0, None)])
+
+        # File starting at 1.4s (eg, MPEG-TS), split points relative to it
+        shifted = '\n'.join('{:.6f},{}'.format(t + 1.4, 'K_' if t % 100 == 0 else '__')
+                             for t in range(0, 1000, 50))
+        self.assertEqual(processor.split(shifted + '\n1.400000\n'),
+                         [(0.0, 300.0), (300.0, 600.0), (600.0, None)])
+
+        # Too short to split, or no keyframes
+        processor.duration = 500.0
+        self.assertEqual(processor.split(packets), [(0.0, None)])
+        self.assertEqual(processor.split('N/A,K_\n'), [(0.0, None)])
+
+    @patch('ffconv.stream_processors.remove_files')
+    @patch('ffconv.stream_processors.execute_cmd')
+    def test_convert_segments(self, ecmd, remove):
+        input, profile = 'some-film.mkv', profiles.ROKU
+        stream = {'index': 0, 'codec_type': 'video', 'codec_name': 'h264',
+                  'refs': 16, 'height': 720, 'duration': '900.0'}
+        with tempfile.TemporaryDirectory() as work_dir:
+            processor = VideoProcessor(input, stream, profile, work_dir=work_dir)
+            processor.segment_jobs = 2
+            processor.threads = 8
+
+            # Keyframes, then segments (each checked) and concat
+            def execute(cmd, **kwargs):
+                if '-show_entries' in cmd and cmd[-1] == input:
+                    return '0.0,K_\n300.0,K_\n600.0,K_\n'
+                if cmd[0] == 'ffprobe':
+                    return '{"streams": [{"refs": 5}], "format": {"duration": "300.02"}}'
+                return ''
+            ecmd.side_effect = execute
+            processor.convert()
+
+            commands = [c[0][0] for c in ecmd.call_args_list]
+            encodes = sorted(c for c in commands if c[0] == 'ffmpeg' and '-ss' in c)
+            self.assertEqual(len(encodes), 3)
+            self.assertEqual(encodes[0][:7], ['ffmpeg', '-ss', '0.000000', '-i', input,
+                                              '-t', '300.000000'])
+            self.assertEqual(encodes[2][:5], ['ffmpeg', '-ss', '600.000000', '-i', input])
+            self.assertIn('-crf', encodes[0])
+            self.assertEqual(encodes[0][-3:], ['-threads', '4', os.path.join(work_dir, 'video-0.segment-0.mp4')])
+
+            # Segments concatenated losslessly, then removed
+            concat = commands[-1]
+            self.assertEqual(concat[:3] + concat[-3:], ['ffmpeg', '-f', 'concat', '-c', 'copy', processor.output])
+            list_file = os.path.join(work_dir, 'video-0.segments.txt')
+            with open(list_file) as f:
+                self.assertEqual(f.read().splitlines()[1],
+                                 "file '{}'".format(os.path.join(work_dir, 'video-0.segment-1.mp4')))
+            self.assertEqual(remove.call_args[0][0][-1], list_file)
+            ecmd.reset_mock()
+
+            # Segment too short (frames lost at boundary), fails
+            def execute(cmd, **kwargs):
+                if '-show_entries' in cmd and cmd[-1] == input:
+                    return '0.0,K_\n300.0,K_\n600.0,K_\n'
+                if cmd[0] == 'ffprobe':
+                    return '{"streams": [{"refs": 5}], "format": {"duration": "298.0"}}'
+                return ''
+            ecmd.side_effect = execute
+            processor.stop = threading.Event()
+            self.assertRaises(ValueError, processor.convert)
+            self.assertFalse(any('concat' in c[0][0] for c in ecmd.call_args_list))
+
+            # Other segments stopped, but not the stream's own stop event
+            self.assertTrue(ecmd.call_args_list[-1][1]['stop'].is_set())
+            self.assertFalse(processor.stop.is_set())
+
+    def test_check_segment(self):
+        input, profile = 'some-film.mkv', profiles.ROKU
+        stream = {'index': 0, 'codec_type': 'video', 'codec_name': 'h264',
+                  'refs': 16, 'height': 1080, 'duration': '900.0'}
+        processor = VideoProcessor(input, stream, profile)
+
+        # Good segment, and last one (until the end of the stream)
+        processor.check_segment(0, 0.0, 300.0, '{"streams": [{"refs": 5}], "format": {"duration": "300.04"}}')
+        processor.check_segment(2, 600.0, None, '{"streams": [{"refs": 5}], "format": {"duration": "300.0"}}')
+
+        # Too many reference frames
+        self.assertRaises(ValueError, processor.check_segment, 0, 0.0, 300.0,
+                          '{"streams": [{"refs": 6}], "format": {"duration": "300.0"}}')
+
     @patch('ffconv.stream_processors.VideoProcessor.convert', MagicMock())
     @patch('ffconv.stream_processors.VideoProcessor.clean_up', MagicMock())
     def test_process(self):
@@ -121,11 +276,87 @@ class AudioProcessorTest(TestCase):
                   'channels': 6, 'tags': {'language': 'por'}}
         processor = AudioProcessor(input, stream, profile)
         processor.convert()
-        cmd = ['ffmpeg', '-i', 'some-film.mkv', '-map', '0:1', '-c:a', 'mp3',
-               '-q:a', '2', '-ac:0', '2', 'audio-1.mp3']
+        cmd = ['ffmpeg', '-i', 'some-film.mkv', '-map', '0:1', '-c:a', 'flac',
+               '-ac:0', '2', 'audio-1.flac']
         self.assertTrue(ecmd.called)
         ecmd.assert_called_once_with(cmd)
 
+    def test_output_args(self):
+        input, profile = 'some-film.mkv', profiles.ROKU
+
+        # Compliant stream, just copy it
+        stream = {'index': 1, 'codec_type': 'audio', 'codec_name': 'aac',
+                  'channels': 2, 'tags': {'language': 'por'}}
+        processor = AudioProcessor(input, stream, profile)
+        self.assertEqual(processor.output_args(1), ['-c:1', 'copy'])
+
+        # Too many channels, keep the codec and reduce them
+        stream = {'index': 1, 'codec_type': 'audio', 'codec_name': 'flac',
+                  'channels': 6, 'tags': {'language': 'por'}}
+        processor = AudioProcessor(input, stream, profile)
+        self.assertEqual(processor.output_args(1), ['-c:1', 'flac', '-ac:1', '2'])
+
+        # Codec not allowed, encode with target values
+        stream = {'index': 1, 'codec_type': 'audio', 'codec_name': 'dts',
+                  'channels': 6, 'tags': {'language': 'por'}}
+        processor = AudioProcessor(input, stream, profile)
+        args = ['-c:1', 'mp3', '-q:1', '2', '-ac:1', '2']
+        self.assertEqual(processor.output_args(1), args)
+
+    def test_keep_original(self):
+        input = 'some-film.mkv'
+        profile = dict(profiles.ROKU, audio=dict(profiles.ROKU['audio'], keep_original=True))
+        stream = {'index': 1, 'codec_type': 'audio', 'codec_name': 'aac',
+                  'channels': 6, 'tags': {'language': 'por'}}
+
+        # Original is copied, and followed by its downmix
+        processor = AudioProcessor(input, stream, profile)
+        self.assertFalse(processor.must_convert)
+        downmix, = processor.companions()
+        self.assertTrue(downmix.must_convert)
+        self.assertEqual((downmix.action, downmix.key, downmix.output), ('downmix', '1-downmix', 'audio-1-downmix.m4a'))
+        self.assertEqual(downmix.output_args(2), ['-c:2', 'aac', '-ac:2', '2'])
+        self.assertEqual(downmix.companions(), [])
+
+        # Codecs with experimental native encoders use the stable ones
+        profile['audio']['codecs'] = ['aac', 'opus', 'vorbis']
+        for codec, encoder in [('opus', 'libopus'), ('vorbis', 'libvorbis')]:
+            downmix, = AudioProcessor(input, dict(stream, codec_name=codec), profile).companions()
+            self.assertEqual(downmix.output_args(2), ['-c:2', encoder, '-ac:2', '2'])
+            self.assertEqual(downmix.output_file_args()[:4], ['-map', '0:1', '-c:a', encoder])
+
+        # Codec not allowed, converted as usual
+        stream = dict(stream, codec_name='dts')
+        processor = AudioProcessor(input, stream, profile)
+        self.assertTrue(processor.must_convert)
+        self.assertEqual(processor.companions(), [])
+
+    @patch('ffconv.stream_processors.execute_cmd')
+    def test_batch(self, ecmd):
+        input, profile = 'some-film.mkv', profiles.ROKU
+        processors = [AudioProcessor(input, {'index': index, 'codec_type': 'audio', 'codec_name': codec,
+                                             'channels': 6}, profile)
+                      for index, codec in [(1, 'dts'), (2, 'aac')]]
+        AudioBatch(processors)
+
+        # A single command for all of them, run by the first one
+        for processor in processors:
+            processor.process()
+        cmd = ['ffmpeg', '-i', 'some-film.mkv',
+               '-map', '0:1', '-c:a', 'mp3', '-q:a', '2', '-ac:0', '2', 'audio-1.mp3',
+               '-map', '0:2', '-c:a', 'aac', '-ac:0', '2', 'audio-2.m4a']
+        ecmd.assert_called_once_with(cmd)
+        self.assertEqual([p.input for p in processors], ['audio-1.mp3', 'audio-2.m4a'])
+
+        # Failed, the error is raised for all of them
+        ecmd.side_effect = subprocess.CalledProcessError(1, cmd)
+        processors = [AudioProcessor(input, {'index': index, 'codec_type': 'audio', 'codec_name': 'dts',
+                                             'channels': 6}, profile) for index in (1, 2)]
+        AudioBatch(processors)
+        for processor in processors:
+            self.assertRaises(subprocess.CalledProcessError, processor.convert)
+        self.assertEqual(ecmd.call_count, 2)
+
     @patch('ffconv.stream_processors.AudioProcessor.convert', MagicMock())
     @patch('ffconv.stream_processors.AudioProcessor.clean_up', MagicMock())
     def test_process(self):
@@ -182,30 +413,102 @@ class SubtitleProcessorTest(TestCase):
     @patch('ffconv.stream_processors.execute_cmd')
     def test_convert(self, ecmd):
         input, profile = 'some-film.mkv', profiles.ROKU
-
-        # Convert flac with 6 channels
-        stream = {'index': 5, 'codec_type': 'subtitle', 'codec_name': 'ass',
-                  'tags': {'language': 'por'}}
+        text = '1\n00:00:01,000 --> 00:00:02,500\n¿Qué pasó, señor?\n'
+
+        def extract(cmd, **kwargs):
+            with open(cmd[-1], 'wb') as out_file:
+                out_file.write(text.encode('iso-8859-1'))
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            # Extract srt as is, recode it and it's done
+            stream = {'index': 5, 'codec_type': 'subtitle', 'codec_name': 'srt',
+                      'tags': {'language': 'por'}}
+            processor = SubtitleProcessor(input, stream, profile, work_dir=work_dir)
+            ecmd.side_effect = extract
+            processor.convert()
+            raw_output = os.path.join(work_dir, 'subtitle-5.raw.srt')
+            cmd = ['ffmpeg', '-i', 'some-film.mkv', '-map', '0:5', '-c:s', 'copy', raw_output]
+            ecmd.assert_called_once_with(cmd)
+            with open(processor.output, 'rb') as srt:
+                self.assertEqual(srt.read().decode('utf-8'), text)
+            self.assertEqual(os.listdir(work_dir), ['subtitle-5.srt'])
+            ecmd.reset_mock()
+
+            # Extract ass as is, recode it and convert it to srt
+            stream = {'index': 6, 'codec_type': 'subtitle', 'codec_name': 'ass'}
+            processor = SubtitleProcessor(input, stream, profile, work_dir=work_dir)
+            ecmd.side_effect = [None, None]
+            with patch('ffconv.stream_processors.SubtitleProcessor.recode', return_value=True):
+                processor.convert()
+            raw_output = os.path.join(work_dir, 'subtitle-6.raw.ass')
+            self.assertEqual(ecmd.call_args_list[0][0][0][-1], raw_output)
+            self.assertEqual(ecmd.call_args_list[1][0][0],
+                             ['ffmpeg', '-i', raw_output, os.path.join(work_dir, 'subtitle-6.srt')])
+            ecmd.reset_mock()
+
+            # Extraction fails, nothing left
+            ecmd.side_effect = subprocess.CalledProcessError(1, cmd)
+            self.assertRaises(ValueError, processor.convert)
+            self.assertEqual(os.listdir(work_dir), ['subtitle-5.srt'])
+            ecmd.reset_mock()
+
+        # Not a text codec: convert with first encoding
+        stream = {'index': 7, 'codec_type': 'subtitle', 'codec_name': 'mov_text'}
         processor = SubtitleProcessor(input, stream, profile)
+        ecmd.side_effect = None
         processor.convert()
         cmd = ['ffmpeg', '-sub_charenc', 'utf-8', '-i', 'some-film.mkv',
-               '-map', '0:5', 'subtitle-5.srt']
-        self.assertTrue(ecmd.called)
+               '-map', '0:7', 'subtitle-7.srt']
         ecmd.assert_called_once_with(cmd)
+        ecmd.reset_mock()
 
-    @patch('ffconv.stream_processors.execute_cmd')
-    def test_clean_up(self, ecmd):
-        input, profile = 'some-film.mkv', profiles.ROKU
+        # First encoding fails (without output), retry with next one
+        ecmd.side_effect = [subprocess.CalledProcessError(1, cmd), '']
+        processor.convert()
+        self.assertEqual(ecmd.call_count, 2)
+        self.assertEqual(ecmd.call_args[0][0][:3], ['ffmpeg', '-sub_charenc', 'iso-8859-1'])
 
-        # Convert flac with 6 channels
+    def test_detect_encoding(self):
+        encodings = ['utf-8', 'iso-8859-1', 'windows-1252']
+        text = '“Qué pasó?”, dijo el señor.'
+
+        # BOMs first, then UTF-8, then best scoring encoding
+        self.assertEqual(detect_encoding(codecs.BOM_UTF16_LE + text.encode('utf-16-le'), encodings), 'utf-16')
+        self.assertEqual(detect_encoding(codecs.BOM_UTF8 + text.encode('utf-8'), encodings), 'utf-8-sig')
+        self.assertEqual(detect_encoding(text.encode('utf-8'), encodings), 'utf-8')
+        self.assertEqual(detect_encoding(text.encode('windows-1252'), encodings), 'windows-1252')
+        self.assertEqual(detect_encoding('¿Qué pasó?'.encode('iso-8859-1'), encodings), 'iso-8859-1')
+
+        # None works
+        self.assertRaises(ValueError, detect_encoding, text.encode('windows-1252'), ['utf-8', 'ascii'])
+
+    def test_clean_up(self):
+        input, profile = 'some-film.mkv', profiles.ROKU
         stream = {'index': 6, 'codec_type': 'subtitle', 'codec_name': 'ass',
                   'tags': {'language': 'por'}}
+
+        # Clean up, tags are removed from text but cues are kept
+        with tempfile.TemporaryDirectory() as work_dir:
+            processor = SubtitleProcessor(input, stream, profile, work_dir=work_dir)
+            with open(processor.output, 'wb') as srt:
+                srt.write('1\r\n00:00:01,000 --> 00:00:02,500\r\n{\\an8}<i>¡Hola,</i> {lala}señor!\r\n\r\n'
+                          '2\r\n00:00:03,000 --> 00:00:04,000\r\n<font color="red">{\\b1}</font>\r\n'
+                          '<b>Adiós</b>\r\n'.encode('iso-8859-1'))
+            processor.clean_up()
+            with open(processor.output, 'rb') as srt:
+                self.assertEqual(srt.read().decode('iso-8859-1'),
+                                 '1\r\n00:00:01,000 --> 00:00:02,500\r\n¡Hola, señor!\r\n\r\n'
+                                 '2\r\n00:00:03,000 --> 00:00:04,000\r\nAdiós\r\n')
+            self.assertEqual(os.listdir(work_dir), ['subtitle-6.srt'])
+
+    def test_output_args(self):
+        input, profile = 'some-film.mkv', profiles.ROKU
+
+        # Always converted, even if it's already srt
+        stream = {'index': 4, 'codec_type': 'subtitle', 'codec_name': 'srt',
+                  'tags': {'language': 'por'}}
         processor = SubtitleProcessor(input, stream, profile)
-        processor.clean_up()
-        cmd = ['sed', '-i', '-e', r"s/<[^>]*>//ig", '-e', r"s/{[^}]*}//ig",
-               'subtitle-6.srt']
-        self.assertTrue(ecmd.called)
-        ecmd.assert_called_once_with(cmd)
+        self.assertEqual(processor.output_args(3), ['-c:3', 'srt'])
 
     @patch('ffconv.stream_processors.SubtitleProcessor.convert', MagicMock())
     @patch('ffconv.stream_processors.SubtitleProcessor.clean_up', MagicMock())